@@ -0,0 +1,6 @@
+"""
+Data and computation layer behind the ``hdvc.py`` Streamlit dashboard.
+
+The modules in this package do not depend on Streamlit, so they can be
+imported headlessly by benchmarks, batch exports and other tools.
+"""
@@ -0,0 +1,484 @@
+"""
+Headless benchmark of the code paths behind a dashboard rerun.
+
+Every stage the Streamlit script goes through is timed without a server:
+parsing the sources, the code join, the Parquet cache, the aggregate cube,
+the spatial index, the map filter, the statistics panel, the subregion and
+extremes tables, the trend matrices, the credible intervals and the
+fastest-rising table, and the build and JSON serialization of every figure. The
+per-view stages are swept over every year and continent, and the trend
+stages over every grouping level.
+
+Besides the WHO data itself (scale 1), the sweep runs on synthetic fact
+tables with 10x, 100x or 1000x as many areas, built by copying every
+country with jittered rates. Each stage reports its timing distribution and
+the peak memory of its slowest case, measured with ``tracemalloc`` in a
+separate run so that tracing does not skew the timings.
+
+An import-time report (``python -X importtime``, summarized by top-level
+package) shows what a cold process pays before the first rerun, and what
+the map view adds on top of it.
+
+Run ``python -m dashboard.bench --scales 1,10,100`` to write the results to
+``bench_results.json``, or ``python -m dashboard.bench --imports-only`` for
+the import report alone.
+"""
+import argparse
+import ast
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import plotly
+
+from dashboard import store, topo
+from dashboard.cube import AggregateCube
+from dashboard.dataset import Dataset
+from dashboard.figures import (
+    CONTINENT_RANGES,
+    TREND_LEVELS,
+    extremes_figure,
+    map_figure,
+    map_rows,
+    subregion_figure,
+    trend_figure,
+)
+from dashboard.model import RATE_COLUMNS, normalize
+from dashboard.ranking import extreme_gender_rates
+from dashboard.spatial import SpatialIndex
+from dashboard.trends import TRANSFORMS, TrendEngine
+from dashboard.uncertainty import Uncertainty
+
+OUTPUT_PATH = "bench_results.json"
+
+# Slider defaults of the dashboard
+RATE_RANGE = (0, 100)
+TOP_K = 5
+
+# Groups selected in the trends view at each level
+TREND_SELECTION = 10
+
+# The Streamlit script whose top-level imports make up a cold start, and
+# the modules the map view adds to them
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "hdvc.py")
+MAP_MODULES = ["dashboard.lod", "dashboard.model", "geopandas", "shapely"]
+
+# Packages that only the map view should need
+GEOMETRY_PACKAGES = ("geopandas", "shapely", "pyogrio", "pyproj", "fiona", "osgeo")
+
+# ----------------------------------------------------------------------
+# Measurements
+# ----------------------------------------------------------------------
+
+class Stage:
+    """
+    Timings of one stage over all the cases it was run for.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = []
+        self.cases = []
+        self.sizes = []
+        self.peak_bytes = None
+
+    def run(self, case, function, *args, **kwargs):
+        """
+        Time ``function(*args, **kwargs)`` and return its result.
+        """
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.seconds.append(time.perf_counter() - start)
+        self.cases.append(case)
+        if isinstance(result, (str, bytes)):
+            self.sizes.append(len(result))
+        return result
+
+    def slowest(self):
+        return self.cases[int(np.argmax(self.seconds))]
+
+    def report(self):
+        seconds = np.asarray(self.seconds) * 1000
+        report = {
+            "stage": self.name,
+            "runs": len(seconds),
+            "total_ms": float(seconds.sum()),
+            "mean_ms": float(seconds.mean()),
+            "median_ms": float(np.median(seconds)),
+            "p95_ms": float(np.percentile(seconds, 95)),
+            "max_ms": float(seconds.max()),
+            "slowest_case": self.slowest(),
+            "peak_mb": None if self.peak_bytes is None else self.peak_bytes / 2**20,
+        }
+        if self.sizes:
+            report["mean_bytes"] = float(np.mean(self.sizes))
+            report["max_bytes"] = int(max(self.sizes))
+        return report
+
+
+def peak_memory(function, *args, **kwargs):
+    """
+    Peak memory allocated by Python while running ``function(*args, **kwargs)``.
+    """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Suite:
+    """
+    Stages of one dataset, kept in the order they were first run.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.calls = {}
+
+    def run(self, name, case, function, *args, **kwargs):
+        stage = self.stages.setdefault(name, Stage(name))
+        self.calls.setdefault((name, _case_key(case)), (function, args, kwargs))
+        return stage.run(case, function, *args, **kwargs)
+
+    def measure_memory(self):
+        """
+        Re-run the slowest case of every stage under ``tracemalloc``.
+        """
+        for name, stage in self.stages.items():
+            function, args, kwargs = self.calls[(name, _case_key(stage.slowest()))]
+            stage.peak_bytes = peak_memory(function, *args, **kwargs)
+
+    def report(self):
+        return [stage.report() for stage in self.stages.values()]
+
+
+def _case_key(case):
+    return json.dumps(case, sort_keys=True)
+
+# ----------------------------------------------------------------------
+# Synthetic data
+# ----------------------------------------------------------------------
+
+def synthetic_facts(facts, scale, seed=0):
+    """
+    Grow the fact table ``scale`` times by copying every country.
+
+    Copy ``i`` of a country gets ``GEO_KEY + i * n``, ``n`` being past the
+    largest key in use (so copies have no polygon), and the name
+    ``"<name> (i)"``; its rates are the original ones times a log-normal
+    jitter, clipped to 0-100. Continents, subregions, years and sexes are
+    unchanged, so every view of the dashboard stays populated.
+    """
+    if scale == 1:
+        return facts
+    rng = np.random.default_rng(seed)
+    rows = len(facts)
+    copy = np.repeat(np.arange(scale), rows)
+    stride = int(facts["GEO_KEY"].max()) + 1
+
+    columns = {}
+    for column in facts.columns:
+        values = facts[column]
+        if column == "GEO_KEY":
+            columns[column] = (np.tile(values.to_numpy(), scale) + copy * stride).astype(values.dtype)
+        elif column == "NAME":
+            names = list(values.cat.categories)
+            categories = names + [f"{name} ({i})" for i in range(1, scale) for name in names]
+            codes = np.tile(values.cat.codes.to_numpy(), scale) + copy * len(names)
+            columns[column] = pd.Categorical.from_codes(codes, categories)
+        elif column in RATE_COLUMNS:
+            jitter = np.exp(rng.normal(0, 0.1, rows * scale)).astype(np.float32)
+            jitter[:rows] = 1
+            columns[column] = np.clip(np.tile(values.to_numpy(), scale) * jitter, 0, 100)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            codes = np.tile(values.cat.codes.to_numpy(), scale)
+            columns[column] = pd.Categorical.from_codes(codes, values.cat.categories)
+        else:
+            columns[column] = np.tile(values.to_numpy(), scale)
+    return pd.DataFrame(columns)
+
+# ----------------------------------------------------------------------
+# Stages
+# ----------------------------------------------------------------------
+
+def bench_sources(suite, csv_path, shapefile_path, cache_dir):
+    """
+    Cold and warm table loading, only meaningful on the real data.
+    """
+    obesity_data = suite.run("read_csv", {}, pd.read_csv, csv_path)
+    world = suite.run("read_shapefile", {}, gpd.read_file, shapefile_path)
+    suite.run("normalize", {}, normalize, world, obesity_data)
+    store.load_tables(csv_path, shapefile_path, cache_dir)
+    return suite.run("load_cached_tables", {}, store.load_tables, csv_path, shapefile_path, cache_dir)
+
+
+def map_geojson(geometry, continent):
+    """
+    GeoJSON of a continent's map view, from the on-disk topology cache.
+    """
+    view = CONTINENT_RANGES[continent]
+    return topo.to_geojson(topo.load_view_topology(geometry, tuple(view["lon"]), tuple(view["lat"])))
+
+
+def bench_views(suite, geometry, facts, years, continents, trend_selection=TREND_SELECTION):
+    """
+    Sweep the per-view stages over years, continents and trend levels.
+    """
+    dataset = suite.run("dataset", {}, Dataset.from_frame, facts)
+    facts = dataset.facts
+    cube = suite.run("cube", {}, AggregateCube, facts)
+    engine = suite.run("trend_engine", {}, TrendEngine, cube)
+    uncertainty = suite.run("uncertainty", {}, Uncertainty, facts, cube)
+    index = suite.run("spatial_index", {}, SpatialIndex, geometry)
+    view = CONTINENT_RANGES["Europe"]
+    centre = ((view["lon"][0] + view["lon"][1]) / 2, (view["lat"][0] + view["lat"][1]) / 2)
+    suite.run("point_lookup", {}, index.locate, *centre)
+
+    for continent in continents:
+        view = CONTINENT_RANGES[continent]
+        suite.run("viewport_query", {"continent": continent}, index.query_view, view["lon"], view["lat"])
+        geojson = suite.run("map_geometry", {"continent": continent}, map_geojson, geometry, continent)
+        for year in years:
+            case = {"year": int(year), "continent": continent}
+            suite.run("map_filter", case, map_rows, dataset, year, continent, RATE_RANGE)
+            suite.run("stats", case, cube.summary, year, continent)
+            suite.run("subregion_prep", case, cube.subregion_means, year, continent)
+            suite.run("extremes_prep", case, extreme_gender_rates, cube, year, continent, TOP_K)
+
+            figure = suite.run("map_figure", case, map_figure, dataset, geojson, year, continent, RATE_RANGE)
+            suite.run("map_json", case, figure.to_json)
+            figure = suite.run("subregion_figure", case, subregion_figure, cube, year, continent)
+            if figure is not None:
+                suite.run("subregion_json", case, figure.to_json)
+            figure = suite.run(
+                "extremes_figure", case, extremes_figure, cube, year, continent, TOP_K, uncertainty=uncertainty
+            )
+            suite.run("extremes_json", case, figure.to_json)
+
+    for level, (column, _) in TREND_LEVELS.items():
+        groups = list(dataset.groups(column))[:trend_selection]
+        for transform in TRANSFORMS:
+            case = {"level": level, "groups": len(groups), "transform": transform}
+            suite.run("trend_transform", case, engine.levels[column].values, transform)
+            suite.run("trend_prep", case, engine.series, column, groups, transform)
+            figure = suite.run(
+                "trend_figure", case, trend_figure, engine, level, groups, True, transform, uncertainty=uncertainty
+            )
+            suite.run("trend_json", case, figure.to_json)
+        countries = uncertainty.countries_of(column, dataset.groups(column))
+        suite.run("rising_table", {"level": level, "countries": len(countries)}, uncertainty.rising_table, countries)
+
+# ----------------------------------------------------------------------
+# Import time
+# ----------------------------------------------------------------------
+
+def import_times(modules):
+    """
+    Self and cumulative import time of every module, in microseconds.
+
+    The modules are imported in a fresh interpreter under
+    ``-X importtime``; returns ``(module, self_us, cumulative_us)`` rows.
+    """
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def script_imports(script=APP_SCRIPT):
+    """
+    Modules imported at the top level of ``script``, in order.
+
+    ``from package import name`` counts as an import of
+    ``package.name`` when that is a module, of ``package`` otherwise.
+    Imports inside functions are lazy and left out.
+    """
+    with open(script, encoding="utf-8") as handle:
+        tree = ast.parse(handle.read(), script)
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            for alias in node.names:
+                submodule = f"{node.module}.{alias.name}"
+                modules.append(submodule if _find_spec(submodule) else node.module)
+    return list(dict.fromkeys(modules))
+
+
+def _find_spec(name):
+    try:
+        return importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+
+
+def import_summary(modules, top=15):
+    """
+    Total import time of ``modules`` and the packages that cost the most.
+    """
+    rows = import_times(modules)
+    packages = {}
+    for name, self_us, _ in rows:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "modules": modules,
+        "total_ms": sum(self_us for _, self_us, _ in rows) / 1000,
+        "top_packages_ms": {package: us / 1000 for package, us in ranked[:top]},
+        "geometry_packages": sorted(set(packages) & set(GEOMETRY_PACKAGES)),
+    }
+
+
+def import_report():
+    """
+    Import cost of a cold start and of the first map view.
+    """
+    modules = script_imports()
+    startup = import_summary(modules)
+    with_map = import_summary(modules + MAP_MODULES)
+    return {
+        "startup": startup,
+        "map_view": with_map,
+        "map_view_extra_ms": with_map["total_ms"] - startup["total_ms"],
+    }
+
+# ----------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------
+
+def environment():
+    """
+    Versions identifying a benchmark run.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "plotly": plotly.__version__,
+    }
+
+
+def run(scales, years=None, continents=None, csv_path=store.CSV_PATH,
+        shapefile_path=store.SHAPEFILE_PATH, cache_dir=store.CACHE_DIR, memory=True, log=print):
+    """
+    Benchmark every scale and return the JSON-ready results.
+    """
+    source_suite = Suite()
+    geometry, facts, _ = bench_sources(source_suite, csv_path, shapefile_path, cache_dir)
+    if memory:
+        source_suite.measure_memory()
+
+    years = sorted(facts["DIM_TIME"].unique().astype(int)) if years is None else years
+    continents = list(CONTINENT_RANGES) if continents is None else continents
+
+    datasets = []
+    for scale in scales:
+        data = synthetic_facts(facts, scale)
+        log(f"scale {scale}: {len(data)} rows, {data['GEO_KEY'].nunique()} areas")
+        suite = Suite()
+        bench_views(suite, geometry, data, years, continents)
+        if memory:
+            suite.measure_memory()
+        datasets.append({"scale": scale, "rows": len(data), "stages": suite.report()})
+
+    return {
+        "environment": environment(),
+        "imports": import_report(),
+        "sweep": {"years": [int(year) for year in years], "continents": continents},
+        "sources": source_suite.report(),
+        "datasets": datasets,
+    }
+
+
+def print_import_report(report):
+    for name in ("startup", "map_view"):
+        summary = report[name]
+        geometry = ", ".join(summary["geometry_packages"]) or "none"
+        print(f"imports ({name}): {summary['total_ms']:.0f} ms, geometry packages: {geometry}")
+        for package, ms in list(summary["top_packages_ms"].items())[:8]:
+            print(f"  {package:<20} {ms:>10.1f} ms")
+
+
+def print_summary(results):
+    print_import_report(results["imports"])
+    print("sources")
+    for stage in results["sources"]:
+        print(f"  {stage['stage']:<20} {stage['mean_ms']:>10.1f} ms")
+    for dataset in results["datasets"]:
+        print(f"scale {dataset['scale']} ({dataset['rows']} rows)")
+        for stage in dataset["stages"]:
+            print(
+                f"  {stage['stage']:<20} mean {stage['mean_ms']:>9.2f} ms"
+                f"  p95 {stage['p95_ms']:>9.2f} ms  total {stage['total_ms']:>10.1f} ms"
+            )
+
+
+def _int_list(text):
+    return [int(item) for item in text.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard's rerun code paths.")
+    parser.add_argument("--scales", type=_int_list, default=[1, 10, 100],
+                        help="comma-separated dataset scales, e.g. 1,10,100,1000")
+    parser.add_argument("--years", type=_int_list, default=None, help="years to sweep (default: all)")
+    parser.add_argument("--continents", default=None,
+                        help="comma-separated geographical areas to sweep (default: all)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--imports-only", action="store_true", help="only report import times")
+    parser.add_argument("--csv", default=store.CSV_PATH, help="WHO obesity export")
+    parser.add_argument("--shapefile", default=store.SHAPEFILE_PATH, help="Natural Earth countries")
+    parser.add_argument("--cache-dir", default=store.CACHE_DIR, help="table cache directory")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="JSON results file")
+    args = parser.parse_args()
+
+    if args.imports_only:
+        results = {"environment": environment(), "imports": import_report()}
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump(results, handle, indent=2)
+        print_import_report(results["imports"])
+        print(f"Results written to {args.output}")
+        return
+
+    continents = args.continents.split(",") if args.continents else None
+    results = run(
+        args.scales, args.years, continents, args.csv, args.shapefile, args.cache_dir,
+        memory=not args.no_memory,
+    )
+    with open(args.output, "w", encoding="utf-8") as handle:
+        json.dump(results, handle, indent=2)
+    print_summary(results)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Browser-side map with all years preloaded.
+
+The page produced here is rendered with ``streamlit.components.v1.html``.
+It receives the view's TopoJSON (see ``dashboard.topo``) once and the rates
+of every country as a compact ``[sex][year][country]`` array. Decoding the
+topology, switching the year, playing through the years, choosing the sex
+and masking countries outside a rate range all happen in the browser with
+``Plotly.restyle``, so none of these interactions reach the server.
+
+plotly.js itself is served by the app, from the bundle shipped with the
+installed plotly (see ``write_plotly_js``), so the map needs no third-party
+CDN and works on offline deployments.
+"""
+import html
+import json
+import os
+
+import numpy as np
+import plotly.express as px
+
+from dashboard.figures import CONTINENT_RANGES
+from dashboard.indicators import OBESITY
+from dashboard.store import CACHE_DIR, write_atomic
+
+# Height of the component in pixels, controls included
+HEIGHT = 620
+
+SEX_LABELS = {"TOTAL": "Both sexes", "MALE": "Male", "FEMALE": "Female"}
+
+# Directory the plotly.js bundle is written to, for the app to serve
+ASSET_DIR = os.path.join(CACHE_DIR, "client_map")
+
+
+def write_plotly_js(asset_dir=ASSET_DIR):
+    """
+    Write the plotly.js bundle of the installed plotly to ``asset_dir``,
+    unless it is already there, and return its file name.
+
+    The name carries the plotly.js version, so browsers can cache the file
+    for good. ``plotly.offline`` pulls in IPython, so it is only imported
+    here.
+    """
+    from plotly.offline import get_plotlyjs
+    from plotly.offline.offline import get_plotlyjs_version
+
+    name = f"plotly-{get_plotlyjs_version()}.min.js"
+    if not os.path.exists(os.path.join(asset_dir, name)):
+        os.makedirs(asset_dir, exist_ok=True)
+
+        def write(path):
+            with open(path, "w", encoding="utf-8") as handle:
+                handle.write(get_plotlyjs())
+
+        write_atomic(asset_dir, name, write)
+    return name
+
+
+def map_data(cube, continent):
+    """
+    Rates of every country of a continent, for every year and sex.
+
+    Returns a JSON-ready dict with the years, sexes, ``GEO_KEY`` locations,
+    country names and a ``[sex][year][country]`` array of rates rounded to
+    two decimals (None where there is no estimate).
+    """
+    countries = cube.countries_in(continent)
+    rates = np.round(cube.country.mean[:, countries, :], 2).transpose(2, 0, 1)
+    return {
+        "years": cube.years.tolist(),
+        "sexes": list(cube.sexes),
+        "keys": cube.geo_keys[countries].tolist(),
+        "names": cube.names[countries].tolist(),
+        "rates": np.where(np.isnan(rates), None, rates).tolist(),
+        "max": float(np.nanmax(rates)),
+    }
+
+
+def map_payload(cube, topology, continent):
+    """
+    The JSON text embedded in the page, computed once per continent.
+    """
+    return json.dumps(
+        {"topology": topology, "data": map_data(cube, continent)},
+        separators=(",", ":"),
+    )
+
+
+def map_html(payload, continent, year, plotly_url, sex="TOTAL", indicator=OBESITY):
+    """
+    Assemble the component page for a continent, starting at ``year``.
+
+    ``plotly_url`` is where the page loads plotly.js from, e.g. the bundle
+    of ``write_plotly_js`` as served by the app.
+    """
+    colorscale = [
+        [i / (len(px.colors.sequential.Sunset) - 1), color]
+        for i, color in enumerate(px.colors.sequential.Sunset)
+    ]
+    options = {
+        "continent": continent,
+        "year": int(year),
+        "sex": sex,
+        "sexLabels": SEX_LABELS,
+        "lon": CONTINENT_RANGES[continent]["lon"],
+        "lat": CONTINENT_RANGES[continent]["lat"],
+        "colorscale": colorscale,
+        "axisTitle": indicator.axis_title,
+    }
+    return (
+        _TEMPLATE
+        .replace("__PLOTLY_URL__", html.escape(plotly_url))
+        .replace("__RATE_LABEL__", html.escape(f"{indicator.name} rate"))
+        .replace("__PAYLOAD__", script_json(payload))
+        .replace("__OPTIONS__", script_json(json.dumps(options)))
+    )
+
+
+def script_json(text):
+    """
+    JSON text made safe to paste into an inline ``<script>``: a ``</script>``
+    or ``<!--`` in a string would otherwise end or derail the script.
+    """
+    return text.replace("<", "\\u003c")
+
+
+_TEMPLATE = """
+<style>
+  body { margin: 0; font-family: "Source Sans Pro", sans-serif; color: #333; }
+  .controls { display: flex; flex-wrap: wrap; gap: 16px; align-items: center; padding: 4px 8px; font-size: 14px; }
+  .controls input[type=range] { vertical-align: middle; }
+  .controls input[type=number] { width: 4em; }
+  .controls button { border: 1px solid #ccc; border-radius: 4px; background: #fff; cursor: pointer; }
+</style>
+<div class="controls">
+  <span><button id="play">&#9654;</button>
+    Year <input id="year" type="range" step="1"> <b id="year-label"></b></span>
+  <span>Sex <select id="sex"></select></span>
+  <span>__RATE_LABEL__ between <input id="low" type="number" min="0" max="100" value="0">
+    and <input id="high" type="number" min="0" max="100" value="100"> %</span>
+</div>
+<div id="map"></div>
+<script src="__PLOTLY_URL__"></script>
+<script>
+const payload = __PAYLOAD__;
+const options = __OPTIONS__;
+const data = payload.data;
+
+// Decode the quantized, delta-encoded TopoJSON into GeoJSON features
+function decodeTopology(topology) {
+  const [sx, sy] = topology.transform.scale;
+  const [tx, ty] = topology.transform.translate;
+  const arcs = topology.arcs.map(function (arc) {
+    let x = 0, y = 0;
+    return arc.map(function (d) { x += d[0]; y += d[1]; return [x * sx + tx, y * sy + ty]; });
+  });
+  function ring(indices) {
+    const points = [];
+    indices.forEach(function (i) {
+      const arc = i >= 0 ? arcs[i] : arcs[~i].slice().reverse();
+      arc.forEach(function (p, j) { if (j > 0 || points.length === 0) points.push(p); });
+    });
+    return points;
+  }
+  const geometries = topology.objects.countries.geometries.filter(function (g) { return g.type; });
+  return {
+    type: "FeatureCollection",
+    features: geometries.map(function (g) {
+      const coordinates = g.type === "Polygon" ? g.arcs.map(ring) : g.arcs.map(function (p) { return p.map(ring); });
+      return { type: "Feature", id: g.id, properties: {}, geometry: { type: g.type, coordinates: coordinates } };
+    }),
+  };
+}
+
+const yearInput = document.getElementById("year");
+const yearLabel = document.getElementById("year-label");
+const sexInput = document.getElementById("sex");
+const lowInput = document.getElementById("low");
+const highInput = document.getElementById("high");
+const playButton = document.getElementById("play");
+
+yearInput.min = 0;
+yearInput.max = data.years.length - 1;
+yearInput.value = Math.max(0, data.years.indexOf(options.year));
+data.sexes.forEach(function (sex) {
+  const option = document.createElement("option");
+  option.value = sex;
+  option.textContent = options.sexLabels[sex] || sex;
+  sexInput.appendChild(option);
+});
+sexInput.value = data.sexes.includes(options.sex) ? options.sex : data.sexes[0];
+
+// Rates of the current year and sex, with countries outside the range masked
+function currentRates() {
+  const rates = data.rates[data.sexes.indexOf(sexInput.value)][Number(yearInput.value)];
+  const low = Number(lowInput.value), high = Number(highInput.value);
+  return rates.map(function (r) { return r === null || r < low || r > high ? null : r; });
+}
+
+function update() {
+  yearLabel.textContent = data.years[Number(yearInput.value)];
+  Plotly.restyle("map", { z: [currentRates()] });
+}
+
+Plotly.newPlot("map", [{
+  type: "choropleth",
+  geojson: decodeTopology(payload.topology),
+  locations: data.keys,
+  z: currentRates(),
+  text: data.names,
+  hovertemplate: "<b>%{text}</b><br>" + options.axisTitle + "=%{z}<extra></extra>",
+  colorscale: options.colorscale,
+  zmin: 0,
+  zmax: data.max,
+  colorbar: { title: { text: "<b>" + options.axisTitle + "</b>" }, len: 0.75, thickness: 15, x: 1.02 },
+}], {
+  title: { text: options.continent, x: 0.5, xanchor: "center", font: { size: 20, color: "#333" } },
+  geo: {
+    projection: { type: "natural earth" },
+    showcountries: true, countrycolor: "#D6D6D6",
+    showocean: true, oceancolor: "#EAF6FF",
+    lonaxis: { range: options.lon }, lataxis: { range: options.lat },
+    resolution: 50,
+  },
+  margin: { r: 10, t: 30, l: 10, b: 10 },
+  height: 560,
+}, { responsive: true, displaylogo: false });
+yearLabel.textContent = data.years[Number(yearInput.value)];
+
+[yearInput, sexInput, lowInput, highInput].forEach(function (input) { input.addEventListener("input", update); });
+
+let timer = null;
+playButton.addEventListener("click", function () {
+  if (timer) { clearInterval(timer); timer = null; playButton.innerHTML = "&#9654;"; return; }
+  playButton.innerHTML = "&#10074;&#10074;";
+  timer = setInterval(function () {
+    yearInput.value = (Number(yearInput.value) + 1) % data.years.length;
+    update();
+  }, 400);
+});
+</script>
+"""
@@ -0,0 +1,82 @@
+"""
+Code-based join between the WHO export and the Natural Earth countries.
+
+The WHO rows carry a numeric UN M49 area code (``DIM_GEO_CODE_M49``) and the
+shapefile carries the matching UN/ISO 3166 numeric codes. Both fit in three
+digits, so the join is a dense integer lookup table: ``lookup[code]`` holds
+the position of the country polygon, or -1 when there is none. Matching a
+whole column is then a single vectorized take.
+"""
+import numpy as np
+import pandas as pd
+
+# M49 and ISO 3166-1 numeric codes are at most three digits
+CODE_SPACE = 1000
+
+# WHO aggregates that have no polygon of their own
+AGGREGATE_CODE_TYPES = ("GLOBAL", "WHOREGION", "WORLDBANKINCOMEGROUP")
+
+# Shapefile columns tried in order; the first positive code wins. UN_A3 is
+# the M49 code proper, ISO_N3_EH fills in countries such as Norway whose
+# official code is withheld in the other columns.
+SHAPEFILE_CODE_COLUMNS = ["UN_A3", "ISO_N3_EH", "ISO_N3"]
+
+
+def geometry_codes(world):
+    """
+    Return the numeric area code of every shapefile row (-1 when unknown).
+    """
+    codes = np.full(len(world), -1, dtype=np.int16)
+    for column in SHAPEFILE_CODE_COLUMNS:
+        if column not in world.columns:
+            continue
+        values = pd.to_numeric(world[column], errors="coerce").to_numpy()
+        usable = (codes < 0) & (values > 0) & (values < CODE_SPACE)
+        codes[usable] = values[usable]
+    return codes
+
+
+def build_code_lookup(codes):
+    """
+    Build the dense ``code -> position`` table for an array of area codes.
+
+    When several polygons share a code (e.g. Australia and the Ashmore and
+    Cartier Islands), the first one keeps it.
+    """
+    lookup = np.full(CODE_SPACE, -1, dtype=np.int32)
+    positions = np.flatnonzero(codes >= 0)[::-1]
+    lookup[codes[positions]] = positions
+    return lookup
+
+
+def match_codes(codes, lookup):
+    """
+    Map an array of area codes to polygon positions (-1 when unmatched).
+
+    ``codes`` may be floating point with NaN for missing values, as pandas
+    reads ``DIM_GEO_CODE_M49``.
+    """
+    codes = np.asarray(codes, dtype=np.float64)
+    valid = (codes >= 0) & (codes < CODE_SPACE)
+    positions = np.full(len(codes), -1, dtype=np.int32)
+    positions[valid] = lookup[codes[valid].astype(np.int64)]
+    return positions
+
+
+def unmatched_keys(data, positions):
+    """
+    List the WHO areas that could not be matched to a polygon.
+
+    Regional and global aggregates are expected not to match and are left
+    out. The result has one row per area code with its name and row count.
+    """
+    missing = data[positions < 0]
+    if "DIM_GEO_CODE_TYPE" in missing.columns:
+        missing = missing[~missing["DIM_GEO_CODE_TYPE"].isin(AGGREGATE_CODE_TYPES)]
+    missing = missing[missing["DIM_GEO_CODE_M49"].notna()]
+    return (
+        missing.groupby(["DIM_GEO_CODE_M49", "GEO_NAME_SHORT"])
+        .size()
+        .rename("ROWS")
+        .reset_index()
+    )
@@ -0,0 +1,289 @@
+"""
+Precomputed aggregate cube of the obesity rates.
+
+The fact table is reduced once to dense NumPy arrays indexed by
+``[year, group, sex]`` holding the count, sum, min and max of
+``RATE_PER_100_N`` and, for groups of countries, the country reaching the
+min/max. Groups are rolled up at several levels: single countries,
+subregions, continent/subregion pairs, continents and the whole world. The
+dashboard panels then read their numbers with a few array lookups instead of
+grouping the fact table on every rerun.
+"""
+import copy
+
+import numpy as np
+import pandas as pd
+
+VALUE_COLUMN = "RATE_PER_100_N"
+
+# Name of the pseudo-continent that selects every country
+WORLD = "World"
+
+
+class Rollup:
+    """
+    Aggregates of one grouping level, as ``[year, group, sex]`` arrays.
+
+    ``mean`` is NaN where the group has no value, and ``argmin``/``argmax``
+    hold the country index reaching the extreme, or -1.
+    """
+
+    ARRAYS = ("count", "sum", "min", "max", "argmin", "argmax", "mean")
+
+    def __init__(self, labels, members, country_stats):
+        self.labels = list(labels)
+        self.index = {label: i for i, label in enumerate(self.labels)}
+        self.members = [np.asarray(countries, dtype=np.intp) for countries in members]
+        count = country_stats[0]
+        shape = (count.shape[0], len(self.labels), count.shape[2])
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.sum = np.zeros(shape)
+        self.min = np.full(shape, np.nan)
+        self.max = np.full(shape, np.nan)
+        self.argmin = np.full(shape, -1, dtype=np.int32)
+        self.argmax = np.full(shape, -1, dtype=np.int32)
+        self.mean = np.full(shape, np.nan)
+        self.fill(slice(None), country_stats)
+
+    def fill(self, years, country_stats):
+        """
+        (Re)compute the aggregates of the ``years`` rows (a slice or index
+        array) from the country statistics of those years.
+        """
+        count, total, low, high = country_stats
+        for group, countries in enumerate(self.members):
+            if len(countries) == 0:
+                continue
+            group_count = count[:, countries].sum(axis=1)
+            present = group_count > 0
+            lows = np.where(np.isnan(low[:, countries]), np.inf, low[:, countries])
+            highs = np.where(np.isnan(high[:, countries]), -np.inf, high[:, countries])
+            self.count[years, group] = group_count
+            self.sum[years, group] = total[:, countries].sum(axis=1)
+            self.min[years, group] = np.where(present, lows.min(axis=1), np.nan)
+            self.max[years, group] = np.where(present, highs.max(axis=1), np.nan)
+            self.argmin[years, group] = np.where(present, countries[lows.argmin(axis=1)], -1)
+            self.argmax[years, group] = np.where(present, countries[highs.argmax(axis=1)], -1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean[years] = self.sum[years] / self.count[years]
+
+    def copy(self):
+        """
+        Copy with its own aggregate arrays, sharing labels and members.
+        """
+        rollup = copy.copy(self)
+        for name in self.ARRAYS:
+            setattr(rollup, name, getattr(self, name).copy())
+        return rollup
+
+
+class AggregateCube:
+    """
+    Dense aggregates of the fact table by year, geography and sex.
+    """
+
+    def __init__(self, facts):
+        self.years = np.sort(facts["DIM_TIME"].unique()).astype(int)
+        self.sexes = list(facts["DIM_SEX"].cat.categories)
+        keys = np.unique(facts["GEO_KEY"].to_numpy())
+        self.geo_keys = keys
+
+        first = pd.DataFrame({"GEO_KEY": facts["GEO_KEY"].to_numpy(), "row": np.arange(len(facts))})
+        first = first.drop_duplicates("GEO_KEY").sort_values("GEO_KEY")["row"].to_numpy()
+        self.names = facts["NAME"].astype(str).to_numpy()[first]
+        continents = facts["CONTINENT"].astype(str).to_numpy()[first]
+        subregions = facts["SUBREGION"].astype(str).to_numpy()[first]
+        self.continent_of = continents
+        self.subregion_of = subregions
+
+        stats = self._country_stats(facts, self.years)
+
+        everyone = np.arange(len(keys))
+        self.country = Rollup(self.names, [[i] for i in everyone], stats)
+        self.world = Rollup([WORLD], [everyone], stats)
+        self.continent = Rollup(*_groups(continents), stats)
+        self.subregion = Rollup(*_groups(subregions), stats)
+        self.continent_subregion = Rollup(*_groups(list(zip(continents, subregions))), stats)
+
+        self._country_year_mean()
+
+    def _country_stats(self, facts, years):
+        """
+        Count, sum, min and max of every (year, country, sex) cell, for the
+        rows of ``facts`` falling in ``years``.
+        """
+        year = facts["DIM_TIME"].to_numpy()
+        position = np.searchsorted(years, year).clip(0, len(years) - 1)
+        country = np.searchsorted(self.geo_keys, facts["GEO_KEY"].to_numpy())
+        sex = facts["DIM_SEX"].cat.codes.to_numpy()
+        value = facts[VALUE_COLUMN].to_numpy(dtype=np.float64)
+        valid = (years[position] == year) & (sex >= 0) & ~np.isnan(value)
+        cell = (position[valid], country[valid], sex[valid])
+        value = value[valid]
+
+        shape = (len(years), len(self.geo_keys), len(self.sexes))
+        count = np.zeros(shape, dtype=np.int32)
+        total = np.zeros(shape)
+        low = np.full(shape, np.inf)
+        high = np.full(shape, -np.inf)
+        np.add.at(count, cell, 1)
+        np.add.at(total, cell, value)
+        np.minimum.at(low, cell, value)
+        np.maximum.at(high, cell, value)
+        low[count == 0] = np.nan
+        high[count == 0] = np.nan
+        return count, total, low, high
+
+    def _country_year_mean(self):
+        # Mean of every country over all sexes, as a [year, country] matrix
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.country_year_mean = self.country.sum.sum(axis=2) / self.country.count.sum(axis=2)
+
+    def refreshed(self, facts, years):
+        """
+        Return a copy of the cube with ``years`` recomputed from ``facts``.
+
+        Only the cells of those years are aggregated again; the cube itself
+        is left untouched, so sessions still reading it are not affected.
+        Returns None when ``facts`` no longer fits the cube (other years,
+        areas or sexes), in which case a new cube has to be built.
+        """
+        same_shape = (
+            np.array_equal(np.sort(facts["DIM_TIME"].unique()).astype(int), self.years)
+            and np.array_equal(np.unique(facts["GEO_KEY"].to_numpy()), self.geo_keys)
+            and list(facts["DIM_SEX"].cat.categories) == self.sexes
+        )
+        if not same_shape:
+            return None
+        cube = copy.copy(self)
+        years = np.intersect1d(np.asarray(list(years), dtype=int), self.years)
+        rows = np.searchsorted(self.years, years)
+        stats = self._country_stats(facts, years)
+        for name in ("country", "world", "continent", "subregion", "continent_subregion"):
+            rollup = getattr(self, name).copy()
+            rollup.fill(rows, stats)
+            setattr(cube, name, rollup)
+        cube._country_year_mean()
+        return cube
+
+    def nbytes(self):
+        """
+        Size of the aggregate arrays of every rollup.
+        """
+        rollups = (self.country, self.world, self.continent, self.subregion, self.continent_subregion)
+        arrays = [getattr(rollup, name) for rollup in rollups for name in Rollup.ARRAYS]
+        return sum(array.nbytes for array in arrays) + self.country_year_mean.nbytes
+
+    # ------------------------------------------------------------------
+    # Lookups
+    # ------------------------------------------------------------------
+
+    def year_index(self, year):
+        return int(np.searchsorted(self.years, year))
+
+    def scope(self, continent):
+        """
+        Return the rollup and group index covering ``continent``.
+        """
+        if continent == WORLD:
+            return self.world, 0
+        return self.continent, self.continent.index[continent]
+
+    def countries_in(self, continent):
+        """
+        Country indices belonging to ``continent`` (all for the world).
+        """
+        if continent == WORLD:
+            return np.arange(len(self.names))
+        return np.flatnonzero(self.continent_of == continent)
+
+    def names_of(self, geo_keys):
+        """
+        Names of the countries with the given ``GEO_KEY`` values, in order;
+        keys without data are skipped.
+        """
+        geo_keys = np.asarray(geo_keys, dtype=self.geo_keys.dtype)
+        positions = np.searchsorted(self.geo_keys, geo_keys).clip(0, max(len(self.geo_keys) - 1, 0))
+        known = self.geo_keys[positions] == geo_keys
+        return [str(name) for name in self.names[positions[known]]]
+
+    def summary(self, year, continent):
+        """
+        Headline statistics of a year and continent.
+
+        Returns the mean over all rows, the mean of each sex, and the
+        (country, sex, rate) of the highest and lowest rows.
+        """
+        rollup, group = self.scope(continent)
+        y = self.year_index(year)
+        count = rollup.count[y, group]
+        total = rollup.sum[y, group]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            by_sex = dict(zip(self.sexes, (total / count).tolist()))
+            mean = total.sum() / count.sum()
+        highs = np.where(np.isnan(rollup.max[y, group]), -np.inf, rollup.max[y, group])
+        lows = np.where(np.isnan(rollup.min[y, group]), np.inf, rollup.min[y, group])
+        top, bottom = int(highs.argmax()), int(lows.argmin())
+        return {
+            "mean": float(mean),
+            "by_sex": by_sex,
+            "max": self._extreme(rollup.argmax[y, group, top], top, rollup.max[y, group, top]),
+            "min": self._extreme(rollup.argmin[y, group, bottom], bottom, rollup.min[y, group, bottom]),
+        }
+
+    def _extreme(self, country, sex, value):
+        if country < 0:
+            return None
+        return {"NAME": self.names[country], "DIM_SEX": self.sexes[sex], VALUE_COLUMN: float(value)}
+
+    def subregion_means(self, year, continent):
+        """
+        Mean rate of every subregion and sex within a continent.
+
+        Matches ``groupby(["SUBREGION", "DIM_SEX"]).mean()`` on the rows of
+        that year and continent.
+        """
+        y = self.year_index(year)
+        if continent == WORLD:
+            rollup = self.subregion
+            groups = np.arange(len(rollup.labels))
+            labels = rollup.labels
+        else:
+            rollup = self.continent_subregion
+            groups = np.array([i for i, (c, _) in enumerate(rollup.labels) if c == continent], dtype=int)
+            labels = [rollup.labels[i][1] for i in groups]
+        means = rollup.mean[y][groups]
+        return _long_frame("SUBREGION", labels, self.sexes, means, rollup.count[y][groups])
+
+    def country_means(self, year, continent):
+        """
+        Per-country mean over all sexes, for the countries of a continent.
+
+        Returns the country indices and their means; countries without data
+        that year have a NaN mean.
+        """
+        countries = self.countries_in(continent)
+        return countries, self.country_year_mean[self.year_index(year), countries]
+
+
+def _groups(labels):
+    """
+    Split country indices by label, in sorted label order.
+    """
+    unique = sorted(set(labels))
+    lookup = {label: i for i, label in enumerate(unique)}
+    codes = np.array([lookup[label] for label in labels])
+    return unique, [np.flatnonzero(codes == i) for i in range(len(unique))]
+
+
+def _long_frame(label_column, labels, sexes, values, counts):
+    """
+    Flatten a ``[group, sex]`` array into observed (label, sex, value) rows.
+    """
+    labels = np.asarray(labels, dtype=object)
+    frame = pd.DataFrame({
+        label_column: np.repeat(labels, len(sexes)),
+        "DIM_SEX": np.tile(np.asarray(sexes, dtype=object), len(labels)),
+        VALUE_COLUMN: np.asarray(values).reshape(-1),
+    })
+    return frame[np.asarray(counts).reshape(-1) > 0].reset_index(drop=True)
@@ -0,0 +1,149 @@
+"""
+Read-only dataset shared by every session of a process.
+
+The fact table is kept as an Arrow table, memory-mapped from the Parquet
+cache, and exposed to pandas without copying: every column of ``facts`` is
+a read-only view of the Arrow buffers, so a session cannot modify the
+shared data by accident and N sessions cost one copy of the table. The
+geometry table is loaded on first use and shared in the same way.
+
+Sessions filter through index arrays (``rows``) rather than boolean-masked
+frames; only the handful of rows a figure actually draws are ever
+materialized (``take``). The lists behind the filter widgets (years,
+continents, trend groups) are computed once here instead of on every rerun.
+"""
+import threading
+
+import numpy as np
+
+from dashboard import store
+
+# Columns whose distinct values feed the dashboard's selectors
+GROUP_COLUMNS = ("SUBREGION", "NAME", "CONTINENT")
+
+
+def _frozen(array):
+    array = np.asarray(array)
+    array.flags.writeable = False
+    return array
+
+
+class Dataset:
+    """
+    Immutable fact table with precomputed selection indices.
+    """
+
+    def __init__(self, table, unmatched=None, geometry_loader=None):
+        self.table = table.combine_chunks()
+        self.facts = self.table.to_pandas(split_blocks=True)
+        self.unmatched = unmatched
+        self._geometry = None
+        self._geometry_loader = geometry_loader
+        self._lock = threading.Lock()
+
+        # Row indices grouped by year, as CSR-style offsets into one array
+        years = self.facts["DIM_TIME"].to_numpy()
+        self._year_order = _frozen(np.argsort(years, kind="stable").astype(np.intp))
+        distinct, counts = np.unique(years, return_counts=True)
+        self.years = tuple(int(year) for year in distinct)
+        self._year_offsets = _frozen(np.concatenate([[0], np.cumsum(counts)]))
+
+        self._groups = {
+            column: tuple(sorted(self.facts[column].dropna().unique())) for column in GROUP_COLUMNS
+        }
+        self._continent_codes = _frozen(self.facts["CONTINENT"].cat.codes.to_numpy())
+
+    @classmethod
+    def from_frame(cls, facts, unmatched=None, geometry_loader=None):
+        """
+        Build a dataset from a fact DataFrame, e.g. a synthetic one.
+        """
+        import pyarrow as pa
+
+        return cls(pa.Table.from_pandas(facts, preserve_index=False), unmatched, geometry_loader)
+
+    def replaced(self, table, unmatched=None):
+        """
+        New dataset over another fact table, sharing this one's geometry.
+        """
+        dataset = Dataset(table, unmatched, self._geometry_loader)
+        dataset._geometry = self._geometry
+        return dataset
+
+    # ------------------------------------------------------------------
+    # Selection
+    # ------------------------------------------------------------------
+
+    @property
+    def continents(self):
+        return self._groups["CONTINENT"]
+
+    def groups(self, column):
+        """
+        Sorted distinct values of a grouping column.
+        """
+        return self._groups[column]
+
+    def year_rows(self, year):
+        """
+        Row indices of one year, as a read-only view.
+        """
+        position = int(np.searchsorted(self.years, year))
+        if position == len(self.years) or self.years[position] != year:
+            return self._year_order[:0]
+        return self._year_order[self._year_offsets[position]:self._year_offsets[position + 1]]
+
+    def rows(self, year=None, continent=None, rate_range=None):
+        """
+        Sorted row indices matching the filters; None means no filter.
+        """
+        rows = np.arange(len(self.facts)) if year is None else np.sort(self.year_rows(year))
+        if continent is not None and continent != "World":
+            categories = self.facts["CONTINENT"].cat.categories
+            if continent not in categories:
+                return rows[:0]
+            rows = rows[self._continent_codes[rows] == categories.get_loc(continent)]
+        if rate_range is not None:
+            rates = self.facts["RATE_PER_100_N"].to_numpy()[rows]
+            rows = rows[(rates >= rate_range[0]) & (rates <= rate_range[1])]
+        return rows
+
+    def take(self, rows, columns=None):
+        """
+        Materialize the selected rows (and columns) as a small DataFrame.
+        """
+        facts = self.facts if columns is None else self.facts[list(columns)]
+        return facts.take(rows).reset_index(drop=True)
+
+    # ------------------------------------------------------------------
+    # Geometry
+    # ------------------------------------------------------------------
+
+    @property
+    def geometry(self):
+        """
+        The geometry table, loaded on first access and shared afterwards.
+        """
+        if self._geometry is None:
+            with self._lock:
+                if self._geometry is None:
+                    if self._geometry_loader is None:
+                        raise ValueError("This dataset has no geometry table")
+                    self._geometry = self._geometry_loader()
+        return self._geometry
+
+    def nbytes(self):
+        """
+        Size of the shared Arrow buffers and selection indices.
+        """
+        return self.table.nbytes + self._year_order.nbytes
+
+
+def load_dataset(csv_path=store.CSV_PATH, shapefile_path=store.SHAPEFILE_PATH, cache_dir=store.CACHE_DIR):
+    """
+    Load the shared dataset from the table cache, rebuilding it if stale.
+    """
+    table, unmatched = store.load_fact_table(csv_path, shapefile_path, cache_dir)
+    return Dataset(
+        table, unmatched, lambda: store.load_geometry(csv_path, shapefile_path, cache_dir)
+    )
@@ -0,0 +1,356 @@
+"""
+Static export of every dashboard figure for offline reports.
+
+``python -m dashboard.export`` writes the map, subregion and extremes charts
+of every year x continent, and the trends of every continent and every
+region, as standalone HTML (and PNG/SVG when kaleido is installed). It also
+writes an ``index.html`` that links them all. The figures come from the
+same builders as the app (``dashboard.figures``).
+
+The dataset, cube, trend engine and map geometry are loaded once in the
+parent process. The jobs are then spread over a fork-based process pool,
+whose workers inherit that state without copying or reloading it. A
+manifest records a digest of the inputs of every output. A later run skips
+outputs whose digest is unchanged, so an interrupted or repeated export
+only rebuilds what is missing or stale.
+"""
+import argparse
+import hashlib
+import html
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import plotly
+
+from dashboard import store, topo
+from dashboard.cube import AggregateCube
+from dashboard.dataset import load_dataset
+from dashboard.figures import (
+    CONTINENT_RANGES,
+    TREND_LEVELS,
+    extremes_figure,
+    map_figure,
+    subregion_figure,
+    trend_figure,
+)
+from dashboard.trends import TrendEngine
+from dashboard.uncertainty import Uncertainty
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR = "export"
+FIGURE_DIR = "figures"
+MANIFEST_FILE = "export-manifest.json"
+
+# Bump when the figures or file layout change, to invalidate old outputs
+EXPORT_VERSION = 5
+
+FORMATS = ("html", "png", "svg")
+IMAGE_FORMATS = ("png", "svg")
+
+# Slider defaults of the dashboard
+RATE_RANGE = (0, 100)
+TOP_K = 5
+
+# Trend levels exported with every group selected
+TREND_EXPORTS = ("Continents", "Regions")
+
+# Inputs shared with the workers of the pool, set before it is forked
+_state = {}
+
+# ----------------------------------------------------------------------
+# Jobs
+# ----------------------------------------------------------------------
+
+def slug(text):
+    """
+    File-name friendly form of a label, e.g. "Seven seas (open ocean)".
+    """
+    return "-".join("".join(c if c.isalnum() else " " for c in str(text).lower()).split())
+
+
+def export_jobs(years, continents):
+    """
+    Every figure of the export, as ``(name, view, parameters)`` jobs.
+    """
+    jobs = []
+    for continent in continents:
+        for year in years:
+            for view in ("map", "subregion", "extremes"):
+                name = f"{view}-{year}-{slug(continent)}"
+                jobs.append((name, view, {"year": int(year), "continent": continent}))
+    for level in TREND_EXPORTS:
+        jobs.append((f"trends-{slug(level)}", "trends", {"level": level}))
+    return jobs
+
+
+def build_figure(view, parameters):
+    """
+    Build the figure of one job from the shared state.
+    """
+    dataset, cube, engine = _state["dataset"], _state["cube"], _state["engine"]
+    if view == "map":
+        geojson = _state["geojson"][parameters["continent"]]
+        return map_figure(dataset, geojson, parameters["year"], parameters["continent"], RATE_RANGE)
+    if view == "subregion":
+        return subregion_figure(cube, parameters["year"], parameters["continent"])
+    if view == "extremes":
+        return extremes_figure(
+            cube, parameters["year"], parameters["continent"], TOP_K, uncertainty=_state["uncertainty"]
+        )
+    if view == "trends":
+        level = parameters["level"]
+        groups = list(dataset.groups(TREND_LEVELS[level][0]))
+        return trend_figure(engine, level, groups, True, uncertainty=_state["uncertainty"])
+    raise ValueError(f"Unknown view: {view!r}")
+
+
+def job_digest(data_digest, name, view, parameters, formats):
+    """
+    Digest of everything an output depends on.
+    """
+    payload = json.dumps(
+        [EXPORT_VERSION, plotly.__version__, data_digest, name, view, parameters, sorted(formats)],
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def run_job(job):
+    """
+    Write the files of one job; runs in a worker process.
+
+    Returns ``(name, files, seconds)``; ``files`` is empty when the view
+    has nothing to draw.
+    """
+    name, view, parameters = job
+    out_dir, formats = _state["out_dir"], _state["formats"]
+    start = time.perf_counter()
+    fig = build_figure(view, parameters)
+    files = []
+    if fig is not None:
+        for fmt in formats:
+            path = os.path.join(out_dir, FIGURE_DIR, f"{name}.{fmt}")
+            if fmt == "html":
+                fig.write_html(path, include_plotlyjs="directory", full_html=True)
+            else:
+                fig.write_image(path, format=fmt)
+            files.append(os.path.relpath(path, out_dir))
+    return name, files, time.perf_counter() - start
+
+# ----------------------------------------------------------------------
+# Manifest and index
+# ----------------------------------------------------------------------
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE), encoding="utf-8") as handle:
+            manifest = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    return manifest.get("outputs", {})
+
+
+def write_manifest(out_dir, outputs):
+    def write(path):
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump({"version": EXPORT_VERSION, "outputs": outputs}, handle, indent=1)
+
+    store.write_atomic(out_dir, MANIFEST_FILE, write)
+
+
+def is_current(entry, digest, out_dir):
+    """
+    Whether a manifest entry matches ``digest`` and its files still exist.
+    """
+    if not entry or entry.get("digest") != digest:
+        return False
+    return all(os.path.exists(os.path.join(out_dir, path)) for path in entry["files"])
+
+
+def write_index(out_dir, years, continents, outputs):
+    """
+    Write ``index.html`` linking every exported figure.
+    """
+    def link(name, label):
+        files = outputs.get(name, {}).get("files") or []
+        if not files:
+            return "&ndash;"
+        return " ".join(
+            f'<a href="{html.escape(path)}">{html.escape(label if path.endswith(".html") else path.rsplit(".", 1)[1])}</a>'
+            for path in files
+        )
+
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>",
+        "<title>Obesity dashboard export</title>",
+        "<style>body{font-family:sans-serif;margin:2em;color:#333}"
+        "table{border-collapse:collapse;margin-bottom:2em}"
+        "td,th{border:1px solid #ddd;padding:4px 8px;font-size:13px}</style>",
+        "</head><body><h1>Global and Regional Obesity Trends in Adults (18+ years)</h1>",
+        "<h2>Obesity Prevalence Trends</h2><ul>",
+    ]
+    for level in TREND_EXPORTS:
+        parts.append(f"<li>By {html.escape(TREND_LEVELS[level][1])}: {link(f'trends-{slug(level)}', 'chart')}</li>")
+    parts.append("</ul>")
+    for continent in continents:
+        parts.append(f"<h2>{html.escape(continent)}</h2><table><tr><th>Year</th>"
+                     "<th>Map</th><th>Subregions</th><th>Highest and lowest</th></tr>")
+        for year in years:
+            cells = "".join(
+                f"<td>{link(f'{view}-{year}-{slug(continent)}', label)}</td>"
+                for view, label in (("map", "map"), ("subregion", "chart"), ("extremes", "chart"))
+            )
+            parts.append(f"<tr><td>{year}</td>{cells}</tr>")
+        parts.append("</table>")
+    parts.append("</body></html>")
+    with open(os.path.join(out_dir, "index.html"), "w", encoding="utf-8") as handle:
+        handle.write("\n".join(parts))
+
+# ----------------------------------------------------------------------
+# Driver
+# ----------------------------------------------------------------------
+
+def write_plotlyjs(figure_dir):
+    """
+    Write the plotly.js bundle the HTML figures load, once, before the
+    workers start (they would otherwise race to write it).
+    """
+    from plotly.offline import get_plotlyjs
+
+    path = os.path.join(figure_dir, "plotly.min.js")
+    if not os.path.exists(path):
+        store.write_atomic(figure_dir, "plotly.min.js", lambda tmp: _write_text(tmp, get_plotlyjs()))
+
+
+def _write_text(path, text):
+    with open(path, "w", encoding="utf-8") as handle:
+        handle.write(text)
+
+
+def available_formats(formats):
+    """
+    Drop the image formats when kaleido, which renders them, is missing.
+    """
+    if any(fmt in IMAGE_FORMATS for fmt in formats) and importlib.util.find_spec("kaleido") is None:
+        logger.warning("PNG/SVG export needs the kaleido package; writing HTML only")
+        formats = [fmt for fmt in formats if fmt not in IMAGE_FORMATS]
+    return formats
+
+
+def load_state(out_dir, formats, continents):
+    """
+    Load the inputs of every job into the state inherited by the workers.
+    """
+    dataset = load_dataset()
+    cube = AggregateCube(dataset.facts)
+    geojson = {}
+    for continent in continents:
+        view = CONTINENT_RANGES[continent]
+        topology = topo.load_view_topology(dataset.geometry, tuple(view["lon"]), tuple(view["lat"]))
+        geojson[continent] = topo.to_geojson(topology)
+    _state.update(
+        dataset=dataset, cube=cube, engine=TrendEngine(cube), uncertainty=Uncertainty(dataset.facts, cube),
+        geojson=geojson,
+        out_dir=out_dir, formats=formats,
+    )
+    manifest = store.fresh_manifest()
+    sources = manifest["sources"] if manifest else store.fingerprint(store.source_files())
+    return hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()
+
+
+def export(out_dir=OUTPUT_DIR, formats=("html",), years=None, continents=None, workers=None, force=False):
+    """
+    Export every figure that is missing or stale and rewrite the index.
+
+    Returns a summary with the number of figures written and skipped and
+    the throughput in figures per second.
+    """
+    start = time.perf_counter()
+    formats = available_formats(list(formats))
+    continents = list(CONTINENT_RANGES) if continents is None else list(continents)
+    os.makedirs(os.path.join(out_dir, FIGURE_DIR), exist_ok=True)
+    data_digest = load_state(out_dir, formats, continents)
+    years = list(_state["dataset"].years) if years is None else list(years)
+    load_seconds = time.perf_counter() - start
+
+    outputs = {} if force else read_manifest(out_dir)
+    pending, digests = [], {}
+    for name, view, parameters in export_jobs(years, continents):
+        digests[name] = job_digest(data_digest, name, view, parameters, formats)
+        if not is_current(outputs.get(name), digests[name], out_dir):
+            pending.append((name, view, parameters))
+
+    export_start = time.perf_counter()
+    if pending and "html" in formats:
+        write_plotlyjs(os.path.join(out_dir, FIGURE_DIR))
+    if pending:
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                results = pool.imap_unordered(run_job, pending, chunksize=4)
+                _record(results, outputs, digests, out_dir)
+        else:
+            _record(map(run_job, pending), outputs, digests, out_dir)
+    export_seconds = time.perf_counter() - export_start
+
+    write_manifest(out_dir, outputs)
+    write_index(out_dir, years, continents, outputs)
+    return {
+        "figures": len(digests),
+        "written": len(pending),
+        "skipped": len(digests) - len(pending),
+        "load_seconds": load_seconds,
+        "export_seconds": export_seconds,
+        "figures_per_second": len(pending) / export_seconds if export_seconds > 0 else None,
+    }
+
+
+def _record(results, outputs, digests, out_dir, checkpoint=50):
+    """
+    Store job results in the manifest, saving it every ``checkpoint`` jobs
+    so that an interrupted export resumes where it stopped.
+    """
+    for done, (name, files, _) in enumerate(results, 1):
+        outputs[name] = {"digest": digests[name], "files": files}
+        if done % checkpoint == 0:
+            write_manifest(out_dir, outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export every dashboard figure as static files.")
+    parser.add_argument("--out", default=OUTPUT_DIR, help="output directory")
+    parser.add_argument("--formats", default="html",
+                        help="comma-separated formats among html, png, svg (png/svg need kaleido)")
+    parser.add_argument("--years", default=None, help="comma-separated years (default: all)")
+    parser.add_argument("--continents", default=None,
+                        help="comma-separated geographical areas (default: all)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="rebuild every output")
+    args = parser.parse_args()
+
+    formats = [fmt for fmt in args.formats.split(",") if fmt]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error(f"unknown format(s): {', '.join(sorted(unknown))}")
+    years = [int(year) for year in args.years.split(",")] if args.years else None
+    continents = args.continents.split(",") if args.continents else None
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    summary = export(args.out, formats, years, continents, args.workers, args.force)
+    rate = summary["figures_per_second"]
+    print(
+        f"{summary['written']} figure(s) written, {summary['skipped']} up to date "
+        f"in {summary['export_seconds']:.1f} s"
+        + (f" ({rate:.1f} figures/s)" if rate else "")
+        + f"; inputs loaded in {summary['load_seconds']:.1f} s"
+    )
+    print(f"Index: {os.path.join(args.out, 'index.html')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Process-wide cache of serialized Plotly figures.
+
+Many sessions ask for the same (view, year, continent, ...) combinations.
+Figures are cached as compact JSON text under a key built from the
+normalized filter state, so a repeated view skips both the pandas work and
+the Plotly figure construction. The cache is bounded by the total size of
+the stored JSON and evicts the least recently used entries first.
+
+The same LRU holds other shared values given a function that measures
+them, e.g. the query results of ``dashboard.service`` and the loaded
+indicators of ``dashboard.indicators``.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import plotly.graph_objects as go
+
+# Default size cap, overridable with the HDVC_FIGURE_CACHE_MB variable
+DEFAULT_MAX_MB = 64
+
+
+def figure_key(view, **filters):
+    """
+    Build a hashable cache key from a view name and its filter state.
+
+    Filters are sorted by name; lists, tuples and sets become sorted tuples
+    and NumPy scalars become plain Python values, so equivalent states map
+    to the same key.
+    """
+    return (view,) + tuple((name, _normalize(value)) for name, value in sorted(filters.items()))
+
+
+def _normalize(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_normalize(item) for item in value))
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+class CachedFigure(go.Figure):
+    """
+    A figure that hands Streamlit an already-built figure dictionary.
+
+    ``st.plotly_chart`` only calls ``to_dict()`` on figures, so wrapping the
+    cached JSON this way avoids re-validating every trace property.
+    """
+
+    def __init__(self, spec):
+        super().__init__()
+        self._spec = json.loads(spec)
+
+    def to_dict(self):
+        return self._spec
+
+
+class FigureCache:
+    """
+    Size-bounded LRU cache of figure JSON, safe to share between sessions.
+
+    ``sizeof`` measures a value in bytes (``len`` of the JSON by default).
+    With ``keep_last``, a value larger than the whole cache is still stored,
+    alone, rather than dropped. ``on_evict(key, value)`` is called for every
+    entry evicted to make room.
+    """
+
+    def __init__(self, max_bytes=None, sizeof=len, keep_last=False, on_evict=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("HDVC_FIGURE_CACHE_MB", DEFAULT_MAX_MB)) * 2**20)
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.keep_last = keep_last
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached JSON for ``key``, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        """
+        Like ``get``, without counting a hit or a miss or refreshing the entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[0]
+
+    def put(self, key, spec):
+        """
+        Store figure JSON, evicting old entries to stay under the size cap.
+
+        Entries larger than the whole cache are not stored, unless
+        ``keep_last`` is set.
+        """
+        size = self.sizeof(spec)
+        if size > self.max_bytes and not self.keep_last:
+            return
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (spec, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                old_key, (old, old_size) = self._entries.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+                evicted.append((old_key, old))
+        if self.on_evict is not None:
+            for old_key, old in evicted:
+                self.on_evict(old_key, old)
+
+    def get_or_build(self, key, build):
+        """
+        Return the figure JSON for ``key``, calling ``build()`` on a miss.
+
+        ``build`` returns a Plotly figure, or None when there is nothing to
+        draw; None results are returned but not cached.
+        """
+        spec = self.get(key)
+        if spec is None:
+            figure = build()
+            if figure is None:
+                return None
+            spec = figure.to_json(validate=False)
+            self.put(key, spec)
+        return spec
+
+    def figure(self, key, build):
+        """
+        Like ``get_or_build``, but wrap the JSON for ``st.plotly_chart``.
+        """
+        spec = self.get_or_build(key, build)
+        return None if spec is None else CachedFigure(spec)
+
+    def discard(self, predicate):
+        """
+        Drop the entries whose key satisfies ``predicate``; returns how many.
+        """
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                self.size -= self._entries.pop(key)[1]
+            return len(stale)
+
+    def keys(self):
+        """
+        The cached keys, from the least to the most recently used.
+        """
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Counters and occupancy, e.g. for a debug panel.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
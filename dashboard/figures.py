@@ -0,0 +1,383 @@
+"""
+Plotly figures of the dashboard.
+
+Each builder takes the loaded tables and the filter state and returns a
+complete figure, so the same charts can be produced by the Streamlit app, the
+figure cache and headless tools. Titles and axes are labelled after the
+``indicators.Indicator`` drawn, obesity by default. Given the
+``uncertainty.Uncertainty`` of the data, the extremes and trends charts also
+show the credible intervals of the rates.
+"""
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from dashboard import topo
+from dashboard.indicators import OBESITY
+from dashboard.ranking import category_labels, extreme_gender_rates
+from dashboard.trends import TRANSFORMS
+from dashboard.uncertainty import FALL, NONE, RISE
+
+# Map view of each geographical area
+CONTINENT_RANGES = {
+    "World": {"lon": [-180, 180], "lat": [-90, 90]},  # Entire world
+    "Europe": {"lon": [-30, 50], "lat": [30, 75]},
+    "Asia": {"lon": [30, 150], "lat": [10, 70]},
+    "Africa": {"lon": [-20, 55], "lat": [-35, 37]},
+    "North America": {"lon": [-170, -50], "lat": [5, 80]},
+    "South America": {"lon": [-85, -30], "lat": [-60, 15]},
+    "Oceania": {"lon": [110, 180], "lat": [-50, 0]},
+    "Seven seas (open ocean)": {"lon": [-180, 180], "lat": [-90, 90]}
+}
+
+# Grouping levels of the trends view: (column, title)
+TREND_LEVELS = {
+    "Regions": ("SUBREGION", "Region/Subregion"),
+    "Countries": ("NAME", "Country"),
+    "Continents": ("CONTINENT", "Continent"),
+}
+
+# ----------------------------------------------------------------------
+# Global Obesity Visualization
+# ----------------------------------------------------------------------
+
+# Columns of the rows drawn on the map
+MAP_COLUMNS = ["GEO_KEY", "NAME", "DIM_TIME", "RATE_PER_100_N"]
+
+
+def map_rows(dataset, year, continent, rate_range):
+    """
+    Rows drawn on the map: one year, one continent, rates within range.
+
+    Only the selected rows and the columns the map needs are copied out of
+    the shared dataset.
+    """
+    return dataset.take(dataset.rows(year, continent, rate_range), MAP_COLUMNS)
+
+
+def map_figure(dataset, geojson, year, continent, rate_range, indicator=OBESITY):
+    """
+    Choropleth of the rate of one year in a continent.
+
+    ``geojson`` is the FeatureCollection of the continent's map view, with
+    features keyed by ``GEO_KEY``.
+    """
+    lon_range = CONTINENT_RANGES[continent]["lon"]
+    lat_range = CONTINENT_RANGES[continent]["lat"]
+    filtered_data_range = map_rows(dataset, year, continent, rate_range)
+
+    fig = px.choropleth(
+        filtered_data_range,
+        geojson=topo.select_features(geojson, filtered_data_range["GEO_KEY"]),
+        locations="GEO_KEY",
+        color="RATE_PER_100_N",
+        hover_name="NAME",
+        hover_data={"RATE_PER_100_N": True, "DIM_TIME": False},
+        title=f"{continent}",
+        color_continuous_scale=px.colors.sequential.Sunset,
+        labels={"RATE_PER_100_N": indicator.axis_title},
+    )
+
+    # Map
+    fig.update_geos(
+        projection_type="natural earth",
+        showcountries=True,
+        countrycolor="#D6D6D6",  # Country boundaries
+        showocean=True,
+        oceancolor="#EAF6FF",
+        visible=True,
+        lonaxis_range=lon_range,
+        lataxis_range=lat_range,
+        resolution=50,
+    )
+
+    # Design and legend
+    fig.update_layout(
+        autosize=True,
+        title={
+            "text": f"{continent}",
+            "x": 0.5,
+            "xanchor": "center",
+            "font": {"size": 20, "color": "#333"},
+        },
+        coloraxis_colorbar={
+            "title": f"<b>{indicator.axis_title}</b>",
+            "len": 0.75,
+            "yanchor": "middle",
+            "y": 0.5,
+            "thickness": 15,
+            "x": 1.02,
+            "tickfont": {"size": 12, "color": "#333"},
+            "titlefont": {"size": 14, "color": "#333"},
+        },
+        margin={"r": 10, "t": 30, "l": 10, "b": 10},
+    )
+    return fig
+
+
+def subregion_figure(cube, year, continent, indicator=OBESITY):
+    """
+    Stacked male/female bars of every subregion in a continent.
+
+    Returns None when the continent has no subregion data that year.
+    """
+    subregion_data = cube.subregion_means(year, continent)
+    if subregion_data.empty:
+        return None
+
+    # Sort subregions by average rate (average of both genders)
+    subregion_order = (
+        subregion_data.groupby("SUBREGION")["RATE_PER_100_N"].mean()
+        .sort_values(ascending=False)
+        .index
+    )
+    subregion_data["SUBREGION"] = pd.Categorical(
+        subregion_data["SUBREGION"], categories=subregion_order, ordered=True
+    )
+    subregion_data_gender = subregion_data[subregion_data["DIM_SEX"].isin(["MALE", "FEMALE"])]
+
+    # Ensure Plotly respects the categorical order
+    fig1 = px.bar(
+        subregion_data_gender,
+        x="SUBREGION",
+        y="RATE_PER_100_N",
+        color="DIM_SEX",
+        barmode="stack",
+        labels={"RATE_PER_100_N": indicator.axis_title, "SUBREGION": "Subregion"},
+        color_discrete_sequence=["#FF9999", "#9999FF"],  # Different colors for genders
+        title=f"Subregion-Level Gender Analysis of {indicator.name} in {continent}",
+        category_orders={"SUBREGION": list(subregion_order)},  # Respect categorical order
+    )
+
+    fig1.update_layout(
+        xaxis_title="Subregion",
+        yaxis_title=indicator.axis_title,
+        legend_title="Gender",
+        margin={"t": 50, "l": 50, "r": 50, "b": 50},
+        width=800,
+        height=500,
+    )
+    return fig1
+
+
+def extremes_figure(cube, year, continent, k, indicator=OBESITY, uncertainty=None):
+    """
+    Horizontal male/female bars of the k highest and k lowest countries.
+
+    With ``uncertainty``, the bars of both sexes are drawn side by side with
+    the credible interval of each rate as an error bar.
+    """
+    top_label, bottom_label = category_labels(k)
+
+    # Rank countries by their average rate over all sexes and keep the male
+    # and female rates of the top and bottom ones, labelled by group
+    extreme_gender_data = extreme_gender_rates(cube, year, continent, k, uncertainty=uncertainty)
+
+    # Credible intervals as error bars, when the export has bounds
+    intervals = {}
+    hover_intervals = {}
+    if "RATE_PER_100_NL" in extreme_gender_data and extreme_gender_data["RATE_PER_100_NL"].notna().any():
+        rates = extreme_gender_data["RATE_PER_100_N"]
+        extreme_gender_data["Upper error"] = extreme_gender_data["RATE_PER_100_NU"] - rates
+        extreme_gender_data["Lower error"] = rates - extreme_gender_data["RATE_PER_100_NL"]
+        intervals = {"error_x": "Upper error", "error_x_minus": "Lower error"}
+        hover_intervals = {
+            "RATE_PER_100_NL": ":.2f", "RATE_PER_100_NU": ":.2f", "Upper error": False, "Lower error": False,
+        }
+
+    # Create the chart with improved aesthetics and additional hover data
+    fig2 = px.bar(
+        extreme_gender_data,
+        x="RATE_PER_100_N",
+        y="NAME",
+        color="DIM_SEX",  # Color by gender
+        pattern_shape="Category",  # Differentiate by Top k/Bottom k
+        orientation="h",
+        labels={
+            "RATE_PER_100_N": indicator.axis_title,
+            "NAME": "Country",
+            "DIM_SEX": "Gender",
+            "Category": "Group",
+            "Average Rate": f"Average {indicator.name} Rate",
+            "RATE_PER_100_NL": "Lower bound (95%)",
+            "RATE_PER_100_NU": "Upper bound (95%)",
+        },
+        hover_data={
+            "Average Rate": ":.2f",  # Show the average rate with two decimal places
+            "RATE_PER_100_N": ":.2f",  # Show the individual rate for each gender
+            "DIM_SEX": True,  # Show gender
+            "Category": True,  # Show whether it is Top k or Bottom k
+            **hover_intervals,  # Credible interval of the rate
+        },
+        **intervals,
+        title=f"{top_label} and {bottom_label} Countries by {indicator.name} Prevalence from {continent}",
+        color_discrete_map={
+            "MALE": "#FF9999",  # Pink for Male
+            "FEMALE": "#9999FF",  # Blue for Female
+        },
+        pattern_shape_map={
+            top_label: "/",  # Slashes for Top k
+            bottom_label: "",  # No pattern for Bottom k
+        },
+    )
+
+    # Layout for fig2
+    fig2.update_layout(
+        xaxis_title=indicator.axis_title,
+        yaxis_title="Country",
+        legend_title="Gender",
+        margin={"t": 50, "l": 50, "r": 50, "b": 50},  # Same margins
+        width=800,  # Same width
+        height=500,  # Same height
+        legend=dict(
+            orientation="v",
+            yanchor="middle",
+            y=0.5,
+            xanchor="left",
+            x=1.02,  # Align legend to the right
+        ),
+    )
+    if intervals:
+        # Stacked segments would put the error bars at the wrong place
+        fig2.update_layout(barmode="group")
+    return fig2
+
+# ----------------------------------------------------------------------
+# Obesity Trends Over Time
+# ----------------------------------------------------------------------
+
+# Legend suffix of a group whose first and last years have disjoint
+# credible intervals
+SIGNIFICANCE_MARKS = {RISE: " \u25b2", FALL: " \u25bc", NONE: ""}
+
+
+def _translucent(color, alpha=0.2):
+    red, green, blue = px.colors.unlabel_rgb(px.colors.convert_colors_to_same_type([color], colortype="rgb")[0][0])
+    return f"rgba({red:.0f}, {green:.0f}, {blue:.0f}, {alpha})"
+
+
+def _band_trace(years, lower, upper, color, name):
+    """
+    Shaded area between the lower and upper bounds of a series.
+    """
+    years, lower, upper = np.asarray(years), np.asarray(lower), np.asarray(upper)
+    return go.Scatter(
+        x=np.concatenate([years, years[::-1]]),
+        y=np.concatenate([upper, lower[::-1]]),
+        fill="toself",
+        fillcolor=_translucent(color),
+        line={"width": 0},
+        hoverinfo="skip",
+        showlegend=False,
+        legendgroup=name,
+        name=f"{name} (95% interval)",
+    )
+
+
+def add_bands(fig, uncertainty, column, selected_groups, include_global_trend):
+    """
+    Shade the 95% interval of every line of a trend chart (see
+    ``uncertainty.Uncertainty._bands``) and mark the groups whose change
+    over the whole period is significant.
+
+    Bands are drawn below the lines and toggle with them in the legend.
+    """
+    bands = uncertainty.band(column, selected_groups)
+    marks = uncertainty.trend_significance(column, selected_groups)
+    lower, upper = bands.columns[2], bands.columns[3]
+    by_group = {label: rows for label, rows in bands.groupby(column, sort=False)}
+    lines = list(fig.data)
+    traces = []
+    for line in lines:
+        rows = by_group.get(line.name)
+        if rows is None:
+            continue
+        traces.append(_band_trace(rows["DIM_TIME"], rows[lower], rows[upper], line.line.color, line.name))
+        line.legendgroup = line.name
+        line.name = line.name + SIGNIFICANCE_MARKS[marks.get(line.name, NONE)]
+    if include_global_trend:
+        years, global_lower, global_upper = uncertainty.global_band()
+        present = ~np.isnan(global_lower)
+        traces.append(_band_trace(
+            years[present], global_lower[present], global_upper[present], "#000000", "Global Trend Average"
+        ))
+    fig.add_traces(traces)
+    fig.data = fig.data[len(lines):] + fig.data[:len(lines)]
+
+
+def trend_figure(engine, view_option, selected_groups, include_global_trend, transform="mean", indicator=OBESITY,
+                 uncertainty=None):
+    """
+    Line chart of the yearly rate of the selected groups.
+
+    ``view_option`` is one of the ``TREND_LEVELS`` keys and ``transform``
+    one of the ``trends.TRANSFORMS`` keys: the plain yearly mean, a smoothed
+    or rolling mean, or the year-over-year change. With ``uncertainty``,
+    the plain means get 95% interval bands (see ``add_bands``).
+    """
+    group_by_column, group_title = TREND_LEVELS[view_option]
+    transform_label, rate_title = TRANSFORMS[transform]
+    rate_title = rate_title or indicator.axis_title
+
+    # Rows of the selected groups in the precomputed (group x year) matrix
+    trend_data = engine.series(group_by_column, selected_groups, transform)
+    # Determine if only one category is selected
+    if len(selected_groups) == 1:
+        line_color = ["#FF5733"]  # Streamlit's orange for a single line
+        markers = False  # Disable markers for single-line aesthetics
+    else:
+        line_color = px.colors.qualitative.Set2
+        markers = False
+
+    # Create the plot using Plotly
+    fig = px.line(
+        trend_data,
+        x="DIM_TIME",
+        y="RATE_PER_100_N",
+        color=group_by_column,
+        labels={
+            "DIM_TIME": "Year",
+            "RATE_PER_100_N": rate_title,
+            group_by_column: group_title,
+        },
+        title=f"{indicator.name} Prevalence Trends by {group_title}"
+        + ("" if transform == "mean" else f" ({transform_label})"),
+        markers=markers,
+        color_discrete_sequence=line_color,
+    )
+
+    # Credible intervals only make sense around the plain means
+    if uncertainty is not None and transform == "mean":
+        add_bands(fig, uncertainty, group_by_column, selected_groups, include_global_trend)
+
+    # Add the global trend if selected
+    if include_global_trend:
+        # Global trend, transformed like the selected groups
+        years, global_average = engine.global_series(transform)
+        fig.add_scatter(
+            x=years,
+            y=global_average,
+            mode="lines",
+            name="Global Trend Average",
+            legendgroup="Global Trend Average",
+            line=dict(color="black"),
+        )
+
+    # Customize the layout
+    fig.update_layout(
+        xaxis_title="Year",
+        yaxis_title=rate_title,
+        legend_title=group_title,
+        margin={"t": 50, "l": 50, "r": 50, "b": 50},
+        width=900,
+        height=600,
+        legend=dict(
+            orientation="v",  # Vertical alignment
+            yanchor="top",
+            y=1.0,
+            xanchor="left",
+            x=1.02,
+        ),
+    )
+    return fig
@@ -0,0 +1,327 @@
+"""
+Catalog and columnar store of WHO GHO indicators.
+
+The bundled export holds a single indicator (``NCD_BMI_30A``, obesity in
+adults), served by ``dashboard.ingest``. Further WHO data-portal exports
+(overweight, diabetes, physical inactivity, ...) can be dropped as CSV files
+into ``indicators/`` (or the directory named by ``HDVC_INDICATOR_DIR``); a
+file may hold one indicator or several.
+
+Every export is normalized once into a long-format fact table, one row per
+(indicator, country, year, sex), and written to Parquet partitioned by
+indicator: ``.hdvc_cache/indicators/<IND_CODE>.parquet``. ``IND_CODE``,
+the country attributes and ``DIM_SEX`` are dictionary encoded and the rates
+are float32, as in the main fact table. A manifest records the fingerprint
+of every source file, so only changed exports are parsed again.
+
+An indicator is loaded on first selection, as a ``Snapshot`` (dataset,
+aggregate cube and trend engine), and kept in a memory-bounded LRU cache
+shared by all sessions. The size cap is set with ``HDVC_INDICATOR_CACHE_MB``.
+
+Run ``python -m dashboard.indicators`` to build the partitions ahead of time
+and list the catalog.
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from dashboard import store
+from dashboard.codes import build_code_lookup, match_codes
+from dashboard.dataset import Dataset
+from dashboard.figcache import FigureCache
+from dashboard.ingest import Snapshot
+from dashboard.model import RATE_COLUMNS, build_fact_table
+
+logger = logging.getLogger(__name__)
+
+INDICATOR_DIR = "indicators"
+PARTITION_DIR = "indicators"
+MANIFEST_FILE = "manifest.json"
+
+# Bump when the layout of the partitions changes
+STORE_VERSION = 1
+
+# Default size cap of the loaded indicators, overridable with the
+# HDVC_INDICATOR_CACHE_MB variable
+DEFAULT_MAX_MB = 256
+
+
+class Indicator:
+    """
+    An indicator of the catalog: its code, short name, full WHO name and
+    the axis title of its values.
+    """
+
+    def __init__(self, code, name, title=None, axis_title=None):
+        self.code = code
+        self.name = name
+        self.title = title or name
+        self.axis_title = axis_title or f"{name} (%)"
+
+    def __repr__(self):
+        return f"Indicator({self.code!r})"
+
+
+# The indicator of the bundled export
+OBESITY = Indicator("NCD_BMI_30A", "Obesity", "Obesity in adults (age 18+)", "Obesity Rate (%)")
+
+# Short names and axis titles of well-known indicators; others are named
+# after their IND_NAME
+KNOWN_INDICATORS = {
+    indicator.code: indicator
+    for indicator in (
+        OBESITY,
+        Indicator("NCD_BMI_25A", "Overweight", "Overweight in adults (age 18+)", "Overweight Rate (%)"),
+        Indicator(
+            "NCD_DIABETES_PREVALENCE_AGESTD",
+            "Diabetes",
+            "Diabetes prevalence in adults (age-standardized)",
+            "Diabetes Prevalence (%)",
+        ),
+        Indicator(
+            "NCD_PAA",
+            "Physical inactivity",
+            "Insufficient physical activity in adults (age 18+)",
+            "Physical Inactivity (%)",
+        ),
+    )
+}
+
+
+def describe(code, title=None):
+    """
+    Catalog entry of an indicator code, with ``title`` as a fallback name.
+    """
+    known = KNOWN_INDICATORS.get(code)
+    if known is not None:
+        return known
+    return Indicator(code, title or code, title)
+
+# ----------------------------------------------------------------------
+# Partitions
+# ----------------------------------------------------------------------
+
+def source_files(indicator_dir=None):
+    """
+    The WHO exports found in the indicator directory, sorted by path.
+    """
+    if indicator_dir is None:
+        indicator_dir = os.environ.get("HDVC_INDICATOR_DIR", INDICATOR_DIR)
+    return sorted(glob.glob(os.path.join(indicator_dir, "*.csv")))
+
+
+def partition_path(code, cache_dir=store.CACHE_DIR):
+    return os.path.join(cache_dir, PARTITION_DIR, f"{code}.parquet")
+
+
+def split_indicators(data, attributes):
+    """
+    Split a WHO export into one fact table per indicator.
+
+    Rows are matched to the countries of the geometry table on their area
+    code; exports without credible bounds get NaN bounds. Returns
+    ``{code: (title, facts)}``.
+    """
+    data = data.copy()
+    for column in RATE_COLUMNS:
+        if column not in data.columns:
+            data[column] = np.nan
+    if "IND_NAME" not in data.columns:
+        data["IND_NAME"] = data["IND_CODE"]
+    lookup = build_code_lookup(attributes["M49"].to_numpy())
+    partitions = {}
+    for code, rows in data.groupby("IND_CODE", sort=True):
+        rows = rows.reset_index(drop=True)
+        facts = build_fact_table(rows, attributes, match_codes(rows["DIM_GEO_CODE_M49"], lookup))
+        facts.insert(0, "IND_CODE", pd.Categorical([code] * len(facts)))
+        partitions[code] = (str(rows["IND_NAME"].iloc[0]), facts)
+    return partitions
+
+
+def read_manifest(cache_dir=store.CACHE_DIR):
+    """
+    Return the partition manifest, or an empty one.
+    """
+    path = os.path.join(cache_dir, PARTITION_DIR, MANIFEST_FILE)
+    try:
+        with open(path, encoding="utf-8") as handle:
+            manifest = json.load(handle)
+    except (OSError, ValueError):
+        manifest = None
+    if not manifest or manifest.get("version") != STORE_VERSION:
+        return {"version": STORE_VERSION, "sources": {}, "indicators": {}}
+    return manifest
+
+
+def _write_manifest(manifest, cache_dir):
+    def write(path):
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(manifest, handle, indent=2)
+
+    store.write_atomic(os.path.join(cache_dir, PARTITION_DIR), MANIFEST_FILE, write)
+
+
+def _geometry_attributes(cache_dir):
+    try:
+        return store.read_geometry_attributes(cache_dir)
+    except OSError:
+        store.load_tables(cache_dir=cache_dir)
+        return store.read_geometry_attributes(cache_dir)
+
+
+def sync_partitions(paths, cache_dir=store.CACHE_DIR):
+    """
+    Bring the partitions in line with the WHO exports in ``paths``.
+
+    Exports whose content hash matches the manifest are skipped; changed
+    ones are parsed and their indicators rewritten, and the partitions of
+    removed exports are deleted. Returns the manifest.
+    """
+    manifest = read_manifest(cache_dir)
+    recorded = manifest["sources"]
+    sources = store.fingerprint(paths, recorded)
+    changed = [path for path in paths if recorded.get(path, {}).get("sha256") != sources[path]["sha256"]]
+    removed = set(recorded) - set(sources)
+    if not changed and not removed:
+        if sources != recorded:
+            manifest = dict(manifest, sources=sources)
+            try:
+                _write_manifest(manifest, cache_dir)
+            except OSError:
+                pass
+        return manifest
+
+    indicators = {
+        code: entry for code, entry in manifest["indicators"].items()
+        if entry["source"] not in removed and entry["source"] not in changed
+    }
+    os.makedirs(os.path.join(cache_dir, PARTITION_DIR), exist_ok=True)
+    attributes = _geometry_attributes(cache_dir) if changed else None
+    for path in changed:
+        partitions = split_indicators(pd.read_csv(path), attributes)
+        for code, (title, facts) in partitions.items():
+            if code in indicators and indicators[code]["source"] != path:
+                logger.warning("Indicator %s is in both %s and %s; using %s",
+                               code, indicators[code]["source"], path, path)
+            store.write_atomic(
+                os.path.join(cache_dir, PARTITION_DIR),
+                os.path.basename(partition_path(code, cache_dir)),
+                lambda target, facts=facts: facts.to_parquet(target, index=False),
+            )
+            indicators[code] = {"source": path, "title": title, "rows": len(facts)}
+        logger.info("Indicator partitions rebuilt from %s: %s", path, ", ".join(partitions))
+
+    for code in set(manifest["indicators"]) - set(indicators):
+        try:
+            os.unlink(partition_path(code, cache_dir))
+        except OSError:
+            pass
+    manifest = {"version": STORE_VERSION, "sources": sources, "indicators": indicators}
+    _write_manifest(manifest, cache_dir)
+    return manifest
+
+
+def read_partition(code, cache_dir=store.CACHE_DIR):
+    """
+    Memory-map the fact table of one indicator as an Arrow table.
+    """
+    return pq.read_table(partition_path(code, cache_dir), memory_map=True)
+
+# ----------------------------------------------------------------------
+# Catalog and cache
+# ----------------------------------------------------------------------
+
+def snapshot_bytes(snapshot):
+    """
+    Memory held by a loaded indicator: its dataset, aggregate cube and
+    credible intervals.
+    """
+    return snapshot.dataset.nbytes() + snapshot.cube.nbytes() + snapshot.uncertainty.nbytes()
+
+
+class IndicatorStore:
+    """
+    Indicator catalog plus an LRU cache of the loaded indicators.
+
+    The bundled indicator is always available from ``live`` (a
+    ``ingest.LiveData``) and does not count against the cache; the others
+    are read from their partitions on first use. Every dataset shares the
+    geometry table of the live one.
+    """
+
+    def __init__(self, live, indicator_dir=None, cache_dir=store.CACHE_DIR, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("HDVC_INDICATOR_CACHE_MB", DEFAULT_MAX_MB)) * 2**20)
+        self.live = live
+        self.cache_dir = cache_dir
+        # The indicator just loaded stays, even when it alone is over the cap
+        self.cache = FigureCache(max_bytes, sizeof=snapshot_bytes, keep_last=True, on_evict=_log_eviction)
+        self._load_lock = threading.Lock()
+
+        try:
+            manifest = sync_partitions(source_files(indicator_dir), cache_dir)
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning("Could not load the indicator exports: %s", error)
+            manifest = read_manifest(cache_dir)
+        self.catalog = {OBESITY.code: OBESITY}
+        for code, entry in sorted(manifest["indicators"].items()):
+            self.catalog.setdefault(code, describe(code, entry["title"]))
+
+    def snapshot(self, code):
+        """
+        The snapshot of an indicator, loaded on first use.
+        """
+        if code == OBESITY.code:
+            return self.live.current
+        snapshot = self.cache.get(code)
+        if snapshot is not None:
+            return snapshot
+        # One load at a time, so concurrent sessions asking for the same
+        # indicator do not parse it twice
+        with self._load_lock:
+            snapshot = self.cache.peek(code)
+            if snapshot is None:
+                snapshot = self._load(code)
+                self.cache.put(code, snapshot)
+        return snapshot
+
+    def _load(self, code):
+        if code not in self.catalog:
+            raise KeyError(f"Unknown indicator: {code!r}")
+        dataset = Dataset(
+            read_partition(code, self.cache_dir), geometry_loader=lambda: self.live.current.dataset.geometry
+        )
+        return Snapshot.build(dataset)
+
+    def stats(self):
+        """
+        Counters and occupancy, e.g. for a debug panel.
+        """
+        return {"loaded": self.cache.keys(), **self.cache.stats()}
+
+
+def _log_eviction(code, snapshot):
+    logger.info("Indicator %s evicted from the cache", code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the indicator partitions and list the catalog.")
+    parser.add_argument("--indicator-dir", default=None, help="directory of WHO exports")
+    parser.add_argument("--cache-dir", default=store.CACHE_DIR, help="table cache directory")
+    args = parser.parse_args()
+
+    manifest = sync_partitions(source_files(args.indicator_dir), args.cache_dir)
+    print(f"{OBESITY.code}: {OBESITY.title} (bundled export)")
+    for code, entry in sorted(manifest["indicators"].items()):
+        print(f"{code}: {describe(code, entry['title']).title}, {entry['rows']} rows from {entry['source']}")
+
+
+if __name__ == "__main__":
+    main()
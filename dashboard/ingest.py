@@ -0,0 +1,339 @@
+"""
+Incremental refresh of the dashboard data.
+
+A new WHO export used to mean replacing the CSV, clearing the caches and
+rebuilding everything from the raw files. Now a ``LiveData`` object holds
+the current ``Snapshot`` (dataset, aggregate cube and trend engine) and a
+background thread watches the sources. Changes are detected by size/mtime,
+confirmed by content hash (see ``store.fingerprint``).
+
+When only the CSV changed, it is parsed again and its rows are diffed
+against the current fact table by (``DIM_GEO_CODE_M49``, ``DIM_TIME``,
+``DIM_SEX``). Then:
+
+- only the fact table and manifest of the columnar store are rewritten,
+  reusing the cached geometry table; the fact table is a single Parquet
+  file, so it is rewritten whole;
+- only the years touched by the diff are aggregated again, in the cube, the
+  trend matrices and the credible intervals;
+- the version of those years is bumped, so figure cache keys built with
+  ``Snapshot.version_of`` stop matching the stale entries, and listeners
+  can drop them.
+
+Only ``refresh`` writes the fact table and the manifest. The geometry of a
+live snapshot is read from the cached geometry table as it is, so a session
+drawing the map never rebuilds the cache behind the watcher's back.
+
+The new snapshot is built off the request path and swapped in with a
+single assignment, so sessions keep serving the old data until the new
+data is ready and never wait on a reload. A changed shapefile still
+triggers a full rebuild, in the background as well.
+
+Run ``python -m dashboard.ingest`` to apply pending source changes once and
+print the diff.
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from dashboard import store
+from dashboard.codes import build_code_lookup, match_codes, unmatched_keys
+from dashboard.cube import AggregateCube
+from dashboard.dataset import Dataset
+from dashboard.model import RATE_COLUMNS, build_fact_table
+from dashboard.trends import TrendEngine
+from dashboard.uncertainty import Uncertainty
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of the sources, overridable with
+# HDVC_REFRESH_SECONDS (0 disables the watcher)
+DEFAULT_INTERVAL = 5
+
+# Key of a WHO row
+ROW_KEY = ["DIM_GEO_CODE_M49", "DIM_TIME", "DIM_SEX"]
+
+# ----------------------------------------------------------------------
+# Snapshots
+# ----------------------------------------------------------------------
+
+class Snapshot:
+    """
+    Immutable view of the data served to sessions.
+
+    ``version`` counts the refreshes applied so far, ``year_versions``
+    holds, for every year, the version that last changed it, and
+    ``geometry_version`` the version that last changed the geometry.
+    ``uncertainty`` holds the credible intervals of the rates.
+    """
+
+    def __init__(self, dataset, cube, engine, version=0, year_versions=None, geometry_version=0,
+                 uncertainty=None):
+        self.dataset = dataset
+        self.cube = cube
+        self.engine = engine
+        self.uncertainty = uncertainty
+        self.version = version
+        self.year_versions = dict(year_versions or {})
+        self.geometry_version = geometry_version
+
+    @classmethod
+    def build(cls, dataset, version=0):
+        cube = AggregateCube(dataset.facts)
+        years = dict.fromkeys(dataset.years, version)
+        return cls(dataset, cube, TrendEngine(cube), version, years, version, Uncertainty(dataset.facts, cube))
+
+    def version_of(self, year=None):
+        """
+        Version of the data behind a view: of one year, or of all years.
+        """
+        if year is None:
+            return self.version
+        return self.year_versions.get(int(year), self.version)
+
+
+class RowDiff:
+    """
+    Rows added, removed and changed between two fact tables.
+    """
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def years(self):
+        frames = [self.added, self.removed, self.changed]
+        return sorted({int(year) for frame in frames for year in frame["DIM_TIME"]})
+
+    def summary(self):
+        return {
+            "added": len(self.added),
+            "removed": len(self.removed),
+            "changed": len(self.changed),
+            "years": self.years(),
+        }
+
+# ----------------------------------------------------------------------
+# Diffing
+# ----------------------------------------------------------------------
+
+def keyed_rates(facts, codes):
+    """
+    Rates of a fact table indexed by the WHO row key.
+
+    ``codes`` maps ``GEO_KEY`` to the area's M49 code.
+    """
+    frame = pd.DataFrame({
+        "DIM_GEO_CODE_M49": codes[facts["GEO_KEY"].to_numpy()],
+        "DIM_TIME": facts["DIM_TIME"].to_numpy().astype(int),
+        "DIM_SEX": facts["DIM_SEX"].astype(str).to_numpy(),
+    })
+    for column in RATE_COLUMNS:
+        frame[column] = facts[column].to_numpy()
+    frame = frame.set_index(ROW_KEY)
+    return frame[~frame.index.duplicated()]
+
+
+def diff_rows(old, new, codes):
+    """
+    Compare two fact tables row by row on (M49 code, year, sex).
+
+    Rows are changed when any rate differs; NaN equals NaN.
+    """
+    old, new = keyed_rates(old, codes), keyed_rates(new, codes)
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    common = old.index.intersection(new.index)
+    before = old.loc[common, RATE_COLUMNS].to_numpy()
+    after = new.loc[common, RATE_COLUMNS].to_numpy()
+    differs = ~((before == after) | (np.isnan(before) & np.isnan(after))).all(axis=1)
+    return RowDiff(
+        added.to_frame(index=False),
+        removed.to_frame(index=False),
+        common[differs].to_frame(index=False),
+    )
+
+# ----------------------------------------------------------------------
+# Refresh
+# ----------------------------------------------------------------------
+
+def changed_sources(csv_path=store.CSV_PATH, shapefile_path=store.SHAPEFILE_PATH, cache_dir=store.CACHE_DIR):
+    """
+    Compare the sources with the cache manifest.
+
+    Returns ``(manifest, sources, changed)``: the manifest (None if there
+    is no usable cache), the current fingerprints and the paths whose
+    content changed.
+    """
+    manifest = store.read_manifest(cache_dir)
+    recorded = manifest["sources"] if manifest else {}
+    sources = store.fingerprint(store.source_files(csv_path, shapefile_path), recorded)
+    changed = [
+        path for path in sorted(set(sources) | set(recorded))
+        if path not in sources or path not in recorded or sources[path]["sha256"] != recorded[path]["sha256"]
+    ]
+    if manifest and not changed and sources != recorded:
+        store._refresh_manifest(manifest, sources, cache_dir)
+    return manifest, sources, changed
+
+
+def refresh(snapshot, csv_path=store.CSV_PATH, shapefile_path=store.SHAPEFILE_PATH, cache_dir=store.CACHE_DIR):
+    """
+    Apply source changes to a snapshot.
+
+    Returns ``(snapshot, report)``; the snapshot is the given one when
+    nothing changed, and the report is None in that case. The report gives
+    the ``mode`` of the refresh and the changed ``sources``; an incremental
+    one also counts the rows ``added``, ``removed`` and ``changed`` and
+    lists the ``years`` they touch, which are the only ones aggregated again.
+    """
+    manifest, sources, changed = changed_sources(csv_path, shapefile_path, cache_dir)
+    if manifest and not changed:
+        return snapshot, None
+    version = snapshot.version + 1
+    if not manifest or changed != [csv_path]:
+        geometry, facts, unmatched = store.rebuild_cache(csv_path, shapefile_path, cache_dir)
+        dataset = Dataset.from_frame(facts, unmatched, lambda: geometry)
+        return Snapshot.build(dataset, version), {"mode": "full", "sources": changed}
+
+    # Only the CSV changed: rebuild the fact table against the cached
+    # geometry attributes, without touching the polygons
+    start = time.perf_counter()
+    attributes = store.read_geometry_attributes(cache_dir)
+    codes = attributes["M49"].to_numpy()
+    data = pd.read_csv(csv_path)
+    positions = match_codes(data["DIM_GEO_CODE_M49"], build_code_lookup(codes))
+    facts = build_fact_table(data, attributes, positions)
+    diff = diff_rows(snapshot.dataset.facts, facts, codes)
+    report = {"mode": "incremental", "sources": changed, **diff.summary()}
+
+    manifest = store.write_facts(facts, unmatched_keys(data, positions), sources, cache_dir)
+    if not len(diff):
+        report["seconds"] = time.perf_counter() - start
+        return snapshot, report
+
+    dataset = snapshot.dataset.replaced(*store.read_fact_table(manifest, cache_dir))
+    cube = snapshot.cube.refreshed(dataset.facts, diff.years())
+    if cube is None:
+        report["mode"] = "incremental (new years, areas or sexes: cube rebuilt)"
+        new = Snapshot.build(dataset, version)
+        new.geometry_version = snapshot.geometry_version
+    else:
+        year_versions = dict(snapshot.year_versions)
+        year_versions.update(dict.fromkeys(diff.years(), version))
+        new = Snapshot(
+            dataset, cube, snapshot.engine.refreshed(cube, diff.years()), version, year_versions,
+            snapshot.geometry_version, snapshot.uncertainty.refreshed(dataset.facts, cube, diff.years()),
+        )
+    report["seconds"] = time.perf_counter() - start
+    return new, report
+
+
+class LiveData:
+    """
+    The current snapshot plus a background watcher that refreshes it.
+
+    Listeners are called with ``(old, new, report)`` after every swap, e.g.
+    to drop figure cache entries of the years that changed.
+    """
+
+    def __init__(self, snapshot, csv_path=store.CSV_PATH, shapefile_path=store.SHAPEFILE_PATH,
+                 cache_dir=store.CACHE_DIR):
+        self.current = snapshot
+        self.paths = (csv_path, shapefile_path, cache_dir)
+        self.listeners = []
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def load(cls, csv_path=store.CSV_PATH, shapefile_path=store.SHAPEFILE_PATH, cache_dir=store.CACHE_DIR):
+        """
+        Start from the cached tables, even if the sources changed since,
+        and apply the changes incrementally.
+
+        The geometry is read from the cached geometry table without
+        checking the sources, leaving the fact table and manifest to
+        ``refresh``.
+        """
+        manifest = store.read_manifest(cache_dir)
+        tables = None
+        if manifest is not None:
+            try:
+                tables = store.read_fact_table(manifest, cache_dir)
+            except (OSError, ValueError):
+                pass
+        if tables is None:
+            tables = store.load_fact_table(csv_path, shapefile_path, cache_dir)
+        dataset = Dataset(*tables, lambda: store.cached_geometry(shapefile_path, cache_dir))
+        live = cls(Snapshot.build(dataset), csv_path, shapefile_path, cache_dir)
+        live.refresh()
+        return live
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def refresh(self):
+        """
+        Check the sources once and swap in a new snapshot if they changed.
+        """
+        with self._lock:
+            old = self.current
+            new, report = refresh(old, *self.paths)
+            if report is None:
+                return None
+            self.current = new
+            self.last_report = report
+        logger.info("Data refreshed: %s", report)
+        if new is not old:
+            for listener in self.listeners:
+                listener(old, new, report)
+        return report
+
+    def start(self, interval=None):
+        """
+        Start the watcher thread; does nothing if the interval is 0.
+        """
+        if interval is None:
+            interval = float(os.environ.get("HDVC_REFRESH_SECONDS", DEFAULT_INTERVAL))
+        if interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch, args=(interval,), name="hdvc-ingest", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                # A half-written export is retried on the next check
+                logger.exception("Data refresh failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply changes of the WHO export to the table cache.")
+    parser.add_argument("--csv", default=store.CSV_PATH, help="WHO obesity export")
+    parser.add_argument("--shapefile", default=store.SHAPEFILE_PATH, help="Natural Earth countries")
+    parser.add_argument("--cache-dir", default=store.CACHE_DIR, help="table cache directory")
+    args = parser.parse_args()
+
+    live = LiveData.load(args.csv, args.shapefile, args.cache_dir)
+    report = live.last_report
+    print("Sources unchanged" if report is None else f"Applied: {report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Opt-in per-stage instrumentation of a dashboard rerun.
+
+Stages are wrapped in ``recorder.stage(name)``, which measures their wall
+time and the change in process memory and lets the stage add the rows it
+processed, the bytes it serialized and whether it was served from a cache.
+Every finished stage is logged as one JSON object on the
+``dashboard.instrument`` logger, and the records of the current rerun feed
+the debug panel of the app. A panel that Streamlit reruns on its own
+(``st.fragment``) records through ``recorder.fragment``, which starts a new
+set of records for that panel once the whole-script rerun is over.
+
+Instrumentation is enabled with ``?debug=1`` in the URL or ``HDVC_DEBUG=1``
+in the environment. When it is off, ``stage`` only hands out a throwaway
+record, so the wrapped code runs at full speed.
+"""
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ENV_VARIABLE = "HDVC_DEBUG"
+QUERY_PARAMETER = "debug"
+TRUE_VALUES = ("1", "true", "yes", "on")
+
+
+def debug_enabled(query_params=None, environ=None):
+    """
+    Whether instrumentation was requested by query parameter or environment.
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get(ENV_VARIABLE, "").lower() in TRUE_VALUES:
+        return True
+    value = (query_params or {}).get(QUERY_PARAMETER, "")
+    return str(value).lower() in TRUE_VALUES
+
+
+def configure_logging(stream=None):
+    """
+    Send the JSON stage logs to stderr unless a handler is already set up.
+    """
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def rss_bytes(pid=None):
+    """
+    Resident set size of this process (or of ``pid``), or None where it
+    cannot be read.
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/statm", encoding="ascii") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def figure_rows(spec):
+    """
+    Number of data points in a figure dictionary, over all its traces.
+    """
+    rows = 0
+    for trace in spec.get("data", []):
+        for field in ("locations", "x", "y"):
+            values = trace.get(field)
+            if values is not None:
+                rows += len(values)
+                break
+    return rows
+
+
+class Recorder:
+    """
+    Collects the stage records of one rerun.
+    """
+
+    def __init__(self, enabled, context=None):
+        self.enabled = enabled
+        self.context = dict(context or {})
+        self.fields = {}
+        self.records = []
+        self.finished = False
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the enclosed block as stage ``name``.
+
+        Yields the stage record; the block may set ``rows``, ``bytes`` and
+        ``cache`` ("hit" or "miss") on it.
+        """
+        record = {"stage": name, **self.fields, **fields}
+        if not self.enabled:
+            yield record
+            return
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["ms"] = round((time.perf_counter() - start) * 1000, 3)
+            rss_after = rss_bytes()
+            if rss_before is not None and rss_after is not None:
+                record["rss_mb"] = round(rss_after / 2**20, 1)
+                record["rss_delta_mb"] = round((rss_after - rss_before) / 2**20, 3)
+            self.records.append(record)
+            logger.info(json.dumps({"event": "stage", **self.context, **record}, default=str))
+
+    @contextmanager
+    def scope(self, **fields):
+        """
+        Add ``fields`` (e.g. the panel) to every stage recorded in the block.
+        """
+        previous = self.fields
+        self.fields = {**previous, **fields}
+        try:
+            yield
+        finally:
+            self.fields = previous
+
+    @contextmanager
+    def fragment(self, **fields):
+        """
+        Record a panel that may rerun without the rest of the script.
+
+        During a whole-script rerun this is ``scope``. A fragment rerun
+        only happens after that rerun is over (``summary`` was called); it
+        then replaces the records with its own and yields True, so the panel
+        can log their summary (tagged with ``fields``) and show them.
+        """
+        alone = self.finished
+        if alone:
+            self.records = []
+        with self.scope(**fields):
+            yield alone
+
+    def total_ms(self):
+        return sum(record["ms"] for record in self.records)
+
+    def summary(self):
+        """
+        Log the totals of the rerun and return them; this ends the rerun.
+        """
+        self.finished = True
+        summary = {
+            "event": "rerun",
+            **self.context,
+            **self.fields,
+            "stages": len(self.records),
+            "ms": round(self.total_ms(), 3),
+            "bytes": sum(record.get("bytes", 0) for record in self.records),
+            "cache_hits": sum(record.get("cache") == "hit" for record in self.records),
+            "cache_misses": sum(record.get("cache") == "miss" for record in self.records),
+        }
+        if self.enabled:
+            logger.info(json.dumps(summary, default=str))
+        return summary
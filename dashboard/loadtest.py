@@ -0,0 +1,393 @@
+"""
+Load test of the Streamlit app with concurrent sessions.
+
+The harness starts ``streamlit run hdvc.py`` as a headless server and opens
+N sessions to it over the same websocket a browser uses, speaking
+Streamlit's protobuf messages directly. Each session records the widgets
+the app sends, by key, and interacts with them like a user would: it sends
+the new widget states and times the rerun until the server reports that the
+script (or the fragment owning the widget) finished.
+
+Sessions start together and each plays a seeded random visit (see
+``visit``): year and continent changes, a drag of the rate slider, the
+number of countries, then the trends view with a few countries and a
+transform. For every session count the harness reports:
+
+- the p50/p95/p99 latency of every kind of interaction;
+- the RSS growth of the server per session;
+- the hit rate of the figure cache, from the stage records the server logs
+  with ``HDVC_DEBUG=1`` (see ``dashboard.instrument``).
+
+A fresh server is started for every session count. It is warmed up with
+one untimed visit first, so the data is loaded and the RSS growth is what
+the sessions add; ``--cold`` skips the warm-up.
+
+Run ``python -m dashboard.loadtest --sessions 1,4,16`` for a scaling curve;
+the results are also written to ``loadtest_results.json``. The latencies
+cover the server and the websocket, not the rendering in a browser.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+from dashboard.instrument import rss_bytes
+
+OUTPUT_PATH = "loadtest_results.json"
+
+# Positions of the rate slider during one drag
+DRAG_STEPS = 3
+
+# Countries picked in the trends view
+TREND_GROUPS = 3
+
+# Widget element types and the WidgetState field of their value
+WIDGET_VALUES = {
+    "selectbox": "int_value",
+    "radio": "int_value",
+    "checkbox": "bool_value",
+    "multiselect": "int_array_value",
+    "slider": "double_array_value",
+}
+
+TRENDS_VIEW = "Obesity Trends Over Time"
+
+
+def visit(rng):
+    """
+    Interactions of one session after opening the page, in order, as
+    ``(interaction, widget key, choose)``. ``choose(widget)`` returns the
+    new value from the widget's element: an option index (or indices) for
+    selections, the values for a slider.
+    """
+    def any_option(widget):
+        return rng.randrange(len(widget.options))
+
+    low = rng.randrange(0, 40, 5)
+    highs = sorted(rng.sample(range(low + 10, 101, 5), DRAG_STEPS), reverse=True)
+    steps = [("year", "year", any_option), ("continent", "continent", any_option)]
+    steps += [("rate_range", "rate_range", lambda widget, high=high: [low, high]) for high in highs]
+    steps += [
+        ("k", "k", lambda widget, k=rng.randint(1, 15): [k]),
+        ("continent", "continent", any_option),
+        ("view", "view", lambda widget: list(widget.options).index(TRENDS_VIEW)),
+        ("level", "level", lambda widget: list(widget.options).index("Countries")),
+        ("groups", "groups", lambda widget: rng.sample(range(len(widget.options)), TREND_GROUPS)),
+        ("transform", "transform", any_option),
+    ]
+    return steps
+
+# ----------------------------------------------------------------------
+# Headless sessions
+# ----------------------------------------------------------------------
+
+class Session:
+    """
+    One browser tab: a websocket session of the app and its widget state.
+    """
+
+    def __init__(self, url, timeout=300):
+        self.url = url
+        self.timeout = timeout
+        self.connection = None
+        # Widget key -> (element, kind, fragment id) of its latest element
+        self.widgets = {}
+        # Widget id -> WidgetState sent on every rerun, like the browser does
+        self.states = {}
+        self.messages = {}
+        self.errors = []
+
+    async def open(self):
+        """
+        Connect and run the script for the first time; returns the ms taken.
+        """
+        from tornado.websocket import websocket_connect
+
+        self.connection = await websocket_connect(
+            self.url.replace("http://", "ws://", 1) + "/_stcore/stream",
+            subprotocols=["streamlit"],
+            max_message_size=256 * 2**20,
+        )
+        return await self.rerun()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    async def set(self, key, choose):
+        """
+        Change the widget with ``key`` and rerun; returns the ms taken.
+        """
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        element, kind, fragment_id = self.widgets[key]
+        value = choose(element)
+        state = WidgetState(id=element.id)
+        field = WIDGET_VALUES[kind]
+        if field.endswith("_array_value"):
+            getattr(state, field).data.extend(value)
+        else:
+            setattr(state, field, value)
+        self.states[element.id] = state
+        return await self.rerun(fragment_id)
+
+    async def rerun(self, fragment_id=""):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+
+        message = BackMsg()
+        message.rerun_script.query_string = ""
+        message.rerun_script.fragment_id = fragment_id
+        message.rerun_script.widget_states.widgets.extend(self.states.values())
+        start = time.perf_counter()
+        await self.connection.write_message(message.SerializeToString(), binary=True)
+        await asyncio.wait_for(self._until_finished(), self.timeout)
+        return (time.perf_counter() - start) * 1000
+
+    async def _until_finished(self):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        while True:
+            data = await self.connection.read_message()
+            if data is None:
+                raise ConnectionError("The server closed the session")
+            message = ForwardMsg()
+            message.ParseFromString(data)
+            kind = message.WhichOneof("type")
+            if kind == "ref_hash":
+                # A message the server already sent to this session
+                message = self.messages.get(message.ref_hash)
+                kind = None if message is None else message.WhichOneof("type")
+            elif message.hash:
+                self.messages[message.hash] = message
+            if kind == "delta":
+                self._record(message.delta)
+            elif kind == "script_finished":
+                if message.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return message.script_finished
+
+    def _record(self, delta):
+        if delta.WhichOneof("type") != "new_element":
+            return
+        kind = delta.new_element.WhichOneof("type")
+        element = getattr(delta.new_element, kind)
+        if kind == "exception":
+            self.errors.append(element.message)
+        elif kind in WIDGET_VALUES:
+            key = element.id.rsplit("-", 1)[-1]
+            self.widgets[key] = (element, kind, delta.fragment_id)
+
+
+async def play(url, steps, start, timings, timeout):
+    """
+    Open a session once ``start`` is set and play ``steps``, appending
+    ``(interaction, ms)`` to ``timings``. Returns the session's errors.
+    """
+    from tornado.httpclient import HTTPClientError
+    from tornado.websocket import WebSocketClosedError
+
+    session = Session(url, timeout)
+    await start.wait()
+    try:
+        timings.append(("open", await session.open()))
+        for interaction, key, choose in steps:
+            if key not in session.widgets:
+                session.errors.append(f"{interaction}: no widget with key {key!r}")
+                break
+            timings.append((interaction, await session.set(key, choose)))
+    except (OSError, asyncio.TimeoutError, HTTPClientError, WebSocketClosedError) as error:
+        session.errors.append(f"{type(error).__name__}: {error}")
+    finally:
+        session.close()
+    return session.errors
+
+# ----------------------------------------------------------------------
+# Server
+# ----------------------------------------------------------------------
+
+class Server:
+    """
+    ``streamlit run`` of the app in a subprocess, with its stage logs.
+    """
+
+    def __init__(self, script="hdvc.py", port=None):
+        if port is None:
+            with socket.socket() as probe:
+                probe.bind(("127.0.0.1", 0))
+                port = probe.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.records = []
+        env = dict(os.environ, HDVC_DEBUG="1")
+        env.setdefault("HDVC_REFRESH_SECONDS", "0")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "streamlit", "run", script,
+             "--server.headless", "true", "--server.address", "127.0.0.1", "--server.port", str(port),
+             "--server.fileWatcherType", "none", "--browser.gatherUsageStats", "false"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        )
+        self._reader = threading.Thread(target=self._read_logs, daemon=True)
+        self._reader.start()
+
+    def _read_logs(self):
+        for line in self.process.stderr:
+            if line.startswith("{"):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get("event") == "stage":
+                    self.records.append(event)
+
+    def wait_ready(self, timeout=60):
+        from urllib.error import URLError
+        from urllib.request import urlopen
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The Streamlit server exited during startup")
+            try:
+                with urlopen(f"{self.url}/_stcore/health", timeout=1):
+                    return
+            except (URLError, OSError):
+                time.sleep(0.2)
+        raise RuntimeError(f"The Streamlit server did not start within {timeout}s")
+
+    def rss_bytes(self):
+        return rss_bytes(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+# ----------------------------------------------------------------------
+# Runs
+# ----------------------------------------------------------------------
+
+def latency_summary(timings):
+    """
+    Count and p50/p95/p99 latency of every interaction, in first-seen order.
+    """
+    by_interaction = {}
+    for interaction, ms in timings:
+        by_interaction.setdefault(interaction, []).append(ms)
+    by_interaction["all"] = [ms for _, ms in timings]
+    summary = {}
+    for interaction, values in by_interaction.items():
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        summary[interaction] = {
+            "count": len(values),
+            "p50_ms": round(float(p50), 1),
+            "p95_ms": round(float(p95), 1),
+            "p99_ms": round(float(p99), 1),
+        }
+    return summary
+
+
+def cache_summary(records):
+    """
+    Figure cache hits and misses over the stage records of a run.
+    """
+    hits = sum(record.get("cache") == "hit" for record in records)
+    misses = sum(record.get("cache") == "miss" for record in records)
+    return {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None}
+
+
+async def _sessions(url, sessions, seed, timeout):
+    start = asyncio.Event()
+    timings = []
+    tasks = [
+        asyncio.ensure_future(play(url, visit(random.Random(seed * 1000 + number)), start, timings, timeout))
+        for number in range(sessions)
+    ]
+    began = time.perf_counter()
+    start.set()
+    errors = await asyncio.gather(*tasks)
+    return timings, [error for session in errors for error in session], time.perf_counter() - began
+
+
+def run(script="hdvc.py", sessions=4, seed=0, warm=True, timeout=300):
+    """
+    Play ``sessions`` concurrent visits against a fresh server and
+    summarize them.
+    """
+    server = Server(script)
+    try:
+        server.wait_ready()
+        if warm:
+            asyncio.run(_sessions(server.url, 1, seed=-1, timeout=timeout))
+        records_before = len(server.records)
+        rss_before = server.rss_bytes()
+        timings, errors, elapsed = asyncio.run(_sessions(server.url, sessions, seed, timeout))
+        rss_after = server.rss_bytes()
+        # Stage logs of the last reruns may still be in the pipe
+        time.sleep(0.5)
+        records = server.records[records_before:]
+    finally:
+        server.stop()
+
+    growth = None if rss_before is None or rss_after is None else (rss_after - rss_before) / 2**20
+    return {
+        "sessions": sessions,
+        "warm": warm,
+        "seconds": round(elapsed, 2),
+        "errors": errors,
+        "interactions": latency_summary(timings) if timings else {},
+        "rss_mb": None if rss_after is None else round(rss_after / 2**20, 1),
+        "rss_growth_mb": None if growth is None else round(growth, 1),
+        "rss_growth_mb_per_session": None if growth is None else round(growth / sessions, 2),
+        "figure_cache": cache_summary(records),
+    }
+
+
+def print_run(result):
+    print(
+        f"{result['sessions']} session(s) in {result['seconds']:.1f}s, server RSS {result['rss_mb']} MB "
+        f"(+{result['rss_growth_mb_per_session']} MB/session), "
+        f"figure cache hit rate {result['figure_cache']['hit_rate']}"
+    )
+    print(f"  {'interaction':<12} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for interaction, row in result["interactions"].items():
+        print(
+            f"  {interaction:<12} {row['count']:>6} {row['p50_ms']:>7.0f}ms "
+            f"{row['p95_ms']:>7.0f}ms {row['p99_ms']:>7.0f}ms"
+        )
+    for error in result["errors"]:
+        print(f"  error: {error}")
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app with concurrent sessions.")
+    parser.add_argument("--sessions", type=_int_list, default=[1, 2, 4, 8],
+                        help="comma-separated session counts, e.g. 1,4,16")
+    parser.add_argument("--script", default="hdvc.py", help="Streamlit script")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cold", action="store_true", help="skip the warm-up visit")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="JSON results file")
+    args = parser.parse_args()
+
+    results = []
+    for sessions in args.sessions:
+        results.append(run(args.script, sessions, args.seed, warm=not args.cold))
+        print_run(results[-1])
+    with open(args.output, "w", encoding="utf-8") as handle:
+        json.dump(results, handle, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
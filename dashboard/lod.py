@@ -0,0 +1,212 @@
+"""
+Level-of-detail geometry for the choropleth.
+
+The 1:50m Natural Earth polygons carry far more vertices than a browser can
+show at world or continent scale. The geometry table is simplified once at
+a few tolerances (in degrees) and the results are stored next to the table
+cache. Each map view picks the coarsest level whose tolerance stays below
+roughly one screen pixel, and clips the polygons to its bounding box.
+
+Simplification works on the shared-arc topology of the polygons (see
+``dashboard.topo``) rather than on each polygon: a border between two
+countries is one arc, simplified once with its junctions fixed, so
+neighbours still fit together without gaps or overlaps at every level.
+"""
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from dashboard import topo
+from dashboard.store import CACHE_DIR, write_atomic
+
+LOD_DIR = os.path.join(CACHE_DIR, "lod")
+MANIFEST_FILE = "manifest.json"
+
+# Simplification tolerance of each level, in degrees; level 0 is the source
+LEVEL_TOLERANCES = (0.0, 0.02, 0.05, 0.1, 0.2)
+
+# Bump when the way levels are built changes, to invalidate cached levels
+LOD_VERSION = 2
+
+# Times the arcs of a country that came out invalid are simplified again at
+# half the tolerance, before falling back to the source arcs
+REFINE_STEPS = 3
+
+# Approximate map width in screen pixels, used to turn a view's span in
+# degrees into the largest tolerance that is still invisible
+MAP_PIXELS = 1200
+
+# Margin added around a view before clipping, as a fraction of its span, so
+# the curved edges of the projection are still filled
+CLIP_MARGIN = 0.1
+
+# ----------------------------------------------------------------------
+# Precomputed levels
+# ----------------------------------------------------------------------
+
+def geometry_digest(geometry):
+    """
+    Hash the polygons and keys of a geometry table.
+    """
+    digest = hashlib.sha256()
+    digest.update(geometry.index.to_numpy().tobytes())
+    for wkb in shapely.to_wkb(geometry.geometry.values):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+def simplify_levels(geometry):
+    """
+    Simplify the polygons at every tolerance in ``LEVEL_TOLERANCES``.
+
+    Returns one GeoSeries per level, indexed like ``geometry``. The
+    polygons are encoded as a shared-arc topology once, and each level
+    simplifies its arcs and decodes them back (see ``simplify_level``).
+    """
+    polygons = geometry.geometry
+    topology = topo.build_topology(polygons)
+    lines = topo.arc_lines(topology)
+    return [
+        polygons if tolerance == 0 else simplify_level(polygons, topology, lines, tolerance)
+        for tolerance in LEVEL_TOLERANCES
+    ]
+
+
+def simplify_level(polygons, topology, lines, tolerance):
+    """
+    The polygons of one level, decoded from the arcs simplified at
+    ``tolerance``.
+
+    A country that comes out invalid (a small ring collapsing, or an island
+    swallowed by a coast) gets its arcs simplified again at half the
+    tolerance, up to ``REFINE_STEPS`` times, then the source arcs. Arcs are
+    replaced for every country sharing them, so borders still coincide.
+    Countries lost to quantization keep their source polygon.
+    """
+    arcs_of = topo.feature_arcs(topology)
+    arcs = np.asarray(topo.simplify_arcs(lines, tolerance), dtype=object)
+    attempt = 0
+    while True:
+        shapes = topo.to_shapes(topo.with_arcs(topology, arcs))
+        invalid = [key for key, shape in shapes.items() if not shape.is_valid]
+        if not invalid or attempt > REFINE_STEPS:
+            break
+        attempt += 1
+        step = tolerance / 2 ** attempt if attempt <= REFINE_STEPS else 0
+        refine = sorted({arc for key in invalid for arc in arcs_of[key]})
+        arcs[refine] = np.asarray(topo.simplify_arcs(lines, step), dtype=object)[refine]
+    shapes = gpd.GeoSeries(shapes, crs=polygons.crs).reindex(polygons.index)
+    return shapes.where(shapes.notna(), polygons)
+
+
+def _level_name(level):
+    return f"level_{level}.parquet"
+
+
+def _read_levels(geometry, lod_dir, digest):
+    try:
+        with open(os.path.join(lod_dir, MANIFEST_FILE), encoding="utf-8") as handle:
+            manifest = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if (
+        manifest.get("geometry") != digest
+        or manifest.get("tolerances") != list(LEVEL_TOLERANCES)
+        or manifest.get("version") != LOD_VERSION
+    ):
+        return None
+    levels = [geometry.geometry]
+    for level in range(1, len(LEVEL_TOLERANCES)):
+        try:
+            table = gpd.read_parquet(os.path.join(lod_dir, _level_name(level)), memory_map=True)
+        except (OSError, ValueError):
+            return None
+        levels.append(table.geometry)
+    return levels
+
+
+def _write_levels(levels, lod_dir, digest):
+    os.makedirs(lod_dir, exist_ok=True)
+    for level, polygons in enumerate(levels[1:], start=1):
+        frame = polygons.to_frame("geometry")
+        write_atomic(lod_dir, _level_name(level), frame.to_parquet)
+    manifest = {"geometry": digest, "tolerances": list(LEVEL_TOLERANCES), "version": LOD_VERSION}
+
+    def write_manifest(path):
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(manifest, handle)
+
+    write_atomic(lod_dir, MANIFEST_FILE, write_manifest)
+
+
+def load_levels(geometry, lod_dir=LOD_DIR):
+    """
+    Return the simplified levels of ``geometry``, from disk when possible.
+
+    The levels are recomputed and rewritten when the polygons or the
+    tolerances have changed since they were cached.
+    """
+    digest = geometry_digest(geometry)
+    levels = _read_levels(geometry, lod_dir, digest)
+    if levels is None:
+        levels = simplify_levels(geometry)
+        try:
+            _write_levels(levels, lod_dir, digest)
+        except OSError:
+            pass
+    return levels
+
+# ----------------------------------------------------------------------
+# View selection
+# ----------------------------------------------------------------------
+
+def choose_level(lon_range, lat_range):
+    """
+    Pick the coarsest level that is still finer than a pixel of the view.
+    """
+    span = max(lon_range[1] - lon_range[0], lat_range[1] - lat_range[0])
+    pixel = span / MAP_PIXELS
+    usable = [level for level, tolerance in enumerate(LEVEL_TOLERANCES) if tolerance <= pixel]
+    return usable[-1]
+
+
+def clip_box(lon_range, lat_range):
+    """
+    Return the padded (xmin, ymin, xmax, ymax) clipping box of a view.
+
+    Views that cover the whole globe return None, as there is nothing to
+    clip.
+    """
+    if lon_range[1] - lon_range[0] >= 360 and lat_range[1] - lat_range[0] >= 180:
+        return None
+    pad_lon = (lon_range[1] - lon_range[0]) * CLIP_MARGIN
+    pad_lat = (lat_range[1] - lat_range[0]) * CLIP_MARGIN
+    return (
+        max(lon_range[0] - pad_lon, -180),
+        max(lat_range[0] - pad_lat, -90),
+        min(lon_range[1] + pad_lon, 180),
+        min(lat_range[1] + pad_lat, 90),
+    )
+
+
+def view_geometry(levels, lon_range, lat_range, index=None):
+    """
+    Return the polygons to draw for a lon/lat view.
+
+    The level is chosen from the size of the view, and polygons are clipped
+    to its box. Countries that fall entirely outside the box are dropped;
+    with a ``spatial.SpatialIndex`` only the countries it finds in the box
+    are clipped at all.
+    """
+    polygons = levels[choose_level(lon_range, lat_range)]
+    box = clip_box(lon_range, lat_range)
+    if box is None:
+        return polygons
+    if index is not None:
+        polygons = polygons.loc[polygons.index.isin(index.query_box(box))]
+    clipped = polygons.clip_by_rect(*box)
+    return clipped[~clipped.is_empty]
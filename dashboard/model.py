@@ -0,0 +1,75 @@
+"""
+Normalized data model for the dashboard.
+
+The Natural Earth polygons are stored once, in a geometry table with one row
+per country. The WHO rows live in a slim fact table that refers to that table
+through an integer ``GEO_KEY``. Geometry is only joined back in at render
+time, for the rows that are actually drawn.
+"""
+import pandas as pd
+
+from dashboard.codes import build_code_lookup, geometry_codes, match_codes, unmatched_keys
+
+# Country attributes kept next to each polygon in the geometry table
+GEOMETRY_COLUMNS = ["NAME", "CONTINENT", "SUBREGION"]
+
+# Prevalence estimate and its lower/upper credible bounds
+RATE_COLUMNS = ["RATE_PER_100_N", "RATE_PER_100_NL", "RATE_PER_100_NU"]
+
+# Columns of the WHO export the dashboard actually uses
+FACT_COLUMNS = ["DIM_TIME", "DIM_SEX"] + RATE_COLUMNS
+
+# ----------------------------------------------------------------------
+# Table construction
+# ----------------------------------------------------------------------
+
+def build_geometry_table(world):
+    """
+    Reduce the shapefile to one row per country, indexed by ``GEO_KEY``.
+
+    Only the attributes the dashboard reads are kept, which drops the ~160
+    translated-name and code columns of the Natural Earth dataset. The
+    numeric area code used for joining is kept as ``M49``.
+    """
+    from geopandas import GeoDataFrame
+
+    geometry = world[GEOMETRY_COLUMNS + ["geometry"]].reset_index(drop=True)
+    geometry.insert(0, "M49", geometry_codes(world))
+    geometry.index.name = "GEO_KEY"
+    return GeoDataFrame(geometry, geometry="geometry", crs=world.crs)
+
+
+def build_fact_table(data, geometry, positions):
+    """
+    Build the fact table for the WHO rows that have a matching country.
+
+    ``positions`` gives the geometry row of every data row (-1 when there is
+    none). Each fact carries its ``GEO_KEY`` plus the Natural Earth country
+    name, continent and subregion as categoricals, so filters and groupbys
+    never touch geometry.
+    """
+    matched = positions >= 0
+    facts = data.loc[matched, FACT_COLUMNS].reset_index(drop=True)
+    facts.insert(0, "GEO_KEY", positions[matched])
+    for column in GEOMETRY_COLUMNS:
+        values = geometry[column].to_numpy()[facts["GEO_KEY"].to_numpy()]
+        facts.insert(1, column, pd.Categorical(values))
+    facts["DIM_TIME"] = facts["DIM_TIME"].astype("int16")
+    facts["DIM_SEX"] = facts["DIM_SEX"].astype("category")
+    for column in RATE_COLUMNS:
+        facts[column] = facts[column].astype("float32")
+    return facts
+
+
+def normalize(world, data):
+    """
+    Split the merged world/obesity view into its geometry and fact tables.
+
+    Rows are joined on their numeric area code. Returns the geometry table,
+    the fact table and the WHO areas left without a polygon.
+    """
+    geometry = build_geometry_table(world)
+    lookup = build_code_lookup(geometry["M49"].to_numpy())
+    positions = match_codes(data["DIM_GEO_CODE_M49"], lookup)
+    facts = build_fact_table(data, geometry, positions)
+    return geometry, facts, unmatched_keys(data, positions)
@@ -0,0 +1,174 @@
+"""
+Panels of the "Global Obesity Visualization" page and what they depend on.
+
+The page is split into panels that Streamlit can rerun on their own
+(``st.fragment``). Each panel declares the inputs its output is derived
+from, and its cached figures are keyed on exactly those inputs through
+``panel_key``, so a panel cannot silently read state it did not declare.
+
+Widgets come in two kinds. Page widgets (indicator, year, continent, ...)
+live in the sidebar and rerun the whole script. Panel widgets live inside
+their panel and only rerun it: the rate range and map mode only redraw the
+map, and the number of countries only redraws the extremes chart.
+
+Stages recorded inside a panel carry its name (see
+``instrument.Recorder.scope``), which lets ``rerun_savings`` work out, from
+one instrumented rerun, how much of it a widget change still has to redo.
+Run ``python -m dashboard.panels`` to measure it for every widget on the app
+with Streamlit's headless test runner.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from dashboard.figcache import figure_key
+
+# Panel -> (inputs its output depends on, widgets inside the panel)
+PANELS = {
+    "stats": (("indicator", "year", "continent"), ()),
+    "map": (("indicator", "year", "continent", "rate_range"), ("map_mode", "rate_range", "map_selection")),
+    "subregions": (("indicator", "year", "continent"), ()),
+    "extremes": (("indicator", "year", "continent", "k"), ("k",)),
+    # Trends of the countries selected on the map, drawn inside the map panel
+    "selection_trends": (("indicator", "selection"), ()),
+}
+
+# Sidebar widgets of the page; changing one reruns every panel
+PAGE_WIDGETS = ("indicator", "view", "year", "continent")
+
+# Widgets inside a panel; changing one reruns that panel only
+PANEL_WIDGETS = tuple(dict.fromkeys(widget for _, widgets in PANELS.values() for widget in widgets))
+
+
+def panel_key(panel, version, **inputs):
+    """
+    Figure cache key of a panel, built from its declared inputs.
+
+    Raises ValueError when ``inputs`` differ from the declaration, so a
+    panel reading a new input cannot keep serving figures cached without it.
+    """
+    declared = set(PANELS[panel][0])
+    if set(inputs) != declared:
+        raise ValueError(
+            f"Panel {panel!r} depends on {sorted(declared)}, got {sorted(inputs)}"
+        )
+    return figure_key(panel, version=version, **inputs)
+
+
+def widget_panels(widget):
+    """
+    Panels rerun when ``widget`` changes: its own panel, or all of them.
+    """
+    owners = [panel for panel, (_, widgets) in PANELS.items() if widget in widgets]
+    return owners or list(PANELS)
+
+
+def rerun_savings(widget, records, full_ms=None):
+    """
+    Work of a rerun that a change of ``widget`` no longer repeats.
+
+    ``records`` are the stage records of a whole-script rerun after the
+    change; stages run inside a panel carry a ``panel`` field. ``full_ms``
+    is the wall time of that rerun (by default, the sum of its stages). A
+    page widget still reruns everything; a panel widget only reruns the
+    stages of its panel.
+    """
+    full = sum(record["ms"] for record in records) if full_ms is None else full_ms
+    panels = widget_panels(widget)
+    if widget in PAGE_WIDGETS:
+        rerun = full
+    else:
+        rerun = sum(record["ms"] for record in records if record.get("panel") in panels)
+    return {
+        "widget": widget,
+        "panels": ["(whole page)"] if widget in PAGE_WIDGETS else panels,
+        "full_ms": round(full, 3),
+        "rerun_ms": round(rerun, 3),
+        "avoided": round(1 - rerun / full, 3) if full else 0.0,
+    }
+
+# ----------------------------------------------------------------------
+# Measurement
+# ----------------------------------------------------------------------
+
+class _Records(logging.Handler):
+    """
+    Collects the JSON stage events of ``dashboard.instrument``.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        event = json.loads(record.getMessage())
+        if event.get("event") == "stage":
+            self.records.append(event)
+
+
+# Widget changes of a typical session, in order: (widget, widget type,
+# value). Each one misses the figure cache of the panels it affects.
+CHANGES = (
+    ("year", "selectbox", 2010),
+    ("continent", "selectbox", "Europe"),
+    ("rate_range", "slider", (20, 60)),
+    ("k", "slider", 10),
+    ("map_mode", "radio", "All years (in browser)"),
+)
+
+
+def measure(script="hdvc.py", timeout=300):
+    """
+    Change every widget of the page in turn and report the work avoided.
+
+    Streamlit's headless test runner always reruns the whole script, so
+    each change is timed as a full rerun and compared with the stages of
+    the panels it affects, i.e. what the fragment rerun executes.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    from dashboard.instrument import configure_logging, logger
+
+    os.environ["HDVC_DEBUG"] = "1"
+    configure_logging()
+    handler = _Records()
+    logger.addHandler(handler)
+    try:
+        app = AppTest.from_file(script, default_timeout=timeout)
+        app.run()
+        rows = []
+        for widget, kind, value in CHANGES:
+            getattr(app, kind)(key=widget).set_value(value)
+            handler.records = []
+            start = time.perf_counter()
+            app.run()
+            wall_ms = (time.perf_counter() - start) * 1000
+            if app.exception:
+                raise RuntimeError(f"{script} failed after changing {widget}: {app.exception[0].message}")
+            rows.append(rerun_savings(widget, handler.records, wall_ms))
+    finally:
+        logger.removeHandler(handler)
+    return rows
+
+
+def print_savings(rows):
+    print(f"  {'widget':<12} {'reruns':<14} {'full rerun':>12} {'panel rerun':>12} {'avoided':>8}")
+    for row in rows:
+        print(
+            f"  {row['widget']:<12} {', '.join(row['panels']):<14} {row['full_ms']:>10.1f}ms"
+            f" {row['rerun_ms']:>10.1f}ms {row['avoided']:>8.0%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the work each widget change avoids.")
+    parser.add_argument("--script", default="hdvc.py", help="Streamlit script")
+    args = parser.parse_args()
+
+    print_savings(measure(args.script))
+
+
+if __name__ == "__main__":
+    main()
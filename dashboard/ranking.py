@@ -0,0 +1,115 @@
+"""
+Top-k / bottom-k ranking of countries.
+
+Rankings are computed with ``np.argpartition`` over the cube's
+``[year, country]`` mean matrix, so one call ranks a continent for a single
+year or for every year at once, for any k. Only the k selected entries of
+each row are sorted.
+"""
+import numpy as np
+import pandas as pd
+
+from dashboard.cube import VALUE_COLUMN
+
+
+def top_k_indices(values, k):
+    """
+    Indices of the ``k`` largest values along the last axis, largest first.
+
+    NaN values rank last. Returns the indices and a mask that is False
+    where fewer than ``k`` values are available.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    k = min(k, values.shape[-1])
+    if k <= 0:
+        return np.empty(values.shape[:-1] + (0,), dtype=np.intp), np.empty(values.shape[:-1] + (0,), dtype=bool)
+    keys = np.where(np.isnan(values), np.inf, -values)
+    part = np.argpartition(keys, k - 1, axis=-1)[..., :k]
+    order = np.argsort(np.take_along_axis(keys, part, axis=-1), axis=-1, kind="stable")
+    indices = np.take_along_axis(part, order, axis=-1)
+    valid = ~np.isnan(np.take_along_axis(values, indices, axis=-1))
+    return indices, valid
+
+
+def bottom_k_indices(values, k):
+    """
+    Indices of the ``k`` smallest values along the last axis, smallest first.
+    """
+    return top_k_indices(-np.asarray(values, dtype=np.float64), k)
+
+
+def category_labels(k):
+    """
+    Labels of the top and bottom groups, e.g. ("Top 5", "Bottom 5").
+    """
+    return f"Top {k}", f"Bottom {k}"
+
+
+def extreme_countries(cube, continent, k, years=None):
+    """
+    Rank the countries of a continent for one or more years.
+
+    Returns one row per (year, selected country) with the country's mean
+    rate over all sexes, its rank within its group and its category. A
+    country that is both among the highest and the lowest (in continents
+    with fewer than 2k countries) is reported in the top group only.
+    """
+    years = cube.years if years is None else np.atleast_1d(years)
+    rows = np.searchsorted(cube.years, years)
+    countries = cube.countries_in(continent)
+    means = cube.country_year_mean[np.ix_(rows, countries)]
+
+    top, top_valid = top_k_indices(means, k)
+    bottom, bottom_valid = bottom_k_indices(means, k)
+    in_top = (bottom[..., None] == np.where(top_valid, top, -1)[:, None, :]).any(axis=-1)
+    bottom_valid &= ~in_top
+
+    top_label, bottom_label = category_labels(k)
+    frames = []
+    for indices, valid, label in ((top, top_valid, top_label), (bottom, bottom_valid, bottom_label)):
+        year_pos, rank = np.nonzero(valid)
+        chosen = countries[indices[year_pos, rank]]
+        frames.append(pd.DataFrame({
+            "DIM_TIME": years[year_pos],
+            "COUNTRY": chosen,
+            "NAME": cube.names[chosen],
+            VALUE_COLUMN: means[year_pos, indices[year_pos, rank]],
+            "Rank": rank + 1,
+            "Category": label,
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def extreme_gender_rates(cube, year, continent, k, sexes=("MALE", "FEMALE"), uncertainty=None):
+    """
+    Rates by sex of the ``k`` highest and lowest countries of a year.
+
+    Returns the long frame drawn by the extremes chart: one row per country
+    and sex with the ``Category`` of the country and its ``Average Rate``
+    over ``sexes``, sorted by rate. Given an ``uncertainty.Uncertainty``,
+    the bounds of every rate are added as ``RATE_PER_100_NL``/``NU``.
+
+    Sexes the cube does not have are skipped; an indicator with none of
+    ``sexes`` (e.g. only TOTAL) is drawn with the sexes it has.
+    """
+    sexes = [sex for sex in sexes if sex in cube.sexes] or list(cube.sexes)
+    ranked = extreme_countries(cube, continent, k, years=[year])
+    y = cube.year_index(year)
+    columns = [cube.sexes.index(sex) for sex in sexes]
+    rates = cube.country.mean[y][np.ix_(ranked["COUNTRY"].to_numpy(), columns)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average = np.nansum(rates, axis=1) / (~np.isnan(rates)).sum(axis=1)
+
+    frame = pd.DataFrame({
+        "NAME": np.repeat(ranked["NAME"].to_numpy(), len(sexes)),
+        "DIM_SEX": np.tile(np.asarray(sexes, dtype=object), len(ranked)),
+        VALUE_COLUMN: rates.reshape(-1),
+        "Category": np.repeat(ranked["Category"].to_numpy(), len(sexes)),
+        "Average Rate": np.repeat(average, len(sexes)),
+    })
+    if uncertainty is not None:
+        bounds = uncertainty.bounds(ranked["COUNTRY"].to_numpy(), columns, year)
+        frame["RATE_PER_100_NL"] = bounds[..., 0].reshape(-1)
+        frame["RATE_PER_100_NU"] = bounds[..., 1].reshape(-1)
+    frame = frame[frame[VALUE_COLUMN].notna()]
+    return frame.sort_values(VALUE_COLUMN, ascending=False, kind="stable").reset_index(drop=True)
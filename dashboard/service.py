@@ -0,0 +1,533 @@
+"""
+Standalone query service over the dashboard's data.
+
+Other tools get the numbers behind the charts over HTTP: per-year country
+rates, headline statistics, subregion means, top-k countries and trend
+series. They are computed by the same code as the dashboard. The data is
+loaded by ``ingest.LiveData`` and ``indicators.IndicatorStore``, and the
+aggregate cube, ranking and trend engine answer the queries.
+
+The server runs on tornado (already a Streamlit dependency) on one asyncio
+event loop:
+
+- ``GET /catalog``: indicators, years, geographical areas and trend groups;
+- ``GET /query?query=extremes&year=2022&continent=Europe&k=5``: one query;
+- ``POST /query`` with ``{"queries": [{...}, ...]}``: a batch, answered in
+  order in one response;
+- ``GET /stats``: request and cache counters.
+
+Results are JSON by default. With ``format=arrow`` (or
+``Accept: application/vnd.apache.arrow.stream``) they are Arrow IPC
+streams: one stream per query, concatenated, each with its query in the
+schema metadata (see ``read_arrow``).
+
+Encoded results are kept in a size-bounded LRU cache shared by every client
+(``HDVC_SERVICE_CACHE_MB``). Entries are keyed by the query and the data
+version of its year, so a refresh of the data makes exactly the stale
+entries unreachable. Queries are computed in worker threads, so the event
+loop keeps accepting requests meanwhile.
+
+Run ``python -m dashboard.service serve`` to start the service and
+``python -m dashboard.service loadtest`` to measure its p50/p99 latency
+and throughput.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from dashboard.figcache import FigureCache, figure_key
+from dashboard.figures import TREND_LEVELS
+from dashboard.indicators import OBESITY, IndicatorStore
+from dashboard.ingest import LiveData
+from dashboard.ranking import extreme_gender_rates
+from dashboard.trends import TRANSFORMS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+
+# Default size cap of the result cache, overridable with the
+# HDVC_SERVICE_CACHE_MB variable
+DEFAULT_CACHE_MB = 64
+
+# Default number of worker threads, overridable with HDVC_SERVICE_WORKERS
+DEFAULT_WORKERS = 4
+
+# Largest number of queries in one batch
+MAX_BATCH = 256
+
+JSON_TYPE = "application/json"
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+
+# Columns of the "rates" query
+RATE_COLUMNS = [
+    "GEO_KEY", "NAME", "CONTINENT", "SUBREGION", "DIM_TIME", "DIM_SEX",
+    "RATE_PER_100_N", "RATE_PER_100_NL", "RATE_PER_100_NU",
+]
+
+# Query -> parameters it takes besides ``indicator``
+QUERIES = {
+    "rates": ("year", "continent"),
+    "summary": ("year", "continent"),
+    "subregions": ("year", "continent"),
+    "extremes": ("year", "continent", "k"),
+    "trends": ("level", "groups", "transform", "include_global"),
+}
+
+
+class QueryError(ValueError):
+    """
+    A query the service cannot answer; reported to the client as a 400.
+    """
+
+# ----------------------------------------------------------------------
+# Queries
+# ----------------------------------------------------------------------
+
+def normalize_query(query, snapshot):
+    """
+    Validate a query against the data and fill in its defaults.
+
+    Values may be strings, as in a query string; ``groups`` may then be
+    comma-separated. Returns a new dict with every parameter of the query.
+    """
+    query = dict(query)
+    name = query.pop("query", None)
+    if not isinstance(name, str) or name not in QUERIES:
+        raise QueryError(f"Unknown query {name!r}; expected one of {sorted(QUERIES)}")
+    indicator = query.pop("indicator", OBESITY.code)
+    unknown = set(query) - set(QUERIES[name])
+    if unknown:
+        raise QueryError(f"Query {name!r} does not take {sorted(unknown)}")
+
+    dataset = snapshot.dataset
+    normalized = {"query": name, "indicator": indicator}
+    if "year" in QUERIES[name]:
+        normalized["year"] = _integer(query, "year", dataset.years[-1])
+        if normalized["year"] not in dataset.years:
+            raise QueryError(f"No data for year {normalized['year']}")
+    if "continent" in QUERIES[name]:
+        normalized["continent"] = _string(query, "continent", "World")
+        if normalized["continent"] != "World" and normalized["continent"] not in dataset.continents:
+            raise QueryError(f"Unknown geographical area {normalized['continent']!r}")
+    if "k" in QUERIES[name]:
+        normalized["k"] = _integer(query, "k", 5)
+        if normalized["k"] < 1:
+            raise QueryError("k must be at least 1")
+
+    if name == "trends":
+        level = _string(query, "level", "Regions")
+        if level not in TREND_LEVELS:
+            raise QueryError(f"Unknown level {level!r}; expected one of {sorted(TREND_LEVELS)}")
+        transform = _string(query, "transform", "mean")
+        if transform not in TRANSFORMS:
+            raise QueryError(f"Unknown transform {transform!r}; expected one of {sorted(TRANSFORMS)}")
+        groups = _groups(query)
+        known = set(dataset.groups(TREND_LEVELS[level][0]))
+        missing = sorted(set(groups) - known)
+        if missing:
+            raise QueryError(f"Unknown {level.lower()}: {missing}")
+        include_global = query.get("include_global", False)
+        if isinstance(include_global, str):
+            include_global = include_global.lower() in ("1", "true", "yes")
+        normalized.update(
+            level=level, groups=sorted(groups), transform=transform, include_global=bool(include_global)
+        )
+    return normalized
+
+
+def run_query(snapshot, query):
+    """
+    Answer a normalized query from a snapshot, as a DataFrame.
+
+    An empty ``groups`` list in a trends query selects every group.
+    """
+    name = query["query"]
+    cube = snapshot.cube
+    if name == "rates":
+        dataset = snapshot.dataset
+        return dataset.take(dataset.rows(query["year"], query["continent"]), RATE_COLUMNS)
+    if name == "summary":
+        summary = cube.summary(query["year"], query["continent"])
+        sexes = ["ALL"] + list(summary["by_sex"])
+        rates = [summary["mean"]] + list(summary["by_sex"].values())
+        return pd.DataFrame({"DIM_SEX": sexes, "RATE_PER_100_N": rates})
+    if name == "subregions":
+        return cube.subregion_means(query["year"], query["continent"])
+    if name == "extremes":
+        return extreme_gender_rates(cube, query["year"], query["continent"], query["k"])
+
+    column = TREND_LEVELS[query["level"]][0]
+    groups = query["groups"] or list(snapshot.dataset.groups(column))
+    frame = snapshot.engine.series(column, groups, query["transform"])
+    if query["include_global"]:
+        years, values = snapshot.engine.global_series(query["transform"])
+        world = pd.DataFrame({column: "Global Trend Average", "DIM_TIME": years, "RATE_PER_100_N": values})
+        frame = pd.concat([frame, world[world["RATE_PER_100_N"].notna()]], ignore_index=True)
+    return frame
+
+
+def _integer(query, name, default):
+    try:
+        return int(query.get(name, default))
+    except (TypeError, ValueError):
+        raise QueryError(f"{name} must be an integer") from None
+
+
+def _string(query, name, default):
+    value = query.get(name, default)
+    if not isinstance(value, str):
+        raise QueryError(f"{name} must be a string")
+    return value
+
+
+def _groups(query):
+    groups = query.get("groups", [])
+    if isinstance(groups, str):
+        groups = [group for group in groups.split(",") if group]
+    if not isinstance(groups, list) or not all(isinstance(group, str) for group in groups):
+        raise QueryError("groups must be a comma-separated string or a list of strings")
+    return groups
+
+# ----------------------------------------------------------------------
+# Encoding
+# ----------------------------------------------------------------------
+
+def encode_json(query, frame):
+    """
+    One result of a JSON response: the query and its table, column-wise.
+    """
+    # float32 rates are printed with the digits they actually hold
+    table = frame.to_json(orient="split", index=False, double_precision=6)
+    return b'{"query":' + json.dumps(query).encode() + b',"table":' + table.encode() + b"}"
+
+
+def encode_arrow(query, frame):
+    """
+    One result of an Arrow response: an IPC stream whose schema metadata
+    holds the query.
+    """
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.replace_schema_metadata({"hdvc.query": json.dumps(query)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+ENCODERS = {"json": encode_json, "arrow": encode_arrow}
+
+
+def join_results(results, fmt):
+    """
+    Body of a batch response from its encoded results.
+    """
+    if fmt == "arrow":
+        return b"".join(results)
+    return b'{"results":[' + b",".join(results) + b"]}"
+
+
+def read_arrow(body):
+    """
+    Split an Arrow response into ``(query, table)`` pairs.
+    """
+    reader = pa.BufferReader(body)
+    results = []
+    while reader.tell() < len(body):
+        table = pa.ipc.open_stream(reader).read_all()
+        query = json.loads(table.schema.metadata[b"hdvc.query"])
+        results.append((query, table.replace_schema_metadata(None)))
+    return results
+
+# ----------------------------------------------------------------------
+# Service
+# ----------------------------------------------------------------------
+
+class QueryService:
+    """
+    Answers query batches from the live data, through a shared result cache.
+
+    Thread-safe: batches are answered in worker threads.
+    """
+
+    def __init__(self, live, indicators, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get("HDVC_SERVICE_CACHE_MB", DEFAULT_CACHE_MB)) * 2**20)
+        self.live = live
+        self.indicators = indicators
+        self.cache = FigureCache(max_bytes)
+        self.requests = 0
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self, code):
+        if not isinstance(code, str) or code not in self.indicators.catalog:
+            raise QueryError(f"Unknown indicator {code!r}")
+        return self.indicators.snapshot(code)
+
+    def answer(self, query, fmt="json"):
+        """
+        Encoded result of one query, from the cache when possible.
+        """
+        snapshot = self.snapshot(query.get("indicator", OBESITY.code))
+        query = normalize_query(query, snapshot)
+        version = snapshot.version_of(query.get("year"))
+        key = figure_key("service", format=fmt, version=version, **query)
+        result = self.cache.get(key)
+        if result is None:
+            result = ENCODERS[fmt](query, run_query(snapshot, query))
+            self.cache.put(key, result)
+        return result
+
+    def answer_batch(self, queries, fmt="json"):
+        """
+        Body of the response to a batch of queries, answered in order.
+        """
+        if fmt not in ENCODERS:
+            raise QueryError(f"Unknown format {fmt!r}; expected one of {sorted(ENCODERS)}")
+        if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+            raise QueryError("Expected a list of query objects")
+        if len(queries) > MAX_BATCH:
+            raise QueryError(f"At most {MAX_BATCH} queries per request")
+        with self._lock:
+            self.requests += 1
+            self.queries += len(queries)
+        return join_results([self.answer(query, fmt) for query in queries], fmt)
+
+    def catalog(self):
+        """
+        What can be queried: indicators, years, areas, trend groups.
+        """
+        dataset = self.live.current.dataset
+        return {
+            "indicators": [
+                {"code": indicator.code, "name": indicator.name, "title": indicator.title,
+                 "axis_title": indicator.axis_title}
+                for indicator in self.indicators.catalog.values()
+            ],
+            "queries": {name: list(parameters) for name, parameters in QUERIES.items()},
+            "years": list(dataset.years),
+            "continents": ["World"] + list(dataset.continents),
+            "levels": {level: list(dataset.groups(column)) for level, (column, _) in TREND_LEVELS.items()},
+            "transforms": list(TRANSFORMS),
+        }
+
+    def stats(self):
+        with self._lock:
+            requests, queries = self.requests, self.queries
+        return {
+            "requests": requests,
+            "queries": queries,
+            "version": self.live.current.version,
+            "cache": self.cache.stats(),
+            "indicators": self.indicators.stats(),
+        }
+
+# ----------------------------------------------------------------------
+# HTTP
+# ----------------------------------------------------------------------
+
+def make_app(service, executor):
+    """
+    The tornado application serving ``service``.
+    """
+    import tornado.web
+
+    class JSONHandler(tornado.web.RequestHandler):
+        def write_json(self, data, status=200):
+            self.set_status(status)
+            self.set_header("Content-Type", JSON_TYPE)
+            self.finish(json.dumps(data))
+
+        def write_error(self, status_code, **kwargs):
+            self.write_json({"error": self._reason}, status_code)
+
+    class CatalogHandler(JSONHandler):
+        def get(self):
+            self.write_json(service.catalog())
+
+    class StatsHandler(JSONHandler):
+        def get(self):
+            self.write_json(service.stats())
+
+    class QueryHandler(JSONHandler):
+        async def get(self):
+            params = {name: self.get_argument(name) for name in self.request.arguments}
+            fmt = params.pop("format", None)
+            await self.answer([params], fmt)
+
+        async def post(self):
+            try:
+                body = json.loads(self.request.body or b"{}")
+            except ValueError:
+                return self.write_json({"error": "Request body is not valid JSON"}, 400)
+            if not isinstance(body, dict):
+                return self.write_json({"error": 'Expected {"queries": [...]}'}, 400)
+            await self.answer(body.get("queries"), self.get_argument("format", body.get("format")))
+
+        async def answer(self, queries, fmt):
+            if fmt is None:
+                fmt = "arrow" if ARROW_TYPE in self.request.headers.get("Accept", "") else "json"
+            loop = asyncio.get_running_loop()
+            try:
+                body = await loop.run_in_executor(executor, service.answer_batch, queries, fmt)
+            except QueryError as error:
+                return self.write_json({"error": str(error)}, 400)
+            self.set_header("Content-Type", ARROW_TYPE if fmt == "arrow" else JSON_TYPE)
+            self.finish(body)
+
+    return tornado.web.Application([
+        (r"/catalog", CatalogHandler),
+        (r"/stats", StatsHandler),
+        (r"/query", QueryHandler),
+    ])
+
+
+async def serve(host="127.0.0.1", port=DEFAULT_PORT, workers=None, refresh=None):
+    """
+    Load the data and serve it until cancelled.
+    """
+    if workers is None:
+        workers = int(os.environ.get("HDVC_SERVICE_WORKERS", DEFAULT_WORKERS))
+    live = LiveData.load()
+    live.start(refresh)
+    service = QueryService(live, IndicatorStore(live))
+    executor = ThreadPoolExecutor(workers, thread_name_prefix="hdvc-query")
+    server = make_app(service, executor).listen(port, host)
+    logger.info("Serving %d indicator(s) on http://%s:%d", len(service.indicators.catalog), host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        live.stop()
+        executor.shutdown(wait=False)
+
+# ----------------------------------------------------------------------
+# Load test
+# ----------------------------------------------------------------------
+
+def random_query(catalog, rng):
+    """
+    A query drawn from the catalog, like a consumer of the service would
+    send.
+    """
+    name = rng.choice(sorted(catalog["queries"]))
+    query = {"query": name}
+    if name == "trends":
+        level = rng.choice(sorted(catalog["levels"]))
+        groups = catalog["levels"][level]
+        query.update(
+            level=level,
+            groups=rng.sample(groups, min(3, len(groups))),
+            transform=rng.choice(catalog["transforms"]),
+        )
+        return query
+    query.update(year=rng.choice(catalog["years"]), continent=rng.choice(catalog["continents"]))
+    if name == "extremes":
+        query["k"] = rng.randint(1, 15)
+    return query
+
+
+async def load_test(url, requests=1000, concurrency=16, batch=4, fmt="json", seed=0):
+    """
+    Send ``requests`` batches of ``batch`` random queries, ``concurrency``
+    at a time, and report latency percentiles and throughput.
+    """
+    from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+    client = AsyncHTTPClient(max_clients=concurrency)
+    catalog = json.loads((await client.fetch(f"{url}/catalog")).body)
+    rng = random.Random(seed)
+    bodies = [
+        json.dumps({"queries": [random_query(catalog, rng) for _ in range(batch)], "format": fmt})
+        for _ in range(requests)
+    ]
+    latencies = []
+    errors = 0
+    received = 0
+
+    async def worker(positions):
+        nonlocal errors, received
+        for position in positions:
+            request = HTTPRequest(f"{url}/query", method="POST", body=bodies[position])
+            start = time.perf_counter()
+            response = await client.fetch(request, raise_error=False)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.code != 200:
+                errors += 1
+            else:
+                received += len(response.body)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(range(i, requests, concurrency)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stats = json.loads((await client.fetch(f"{url}/stats")).body)
+    client.close()
+
+    latencies = np.asarray(latencies)
+    return {
+        "requests": requests,
+        "queries": requests * batch,
+        "concurrency": concurrency,
+        "format": fmt,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+        "queries_per_second": round(requests * batch / elapsed, 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "mb_received": round(received / 2**20, 2),
+        "cache": stats["cache"],
+    }
+
+
+def print_load_test(result):
+    print(
+        f"{result['requests']} requests ({result['queries']} queries, {result['format']}), "
+        f"{result['concurrency']} concurrent, {result['errors']} errors in {result['seconds']:.2f}s"
+    )
+    print(
+        f"  {result['requests_per_second']:.0f} requests/s, {result['queries_per_second']:.0f} queries/s, "
+        f"p50 {result['p50_ms']:.1f}ms, p99 {result['p99_ms']:.1f}ms, {result['mb_received']:.1f} MB"
+    )
+    cache = result["cache"]
+    print(f"  result cache: {cache['entries']} entries, {cache['hits']} hits, {cache['misses']} misses")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query service over the dashboard's data.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the service")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--workers", type=int, default=None, help="query worker threads")
+    load_parser = commands.add_parser("loadtest", help="measure a running service")
+    load_parser.add_argument("--url", default=f"http://127.0.0.1:{DEFAULT_PORT}")
+    load_parser.add_argument("--requests", type=int, default=1000)
+    load_parser.add_argument("--concurrency", type=int, default=16)
+    load_parser.add_argument("--batch", type=int, default=4, help="queries per request")
+    load_parser.add_argument("--format", choices=sorted(ENCODERS), default="json")
+    load_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+        asyncio.run(serve(args.host, args.port, args.workers))
+    else:
+        print_load_test(asyncio.run(load_test(
+            args.url, args.requests, args.concurrency, args.batch, args.format, args.seed
+        )))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Spatial index of the country polygons.
+
+An STRtree over the geometry table, built once per geometry and shared by
+every session. It answers the two spatial questions of the map:
+
+- viewport queries: which countries intersect a lon/lat box, so a map view
+  only clips and ships the polygons it can actually show;
+- point lookups: which country contains a clicked lon/lat, so a click on the
+  map can select countries for the trends view.
+
+Both are tree searches over bounding boxes followed by an exact test on the
+few candidates, instead of a scan over every polygon. Results are
+``GEO_KEY`` values, like the index of the geometry table. shapely is only
+imported when an index is built or queried.
+"""
+import numpy as np
+
+# Distance in degrees within which a click next to a country (e.g. in the
+# sea next to a small island) still selects it
+CLICK_TOLERANCE = 0.25
+
+
+def view_box(lon_range, lat_range):
+    """
+    The (xmin, ymin, xmax, ymax) box of a view, or None for the whole globe.
+    """
+    if lon_range[1] - lon_range[0] >= 360 and lat_range[1] - lat_range[0] >= 180:
+        return None
+    return (lon_range[0], lat_range[0], lon_range[1], lat_range[1])
+
+
+class SpatialIndex:
+    """
+    STRtree over the polygons of a geometry table indexed by ``GEO_KEY``.
+    """
+
+    def __init__(self, geometry):
+        import shapely
+
+        self.keys = geometry.index.to_numpy()
+        self.shapes = np.asarray(geometry.geometry.values, dtype=object)
+        self.tree = shapely.STRtree(self.shapes)
+        self.areas = shapely.area(self.shapes)
+        # Prepared polygons answer point-in-polygon tests without rescanning
+        # their edges
+        shapely.prepare(self.shapes)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def query_box(self, box):
+        """
+        Sorted keys of the countries intersecting ``box``, a
+        (xmin, ymin, xmax, ymax) tuple; None selects every country.
+        """
+        import shapely
+
+        if box is None:
+            return np.sort(self.keys)
+        positions = self.tree.query(shapely.box(*box), predicate="intersects")
+        return np.sort(self.keys[positions])
+
+    def query_view(self, lon_range, lat_range):
+        """
+        Sorted keys of the countries visible in a lon/lat view.
+        """
+        return self.query_box(view_box(lon_range, lat_range))
+
+    def locate(self, lon, lat, tolerance=CLICK_TOLERANCE):
+        """
+        Key of the country containing a point, or None.
+
+        Where polygons overlap the smallest one wins, so an enclave is found
+        rather than the country around it. A point in no polygon falls back
+        to the nearest one within ``tolerance`` degrees.
+        """
+        keys = self.locate_many([lon], [lat], tolerance)
+        return None if keys[0] < 0 else keys[0].item()
+
+    def locate_many(self, lons, lats, tolerance=CLICK_TOLERANCE):
+        """
+        Keys of the countries containing each point, -1 where there is none.
+        """
+        import shapely
+
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        points = shapely.points(lons, lats)
+        found = np.full(len(points), -1, dtype=self.keys.dtype)
+
+        # Bounding-box candidates from the tree, then an exact test on the
+        # prepared polygons
+        point_positions, shape_positions = self.tree.query(points)
+        inside = shapely.contains_xy(
+            self.shapes[shape_positions], lons[point_positions], lats[point_positions]
+        )
+        point_positions, shape_positions = point_positions[inside], shape_positions[inside]
+        # Write candidates from the largest to the smallest polygon, so the
+        # smallest containing one wins
+        order = np.argsort(-self.areas[shape_positions], kind="stable")
+        found[point_positions[order]] = self.keys[shape_positions[order]]
+
+        missing = np.flatnonzero(found < 0)
+        if len(missing) and tolerance > 0:
+            point_positions, shape_positions = self.tree.query(
+                points[missing], predicate="dwithin", distance=tolerance
+            )
+            distances = shapely.distance(self.shapes[shape_positions], points[missing][point_positions])
+            order = np.argsort(-distances, kind="stable")
+            found[missing[point_positions[order]]] = self.keys[shape_positions[order]]
+        return found
+
+
+def selected_keys(selection, index):
+    """
+    Keys of the countries picked in a map selection event.
+
+    Choropleth points carry their ``location`` (the ``GEO_KEY``) directly;
+    points that only carry coordinates are looked up in ``index``.
+    """
+    keys = []
+    lons, lats = [], []
+    for point in selection.get("points", []):
+        if point.get("location") is not None:
+            keys.append(int(point["location"]))
+        elif point.get("lon") is not None and point.get("lat") is not None:
+            lons.append(point["lon"])
+            lats.append(point["lat"])
+    if lons:
+        keys.extend(int(key) for key in index.locate_many(lons, lats) if key >= 0)
+    return sorted(set(keys))
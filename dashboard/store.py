@@ -0,0 +1,357 @@
+"""
+Columnar on-disk cache of the dashboard tables.
+
+Parsing the WHO CSV and the Natural Earth shapefile is the slowest part of a
+cold start. The normalized tables are therefore written once to Parquet: the
+fact table with categorical country/sex columns and float32 rates, and the
+geometry table as GeoParquet. A manifest records the size, mtime and SHA-256
+of every source file, and the cache is rebuilt only when one of them changes.
+
+Run ``python -m dashboard.store`` to build the cache ahead of time, for
+example in a container image build step.
+
+The fact table can be loaded on its own, as a memory-mapped Arrow table,
+with ``load_fact_table``, which needs neither geopandas nor shapely; they
+are only imported when the geometry table is read or the cache is rebuilt.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+CSV_PATH = "BEFA58B_ALL_LATEST.csv"
+SHAPEFILE_PATH = "ne_50m_admin_0_countries/ne_50m_admin_0_countries.shp"
+CACHE_DIR = ".hdvc_cache"
+
+FACTS_FILE = "facts.parquet"
+GEOMETRY_FILE = "countries.parquet"
+MANIFEST_FILE = "manifest.json"
+
+# Bump when the layout of the cached tables changes
+CACHE_VERSION = 1
+
+# Sidecar files read together with a shapefile
+SHAPEFILE_SIDECARS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+# ----------------------------------------------------------------------
+# Source fingerprints
+# ----------------------------------------------------------------------
+
+def source_files(csv_path=CSV_PATH, shapefile_path=SHAPEFILE_PATH):
+    """
+    List every file the cached tables are derived from.
+    """
+    stem = os.path.splitext(shapefile_path)[0]
+    sidecars = [stem + ext for ext in SHAPEFILE_SIDECARS if os.path.exists(stem + ext)]
+    return [csv_path] + sidecars
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Return the SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(paths, previous=None):
+    """
+    Describe the source files by size, mtime and content hash.
+
+    Files whose size and mtime match ``previous`` reuse its hash, so a
+    fresh cache is validated without reading the sources.
+    """
+    previous = previous or {}
+    result = {}
+    for path in paths:
+        stat = os.stat(path)
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        known = previous.get(path)
+        if known and all(known.get(key) == value for key, value in entry.items()):
+            entry["sha256"] = known["sha256"]
+        else:
+            entry["sha256"] = file_hash(path)
+        result[path] = entry
+    return result
+
+
+def same_content(current, recorded):
+    """
+    Compare two fingerprints by content hash only.
+    """
+    if set(current) != set(recorded):
+        return False
+    return all(current[path]["sha256"] == recorded[path]["sha256"] for path in current)
+
+# ----------------------------------------------------------------------
+# Reading and writing
+# ----------------------------------------------------------------------
+
+def read_manifest(cache_dir=CACHE_DIR):
+    """
+    Return the cache manifest, or None if there is no usable cache.
+    """
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    try:
+        with open(path, encoding="utf-8") as handle:
+            manifest = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != CACHE_VERSION:
+        return None
+    return manifest
+
+
+def write_atomic(cache_dir, name, write):
+    """
+    Write a cache file through a temporary file and rename it into place.
+    """
+    handle, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=name, suffix=".tmp")
+    os.close(handle)
+    try:
+        write(tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, os.path.join(cache_dir, name))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _write_manifest(manifest, cache_dir):
+    def write(path):
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(manifest, handle, indent=2)
+
+    write_atomic(cache_dir, MANIFEST_FILE, write)
+
+
+def _refresh_manifest(manifest, sources, cache_dir):
+    """
+    Record new mtimes for sources that were touched but not changed.
+    """
+    try:
+        _write_manifest(dict(manifest, sources=sources), cache_dir)
+    except OSError:
+        pass
+
+
+def write_cache(geometry, facts, unmatched, sources, cache_dir=CACHE_DIR):
+    """
+    Write the normalized tables and their manifest to ``cache_dir``.
+
+    The manifest is written last, so a reader never sees a manifest that
+    points at half-written tables.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomic(cache_dir, GEOMETRY_FILE, lambda path: geometry.to_parquet(path))
+    return write_facts(facts, unmatched, sources, cache_dir)
+
+
+def write_facts(facts, unmatched, sources, cache_dir=CACHE_DIR):
+    """
+    Replace the cached fact table, keeping the geometry table, and write
+    the manifest. Returns the new manifest.
+    """
+    write_atomic(cache_dir, FACTS_FILE, lambda path: facts.to_parquet(path, index=False))
+    manifest = {
+        "version": CACHE_VERSION,
+        "sources": sources,
+        "unmatched": unmatched.to_dict(orient="records"),
+    }
+    _write_manifest(manifest, cache_dir)
+    return manifest
+
+
+def read_fact_table(manifest, cache_dir=CACHE_DIR):
+    """
+    Memory-map the cached fact table as an Arrow table.
+
+    Returns the table and the unmatched WHO areas recorded when the cache
+    was built.
+    """
+    table = pq.read_table(os.path.join(cache_dir, FACTS_FILE), memory_map=True)
+    unmatched = pd.DataFrame(
+        manifest["unmatched"], columns=["DIM_GEO_CODE_M49", "GEO_NAME_SHORT", "ROWS"]
+    )
+    return table, unmatched
+
+
+def read_geometry_attributes(cache_dir=CACHE_DIR):
+    """
+    The cached geometry table without its polygons, read with pyarrow
+    only: ``GEO_KEY`` index, ``M49`` code and the country attributes.
+    """
+    table = pq.read_table(os.path.join(cache_dir, GEOMETRY_FILE), columns=["M49", "NAME", "CONTINENT", "SUBREGION"])
+    attributes = table.to_pandas()
+    attributes.index.name = "GEO_KEY"
+    return attributes
+
+
+def read_geometry(cache_dir=CACHE_DIR):
+    """
+    Memory-map the cached geometry table.
+    """
+    import geopandas as gpd
+
+    return gpd.read_parquet(os.path.join(cache_dir, GEOMETRY_FILE), memory_map=True)
+
+
+def read_cache(manifest, cache_dir=CACHE_DIR):
+    """
+    Memory-map the cached tables.
+
+    Returns the geometry table, the fact table and the unmatched WHO areas
+    recorded when the cache was built.
+    """
+    table, unmatched = read_fact_table(manifest, cache_dir)
+    return read_geometry(cache_dir), table.to_pandas(split_blocks=True), unmatched
+
+
+def read_sources(csv_path=CSV_PATH, shapefile_path=SHAPEFILE_PATH):
+    """
+    Parse the raw WHO export and the Natural Earth shapefile.
+    """
+    import geopandas as gpd
+
+    obesity_data = pd.read_csv(csv_path)
+    world = gpd.read_file(shapefile_path)
+    return obesity_data, world
+
+
+def fresh_manifest(csv_path=CSV_PATH, shapefile_path=SHAPEFILE_PATH, cache_dir=CACHE_DIR):
+    """
+    Return the cache manifest if it matches the sources, else None.
+
+    Sources that were touched but not changed get their new mtimes
+    recorded, so the next check does not hash them again.
+    """
+    manifest = read_manifest(cache_dir)
+    if manifest is None:
+        return None
+    recorded = manifest["sources"]
+    sources = fingerprint(source_files(csv_path, shapefile_path), recorded)
+    if not same_content(sources, recorded):
+        return None
+    if sources != recorded:
+        _refresh_manifest(manifest, sources, cache_dir)
+        manifest = dict(manifest, sources=sources)
+    return manifest
+
+
+def rebuild_cache(csv_path=CSV_PATH, shapefile_path=SHAPEFILE_PATH, cache_dir=CACHE_DIR):
+    """
+    Parse the sources, normalize them and write the cache.
+
+    Failing to write the cache (e.g. on a read-only file system) is not an
+    error. Returns the geometry table, fact table and unmatched areas.
+    """
+    from dashboard.model import normalize
+
+    sources = fingerprint(source_files(csv_path, shapefile_path))
+    obesity_data, world = read_sources(csv_path, shapefile_path)
+    geometry, facts, unmatched = normalize(world, obesity_data)
+    try:
+        write_cache(geometry, facts, unmatched, sources, cache_dir)
+    except OSError as error:
+        logger.warning("Could not write table cache to %s: %s", cache_dir, error)
+    return geometry, facts, unmatched
+
+
+def _load(read, csv_path, shapefile_path, cache_dir):
+    """
+    Read from the cache when it is fresh, otherwise rebuild it.
+
+    Returns ``read(manifest)``, or None when the cache had to be rebuilt.
+    """
+    manifest = fresh_manifest(csv_path, shapefile_path, cache_dir)
+    if manifest is not None:
+        try:
+            return read(manifest)
+        except (OSError, ValueError) as error:
+            logger.warning("Ignoring unreadable table cache in %s: %s", cache_dir, error)
+    return None
+
+
+def load_tables(csv_path=CSV_PATH, shapefile_path=SHAPEFILE_PATH, cache_dir=CACHE_DIR):
+    """
+    Return the geometry table, fact table and unmatched areas.
+
+    The Parquet cache is used when its manifest matches the sources;
+    otherwise the raw files are parsed and the cache is rebuilt.
+    """
+    tables = _load(lambda manifest: read_cache(manifest, cache_dir), csv_path, shapefile_path, cache_dir)
+    if tables is None:
+        tables = rebuild_cache(csv_path, shapefile_path, cache_dir)
+    return tables
+
+
+def load_fact_table(csv_path=CSV_PATH, shapefile_path=SHAPEFILE_PATH, cache_dir=CACHE_DIR):
+    """
+    Return the fact table as an Arrow table, and the unmatched areas,
+    without the geometry.
+    """
+    tables = _load(lambda manifest: read_fact_table(manifest, cache_dir), csv_path, shapefile_path, cache_dir)
+    if tables is None:
+        _, facts, unmatched = rebuild_cache(csv_path, shapefile_path, cache_dir)
+        tables = pa.Table.from_pandas(facts, preserve_index=False), unmatched
+    return tables
+
+
+def load_geometry(csv_path=CSV_PATH, shapefile_path=SHAPEFILE_PATH, cache_dir=CACHE_DIR):
+    """
+    Return the geometry table, one row per country indexed by ``GEO_KEY``.
+    """
+    geometry = _load(lambda manifest: read_geometry(cache_dir), csv_path, shapefile_path, cache_dir)
+    if geometry is None:
+        geometry, _, _ = rebuild_cache(csv_path, shapefile_path, cache_dir)
+    return geometry
+
+
+def cached_geometry(shapefile_path=SHAPEFILE_PATH, cache_dir=CACHE_DIR):
+    """
+    Return the cached geometry table as it is, without checking the sources.
+
+    Only when the table is missing is the shapefile parsed, and only the
+    geometry table written; the fact table and manifest are left alone.
+    """
+    if os.path.exists(os.path.join(cache_dir, GEOMETRY_FILE)):
+        return read_geometry(cache_dir)
+    import geopandas as gpd
+
+    from dashboard.model import build_geometry_table
+
+    geometry = build_geometry_table(gpd.read_file(shapefile_path))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomic(cache_dir, GEOMETRY_FILE, lambda path: geometry.to_parquet(path))
+    except OSError as error:
+        logger.warning("Could not write geometry table to %s: %s", cache_dir, error)
+    return geometry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the dashboard's Parquet table cache.")
+    parser.add_argument("--csv", default=CSV_PATH, help="WHO obesity export")
+    parser.add_argument("--shapefile", default=SHAPEFILE_PATH, help="Natural Earth countries")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="output directory")
+    args = parser.parse_args()
+
+    geometry, facts, unmatched = load_tables(args.csv, args.shapefile, args.cache_dir)
+    print(f"{len(facts)} rows, {len(geometry)} countries cached in {args.cache_dir}")
+    if not unmatched.empty:
+        print("Unmatched WHO areas: " + ", ".join(unmatched["GEO_NAME_SHORT"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""
+Compact TopoJSON encoding of the map geometry.
+
+Polygons are quantized to an integer grid and cut into arcs at the points
+where neighbouring borders meet or part, so a border shared by two countries
+is stored once. Arcs are delta-encoded as in the TopoJSON specification and
+every feature carries its ``GEO_KEY`` as ``id``.
+
+Plotly's choropleth only accepts GeoJSON, so the figures are fed a GeoJSON
+decoded from the topology. Its coordinates are snapped to the quantization
+grid and rounded accordingly, which makes it much smaller than the float64
+output of ``GeoSeries.to_json``. Topologies are built once per map view and
+cached on disk next to the geometry levels.
+
+The same encoding backs the simplified levels of ``dashboard.lod``: the
+source polygons are encoded once and every arc is simplified once, so the
+borders of neighbouring countries still coincide at every level.
+
+Decoding needs neither shapely nor geopandas; they are imported only when a
+topology has to be built or simplified.
+"""
+import hashlib
+import json
+import math
+import os
+
+from dashboard.store import CACHE_DIR, write_atomic
+
+TOPO_DIR = os.path.join(CACHE_DIR, "topo")
+
+# Grid size of the quantized coordinates along each axis
+QUANTIZATION = 100_000
+
+# Name of the object holding the countries in the topology
+OBJECT_NAME = "countries"
+
+# ----------------------------------------------------------------------
+# Encoding
+# ----------------------------------------------------------------------
+
+def _quantize_ring(coords, translate, scale):
+    """
+    Snap a ring to the integer grid, dropping repeated points.
+    """
+    points = []
+    for x, y in coords:
+        point = (round((x - translate[0]) / scale[0]), round((y - translate[1]) / scale[1]))
+        if not points or point != points[-1]:
+            points.append(point)
+    if points[0] != points[-1]:
+        points.append(points[0])
+    return points if len(points) >= 4 else None
+
+
+def _find_junctions(rings):
+    """
+    Return the points where rings stop sharing the same neighbours.
+    """
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        points = ring[:-1]
+        count = len(points)
+        for i, point in enumerate(points):
+            pair = (points[i - 1], points[(i + 1) % count])
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair and seen != pair[::-1]:
+                junctions.add(point)
+    return junctions
+
+
+def _cut_ring(ring, junctions):
+    """
+    Split a closed ring into arcs that start and end at junctions.
+
+    A ring without junctions becomes a single closed arc starting at its
+    smallest point, so the same ring seen from either side is cut the same
+    way.
+    """
+    points = ring[:-1]
+    cuts = [i for i, point in enumerate(points) if point in junctions]
+    if not cuts:
+        start = points.index(min(points))
+        rotated = points[start:] + points[:start]
+        return [rotated + [rotated[0]]]
+    rotated = points[cuts[0]:] + points[:cuts[0]]
+    rotated.append(rotated[0])
+    cuts = [cut - cuts[0] for cut in cuts] + [len(points)]
+    return [rotated[a:b + 1] for a, b in zip(cuts, cuts[1:])]
+
+
+def _polygon_parts(shape):
+    from shapely.geometry import MultiPolygon, Polygon
+
+    if isinstance(shape, Polygon):
+        return [shape]
+    if isinstance(shape, MultiPolygon):
+        return list(shape.geoms)
+    return [part for part in getattr(shape, "geoms", []) if isinstance(part, Polygon)]
+
+
+def build_topology(polygons, quantization=QUANTIZATION):
+    """
+    Encode a GeoSeries of (multi)polygons as a TopoJSON dictionary.
+
+    The series index is used as the feature ``id``. Arcs are stored once,
+    whichever direction they are traversed in, and delta-encoded.
+    """
+    xmin, ymin, xmax, ymax = polygons.total_bounds
+    translate = (float(xmin), float(ymin))
+    scale = (
+        (float(xmax - xmin) or 1.0) / (quantization - 1),
+        (float(ymax - ymin) or 1.0) / (quantization - 1),
+    )
+
+    features = []
+    for key, shape in polygons.items():
+        parts = []
+        for polygon in _polygon_parts(shape):
+            rings = [_quantize_ring(polygon.exterior.coords, translate, scale)]
+            rings += [_quantize_ring(ring.coords, translate, scale) for ring in polygon.interiors]
+            if rings[0] is not None:
+                parts.append([ring for ring in rings if ring is not None])
+        features.append((key, parts))
+
+    junctions = _find_junctions(ring for _, parts in features for rings in parts for ring in rings)
+
+    arcs = []
+    arc_index = {}
+
+    def register(arc):
+        key = tuple(arc)
+        if key in arc_index:
+            return arc_index[key]
+        reverse = key[::-1]
+        if reverse in arc_index:
+            return ~arc_index[reverse]
+        arc_index[key] = len(arcs)
+        arcs.append(arc)
+        return len(arcs) - 1
+
+    geometries = []
+    for key, parts in features:
+        encoded = [[[register(arc) for arc in _cut_ring(ring, junctions)] for ring in rings] for rings in parts]
+        geometry = {"id": int(key)}
+        if len(encoded) == 1:
+            geometry.update(type="Polygon", arcs=encoded[0])
+        elif encoded:
+            geometry.update(type="MultiPolygon", arcs=encoded)
+        else:
+            geometry.update(type=None)
+        geometries.append(geometry)
+
+    return {
+        "type": "Topology",
+        "transform": {"scale": list(scale), "translate": list(translate)},
+        "objects": {OBJECT_NAME: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": [_delta_encode(arc) for arc in arcs],
+    }
+
+
+def _delta_encode(arc):
+    encoded = [list(arc[0])]
+    for (x0, y0), (x1, y1) in zip(arc, arc[1:]):
+        encoded.append([x1 - x0, y1 - y0])
+    return encoded
+
+# ----------------------------------------------------------------------
+# Arc simplification
+# ----------------------------------------------------------------------
+
+def _grid(topology):
+    import numpy as np
+
+    return np.asarray(topology["transform"]["scale"]), np.asarray(topology["transform"]["translate"])
+
+
+def arc_lines(topology):
+    """
+    The arcs of a topology as shapely LineStrings, in map coordinates.
+    """
+    import numpy as np
+    import shapely
+
+    scale, translate = _grid(topology)
+    lines = [shapely.linestrings(np.cumsum(arc, axis=0) * scale + translate) for arc in topology["arcs"]]
+    return np.asarray(lines, dtype=object)
+
+
+def simplify_arcs(lines, tolerance):
+    """
+    Simplify every arc once, at ``tolerance`` map units.
+
+    The arcs are simplified together with shapely's topology-preserving
+    simplifier: their end points, where borders meet, stay in place, and no
+    arc is moved across another.
+    """
+    import shapely
+
+    if tolerance == 0:
+        return lines
+    simplified = shapely.get_parts(shapely.simplify(shapely.multilinestrings(lines), tolerance, preserve_topology=True))
+    if len(simplified) != len(lines):
+        raise ValueError(f"Simplification returned {len(simplified)} arcs for {len(lines)}")
+    return simplified
+
+
+def with_arcs(topology, lines):
+    """
+    Copy of ``topology`` whose arcs are ``lines``, snapped to its grid.
+
+    ``lines`` must keep the arcs in order, e.g. the output of
+    ``simplify_arcs``; the geometries are left untouched.
+    """
+    import numpy as np
+    import shapely
+
+    scale, translate = _grid(topology)
+    arcs = []
+    for line in lines:
+        points = np.rint((shapely.get_coordinates(line) - translate) / scale).astype(np.int64)
+        arcs.append(np.vstack([points[:1], np.diff(points, axis=0)]).tolist())
+    return dict(topology, arcs=arcs)
+
+
+def feature_arcs(topology):
+    """
+    Indices of the arcs of every feature, as ``{id: [arc, ...]}``.
+    """
+    def flatten(arcs):
+        for item in arcs:
+            if isinstance(item, list):
+                yield from flatten(item)
+            else:
+                yield item if item >= 0 else ~item
+
+    return {
+        geometry["id"]: sorted(set(flatten(geometry.get("arcs") or [])))
+        for geometry in topology["objects"][OBJECT_NAME]["geometries"]
+    }
+
+# ----------------------------------------------------------------------
+# Decoding
+# ----------------------------------------------------------------------
+
+def coordinate_decimals(topology):
+    """
+    Number of decimals that still resolve one quantization step.
+    """
+    step = min(topology["transform"]["scale"])
+    return max(0, math.ceil(-math.log10(step)))
+
+
+def _decode_arcs(topology, decimals):
+    scale = topology["transform"]["scale"]
+    translate = topology["transform"]["translate"]
+    decoded = []
+    for arc in topology["arcs"]:
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x += dx
+            y += dy
+            points.append([
+                round(x * scale[0] + translate[0], decimals),
+                round(y * scale[1] + translate[1], decimals),
+            ])
+        decoded.append(points)
+    return decoded
+
+
+def _stitch_ring(ring, arcs):
+    points = []
+    for index in ring:
+        arc = arcs[index] if index >= 0 else arcs[~index][::-1]
+        points.extend(arc if not points else arc[1:])
+    return points
+
+
+def to_geojson(topology):
+    """
+    Decode a topology into a GeoJSON FeatureCollection for plotly.
+
+    Feature ids are the ``GEO_KEY`` values, matching
+    ``locations="GEO_KEY"`` with plotly's default ``featureidkey="id"``.
+    """
+    arcs = _decode_arcs(topology, coordinate_decimals(topology))
+    features = []
+    for geometry in topology["objects"][OBJECT_NAME]["geometries"]:
+        if geometry["type"] == "Polygon":
+            coordinates = [_stitch_ring(ring, arcs) for ring in geometry["arcs"]]
+        elif geometry["type"] == "MultiPolygon":
+            coordinates = [[_stitch_ring(ring, arcs) for ring in rings] for rings in geometry["arcs"]]
+        else:
+            continue
+        features.append({
+            "type": "Feature",
+            "id": geometry["id"],
+            "properties": {},
+            "geometry": {"type": geometry["type"], "coordinates": coordinates},
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def to_shapes(topology):
+    """
+    Decode a topology into shapely geometries, as ``{id: shape}``.
+
+    A ring that collapsed to fewer than four points is kept as is, so the
+    shape comes out invalid rather than silently losing a part.
+    """
+    from shapely.geometry import shape
+
+    return {feature["id"]: shape(feature["geometry"]) for feature in to_geojson(topology)["features"]}
+
+
+def select_features(geojson, keys):
+    """
+    Keep only the features whose id is in ``keys``.
+    """
+    wanted = {int(key) for key in keys}
+    features = [feature for feature in geojson["features"] if feature["id"] in wanted]
+    return {"type": "FeatureCollection", "features": features}
+
+# ----------------------------------------------------------------------
+# Per-view cache
+# ----------------------------------------------------------------------
+
+def view_key(geometry, lon_range, lat_range, quantization=QUANTIZATION):
+    """
+    Identify the topology of a map view by its inputs.
+    """
+    from dashboard import lod
+
+    digest = hashlib.sha256()
+    digest.update(lod.geometry_digest(geometry).encode())
+    digest.update(
+        repr((lod.LEVEL_TOLERANCES, lod.LOD_VERSION, list(lon_range), list(lat_range), quantization)).encode()
+    )
+    return digest.hexdigest()[:16]
+
+
+def load_view_topology(geometry, lon_range, lat_range, topo_dir=TOPO_DIR, index=None):
+    """
+    Return the topology of a map view, building and caching it if needed.
+
+    The polygons come from the level of detail that suits the view and are
+    clipped to its box (see ``dashboard.lod``); ``index`` (a
+    ``spatial.SpatialIndex``) narrows the clipping down to the countries in
+    the box. The levels are simplified on the topology of the source, so
+    neighbouring countries still share their border vertices and every
+    shared border is found again, and stored once, here.
+    """
+    from dashboard import lod
+
+    name = f"{view_key(geometry, lon_range, lat_range)}.topojson"
+    try:
+        with open(os.path.join(topo_dir, name), encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        pass
+
+    levels = lod.load_levels(geometry)
+    topology = build_topology(lod.view_geometry(levels, lon_range, lat_range, index))
+
+    def write(path):
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(topology, handle, separators=(",", ":"))
+
+    try:
+        os.makedirs(topo_dir, exist_ok=True)
+        write_atomic(topo_dir, name, write)
+    except OSError:
+        pass
+    return topology
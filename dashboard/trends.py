@@ -0,0 +1,219 @@
+"""
+Dense trend matrices for the "Obesity Trends Over Time" view.
+
+At load time the aggregate cube is reduced, for every grouping level of the
+view (subregions, countries and continents) and for the whole world, to a
+``[group, year]`` matrix of the mean rate over all rows. Selecting groups is
+then a row slice. Derived series (rolling means, centred smoothing and
+year-over-year deltas) are computed on first use for every group of a level
+in one vectorized pass and kept for later reruns.
+
+When a refresh changes some years only, ``TrendEngine.refreshed`` recomputes
+the matrix columns of those years from the refreshed cube.
+"""
+import copy
+import threading
+
+import numpy as np
+import pandas as pd
+
+from dashboard.cube import VALUE_COLUMN
+
+# Default window of the rolling and smoothed series, in years
+WINDOW = 3
+
+# Series a trend can be drawn as: name -> (label, y-axis title); None keeps
+# the axis title of the indicator
+TRANSFORMS = {
+    "mean": ("Yearly mean", None),
+    "smoothed": (f"Smoothed ({WINDOW}-year centred mean)", None),
+    "rolling": (f"{WINDOW}-year rolling mean", None),
+    "delta": ("Year-over-year change", "Change (percentage points)"),
+}
+
+
+def window_sums(values, window, centred):
+    """
+    NaN-aware moving sums and counts along the last axis.
+
+    A trailing window ends at each year; a centred one is placed around it
+    and shrinks at both ends.
+    """
+    valid = ~np.isnan(values)
+    padded_values = np.concatenate(
+        [np.zeros(values.shape[:-1] + (1,)), np.cumsum(np.where(valid, values, 0), axis=-1)], axis=-1
+    )
+    padded_counts = np.concatenate(
+        [np.zeros(values.shape[:-1] + (1,)), np.cumsum(valid, axis=-1)], axis=-1
+    )
+    n = values.shape[-1]
+    positions = np.arange(n)
+    if centred:
+        start = np.clip(positions - (window - 1) // 2, 0, n)
+        end = np.clip(positions + window // 2 + 1, 0, n)
+    else:
+        start = np.clip(positions - window + 1, 0, n)
+        end = positions + 1
+    sums = padded_values[..., end] - padded_values[..., start]
+    counts = padded_counts[..., end] - padded_counts[..., start]
+    return sums, counts
+
+
+def moving_mean(values, window, centred=False):
+    """
+    Moving mean over ``window`` years of every row, ignoring missing years.
+    """
+    sums, counts = window_sums(values, window, centred)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def year_over_year(values):
+    """
+    Change from the previous year of every row; NaN for the first year.
+    """
+    delta = np.full(values.shape, np.nan)
+    delta[..., 1:] = values[..., 1:] - values[..., :-1]
+    return delta
+
+
+class TrendLevel:
+    """
+    Yearly means of the groups of one level, as a ``[group, year]`` matrix.
+    """
+
+    def __init__(self, labels, total, count):
+        labels = np.asarray(labels, dtype=object)
+        self.labels, inverse = np.unique(labels, return_inverse=True)
+        self.index = {label: i for i, label in enumerate(self.labels)}
+        self.total, self.count = self._grouped(inverse, total, count)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean = self.total / self.count
+        self._derived = {"mean": self.mean}
+        self._lock = threading.Lock()
+
+    def _grouped(self, inverse, total, count):
+        """
+        Sum the rows of ``total`` and ``count`` into their groups.
+        """
+        grouped_total = np.zeros((len(self.labels), total.shape[1]))
+        grouped_count = np.zeros((len(self.labels), total.shape[1]), dtype=np.int64)
+        np.add.at(grouped_total, inverse, total)
+        np.add.at(grouped_count, inverse, count)
+        return grouped_total, grouped_count
+
+    def refreshed(self, labels, total, count, columns):
+        """
+        Copy of the level with the ``columns`` (year positions) recomputed.
+
+        ``total`` and ``count`` hold those columns only, with one row per
+        entry of ``labels`` as in the constructor; the labels must be
+        known. The other columns and the level itself are left untouched,
+        and the derived series are computed again on first use.
+        """
+        level = copy.copy(self)
+        inverse = np.array([self.index[label] for label in labels], dtype=np.intp)
+        part_total, part_count = self._grouped(inverse, total, count)
+        level.total, level.count = self.total.copy(), self.count.copy()
+        level.total[:, columns] = part_total
+        level.count[:, columns] = part_count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            level.mean = level.total / level.count
+        level._derived = {"mean": level.mean}
+        level._lock = threading.Lock()
+        return level
+
+    def rows(self, groups):
+        """
+        Row indices of ``groups`` in label order; unknown groups are skipped.
+        """
+        return np.sort([self.index[group] for group in groups if group in self.index]).astype(np.intp)
+
+    def values(self, transform="mean", window=WINDOW):
+        """
+        The matrix of a transform, computed for every group on first use.
+        """
+        key = transform if transform in ("mean", "delta") else (transform, window)
+        values = self._derived.get(key)
+        if values is None:
+            if transform == "smoothed":
+                values = moving_mean(self.mean, window, centred=True)
+            elif transform == "rolling":
+                values = moving_mean(self.mean, window)
+            elif transform == "delta":
+                values = year_over_year(self.mean)
+            else:
+                raise ValueError(f"Unknown trend transform: {transform!r}")
+            with self._lock:
+                values = self._derived.setdefault(key, values)
+        return values
+
+
+class TrendEngine:
+    """
+    Trend matrices of every grouping level of the trends view.
+
+    Levels are keyed by the fact table column they group by, as in
+    ``figures.TREND_LEVELS``; the world trend is a one-row level.
+    """
+
+    # Fact table column of a level -> cube rollup it is reduced from
+    ROLLUPS = {"SUBREGION": "subregion", "NAME": "country", "CONTINENT": "continent"}
+
+    def __init__(self, cube):
+        self.years = cube.years
+        self.levels = {
+            column: TrendLevel(getattr(cube, rollup).labels, *_sums(getattr(cube, rollup)))
+            for column, rollup in self.ROLLUPS.items()
+        }
+        self.world = TrendLevel(cube.world.labels, *_sums(cube.world))
+
+    def refreshed(self, cube, years):
+        """
+        Copy of the engine with the columns of ``years`` recomputed from
+        ``cube``, a cube refreshed for those years (see
+        ``AggregateCube.refreshed``), so it has the same years and groups.
+        """
+        columns = np.searchsorted(self.years, np.intersect1d(np.asarray(list(years), dtype=int), self.years))
+        engine = copy.copy(self)
+        engine.levels = {
+            column: self.levels[column].refreshed(
+                getattr(cube, rollup).labels, *_sums(getattr(cube, rollup), columns), columns
+            )
+            for column, rollup in self.ROLLUPS.items()
+        }
+        engine.world = self.world.refreshed(cube.world.labels, *_sums(cube.world, columns), columns)
+        return engine
+
+    def series(self, column, groups, transform="mean", window=WINDOW):
+        """
+        Long frame of the selected groups: (column, DIM_TIME, value) rows.
+
+        Groups come out in label order and years without data are dropped,
+        as in a ``groupby([column, "DIM_TIME"]).mean()``.
+        """
+        level = self.levels[column]
+        rows = level.rows(groups)
+        values = level.values(transform, window)[rows]
+        frame = pd.DataFrame({
+            column: np.repeat(level.labels[rows], len(self.years)),
+            "DIM_TIME": np.tile(self.years, len(rows)),
+            VALUE_COLUMN: values.reshape(-1),
+        })
+        return frame[frame[VALUE_COLUMN].notna()].reset_index(drop=True)
+
+    def global_series(self, transform="mean", window=WINDOW):
+        """
+        The world trend as ``(years, values)``.
+        """
+        return self.years, self.world.values(transform, window)[0]
+
+
+def _sums(rollup, years=slice(None)):
+    """
+    Reduce a cube rollup to ``[group, year]`` totals and counts over all
+    sexes, for the ``years`` rows (a slice or index array).
+    """
+    total = rollup.sum[years].sum(axis=2).T
+    count = rollup.count[years].sum(axis=2).T
+    return total, count
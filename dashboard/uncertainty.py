@@ -0,0 +1,287 @@
+"""
+Credible intervals of the rates and the significance of their changes.
+
+Every WHO estimate comes with the bounds of its 95% credible interval
+(``RATE_PER_100_NL`` and ``RATE_PER_100_NU``). They are reduced once per
+snapshot, in a few vectorized NumPy passes:
+
+- ``values``, a dense ``[country, sex, year, 3]`` array of (estimate,
+  lower, upper), NaN where there is no row;
+- uncertainty bands for the trends view: for every grouping level of
+  ``trends.TrendEngine``, the 95% interval of the yearly mean drawn by the
+  trend line (see ``Uncertainty._bands``);
+- changes between two years for every country and sex at once. A change is
+  significant when the intervals of the two years do not overlap, a
+  conservative test.
+
+Selections then only slice these arrays, so the fastest-rising table costs
+the same with every country selected as with one. Exports without bounds
+simply get NaN bands and no significant changes. A refresh that changes
+some years only recomputes their cells and band columns
+(``Uncertainty.refreshed``).
+"""
+import copy
+
+import numpy as np
+import pandas as pd
+
+from dashboard.cube import VALUE_COLUMN
+from dashboard.trends import TrendLevel
+
+EST, LOWER, UPPER = 0, 1, 2
+
+# Fact table columns of (estimate, lower, upper)
+BOUND_COLUMNS = (VALUE_COLUMN, "RATE_PER_100_NL", "RATE_PER_100_NU")
+
+# Direction of a significant change: rise, fall or none
+RISE, FALL, NONE = 1, -1, 0
+
+
+def cell_array(facts, cube):
+    """
+    The ``[country, sex, year, 3]`` array of (estimate, lower, upper),
+    indexed like the cube.
+
+    A cell holds one WHO row; should there be several, the last one wins.
+    """
+    country = np.searchsorted(cube.geo_keys, facts["GEO_KEY"].to_numpy())
+    sex = facts["DIM_SEX"].cat.codes.to_numpy()
+    year = facts["DIM_TIME"].to_numpy()
+    position = np.searchsorted(cube.years, year).clip(0, len(cube.years) - 1)
+    values = np.stack([facts[column].to_numpy(dtype=np.float64) for column in BOUND_COLUMNS], axis=-1)
+    valid = (cube.years[position] == year) & (sex >= 0) & ~np.isnan(values[:, EST])
+
+    cells = np.full((len(cube.geo_keys), len(cube.sexes), len(cube.years), 3), np.nan)
+    cells[country[valid], sex[valid], position[valid]] = values[valid]
+    return cells
+
+
+def significance(start_lower, start_upper, end_lower, end_upper):
+    """
+    RISE, FALL or NONE for every pair of intervals, elementwise.
+    """
+    with np.errstate(invalid="ignore"):
+        return np.where(end_lower > start_upper, RISE, np.where(end_upper < start_lower, FALL, NONE))
+
+
+def _country_stats(values):
+    """
+    Per country and year, ``[country, year]``: sum and count of the
+    estimates over the sexes, as in the trend lines, and the distance from
+    each estimate to its lower and upper bound, summed over the sexes. Rows
+    with an estimate but no bounds are counted apart.
+    """
+    estimate = values[..., EST]
+    present = ~np.isnan(estimate)
+    stats = {"total": np.where(present, estimate, 0).sum(axis=1), "count": present.sum(axis=1)}
+    for bound in (LOWER, UPPER):
+        width = np.abs(values[..., bound] - estimate)
+        stats[bound] = np.where(present & ~np.isnan(width), width, 0).sum(axis=1)
+        stats["missing", bound] = (present & np.isnan(width)).sum(axis=1)
+    return stats
+
+
+def _rollups(cube):
+    """
+    ``(column, rollup)`` of every grouping level of the trends view.
+    """
+    return (("SUBREGION", cube.subregion), ("NAME", cube.country), ("CONTINENT", cube.continent))
+
+
+def _merged(bands, part, columns):
+    """
+    Copy of the bands of a level with the ``columns`` taken from ``part``,
+    the bands of the same groups computed for those columns only.
+    """
+    level = part[EST]
+    merged = {EST: bands[EST].refreshed(level.labels, level.total, level.count, columns)}
+    for bound in (LOWER, UPPER):
+        merged[bound] = bands[bound].copy()
+        merged[bound][:, columns] = part[bound]
+    return merged
+
+
+class Uncertainty:
+    """
+    Credible intervals of one snapshot, by country, sex and year.
+    """
+
+    def __init__(self, facts, cube):
+        self.years = cube.years
+        self.sexes = cube.sexes
+        self.names = cube.names
+        self.continent_of = cube.continent_of
+        self.subregion_of = cube.subregion_of
+        self.values = cell_array(facts, cube)
+
+        # Bands of every group of a level: one membership product per
+        # rollup, over every group and year at once
+        stats = _country_stats(self.values)
+        self.levels = {column: self._bands(rollup, stats) for column, rollup in _rollups(cube)}
+        self.world = self._bands(cube.world, stats)
+
+    def refreshed(self, facts, cube, years):
+        """
+        Copy of the intervals with the cells and band columns of ``years``
+        recomputed from ``facts``, for a cube refreshed for those years
+        (see ``AggregateCube.refreshed``). The other years and this object
+        are left untouched.
+        """
+        years = np.intersect1d(np.asarray(list(years), dtype=int), self.years)
+        columns = np.searchsorted(self.years, years)
+        rows = facts[facts["DIM_TIME"].isin(years)]
+        uncertainty = copy.copy(self)
+        uncertainty.values = self.values.copy()
+        uncertainty.values[:, :, columns] = cell_array(rows, cube)[:, :, columns]
+
+        stats = _country_stats(uncertainty.values[:, :, columns])
+        uncertainty.levels = {
+            column: _merged(self.levels[column], self._bands(rollup, stats), columns)
+            for column, rollup in _rollups(cube)
+        }
+        uncertainty.world = _merged(self.world, self._bands(cube.world, stats), columns)
+        return uncertainty
+
+    def _bands(self, rollup, stats):
+        """
+        ``{EST: TrendLevel, LOWER: [group, year], UPPER: [group, year]}``:
+        the yearly mean of every group and the bounds of its 95% interval.
+
+        The sexes of a country are taken as fully correlated, so the
+        half-width of a country's mean is the mean distance of its rows to
+        their bound: for a single country the band is its average interval.
+        Countries are taken as independent, so for a group of ``n`` rows the
+        half-width is ``sqrt(sum of squared country sums) / n``, narrowing
+        as the group grows. WHO intervals are not symmetric, so each side is
+        combined separately. Years where a row of the group has no bounds
+        get no band.
+        """
+        membership = np.zeros((len(rollup.members), len(self.names)))
+        for group, countries in enumerate(rollup.members):
+            membership[group, countries] = 1
+
+        def grouped(values):
+            # TrendLevel sorts the groups by label; keep every matrix aligned
+            return TrendLevel(rollup.labels, membership @ values, membership @ stats["count"]).total
+
+        level = TrendLevel(rollup.labels, membership @ stats["total"], membership @ stats["count"])
+        bands = {EST: level}
+        for bound, sign in ((LOWER, -1), (UPPER, 1)):
+            with np.errstate(invalid="ignore", divide="ignore"):
+                half = np.sqrt(grouped(stats[bound] ** 2)) / level.count
+            half[grouped(stats["missing", bound]) > 0] = np.nan
+            bands[bound] = level.mean + sign * half
+        return bands
+
+    def nbytes(self):
+        levels = (*self.levels.values(), self.world)
+        return self.values.nbytes + sum(
+            level[EST].total.nbytes + level[EST].count.nbytes + level[EST].mean.nbytes
+            + level[LOWER].nbytes + level[UPPER].nbytes
+            for level in levels
+        )
+
+    # ------------------------------------------------------------------
+    # Trends
+    # ------------------------------------------------------------------
+
+    def band(self, column, groups):
+        """
+        Long frame of the bands of the selected groups: (column, DIM_TIME,
+        lower, upper) rows, in label order, like ``TrendEngine.series``.
+        """
+        level = self.levels[column]
+        rows = level[EST].rows(groups)
+        frame = pd.DataFrame({
+            column: np.repeat(level[EST].labels[rows], len(self.years)),
+            "DIM_TIME": np.tile(self.years, len(rows)),
+            BOUND_COLUMNS[LOWER]: level[LOWER][rows].reshape(-1),
+            BOUND_COLUMNS[UPPER]: level[UPPER][rows].reshape(-1),
+        })
+        return frame[frame[BOUND_COLUMNS[LOWER]].notna()].reset_index(drop=True)
+
+    def global_band(self):
+        """
+        The world band as ``(years, lower, upper)``.
+        """
+        return self.years, self.world[LOWER][0], self.world[UPPER][0]
+
+    def trend_significance(self, column, groups, start=None, end=None):
+        """
+        Direction of the significant change of each group between two
+        years (by default the first and the last), as ``{group: RISE,
+        FALL or NONE}``.
+        """
+        level = self.levels[column]
+        lower, upper = level[LOWER], level[UPPER]
+        rows = level[EST].rows(groups)
+        first, last = self._year_positions(start, end)
+        flags = significance(lower[rows, first], upper[rows, first], lower[rows, last], upper[rows, last])
+        return dict(zip(level[EST].labels[rows], flags.tolist()))
+
+    # ------------------------------------------------------------------
+    # Countries
+    # ------------------------------------------------------------------
+
+    def _year_positions(self, start, end):
+        first = 0 if start is None else int(np.searchsorted(self.years, start))
+        last = len(self.years) - 1 if end is None else int(np.searchsorted(self.years, end))
+        return first, last
+
+    def bounds(self, countries, sexes, year):
+        """
+        ``[country, sex, 2]`` array of the (lower, upper) bounds of the
+        given country and sex indices in one year.
+        """
+        y = int(np.searchsorted(self.years, year))
+        return self.values[np.ix_(np.asarray(countries), np.asarray(sexes))][:, :, y, LOWER:UPPER + 1]
+
+    def countries_of(self, column, groups):
+        """
+        Indices of the countries belonging to the selected groups of a
+        trend level.
+        """
+        labels = {"NAME": self.names, "SUBREGION": self.subregion_of, "CONTINENT": self.continent_of}[column]
+        return np.flatnonzero(np.isin(labels, list(groups)))
+
+    def changes(self, start=None, end=None):
+        """
+        Change of every country and sex between two years, as
+        ``[country, sex]`` arrays: start and end estimates, change, change
+        per year and direction of a significant change.
+        """
+        first, last = self._year_positions(start, end)
+        begin, finish = self.values[:, :, first], self.values[:, :, last]
+        change = finish[..., EST] - begin[..., EST]
+        return {
+            "start": begin[..., EST],
+            "end": finish[..., EST],
+            "change": change,
+            "per_year": change / max(int(self.years[last] - self.years[first]), 1),
+            "significance": significance(begin[..., LOWER], begin[..., UPPER], finish[..., LOWER], finish[..., UPPER]),
+        }
+
+    def rising_table(self, countries=None, sex="TOTAL", start=None, end=None):
+        """
+        Countries sorted by the rise of their rate between two years, for
+        one sex, e.g. for a sortable table.
+
+        ``countries`` are country indices (all by default); countries
+        without an estimate in either year are left out.
+        """
+        first, last = self._year_positions(start, end)
+        countries = np.arange(len(self.names)) if countries is None else np.asarray(countries, dtype=np.intp)
+        s = self.sexes.index(sex) if sex in self.sexes else 0
+        changes = {name: values[countries, s] for name, values in self.changes(start, end).items()}
+        start_year, end_year = int(self.years[first]), int(self.years[last])
+        frame = pd.DataFrame({
+            "Country": self.names[countries],
+            "Continent": self.continent_of[countries],
+            str(start_year): changes["start"],
+            str(end_year): changes["end"],
+            "Change (pp)": changes["change"],
+            "Change per year (pp)": changes["per_year"],
+            "Significant": np.asarray(["fall", "", "rise"], dtype=object)[changes["significance"] + 1],
+        })
+        frame = frame[frame["Change (pp)"].notna()]
+        return frame.sort_values("Change (pp)", ascending=False, kind="stable").reset_index(drop=True)
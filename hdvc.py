@@ -1,11 +1,26 @@
+import logging
+
 import streamlit as st
-import pandas as pd
-import geopandas as gpd
-from geopandas import GeoDataFrame
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
+import streamlit.components.v1 as components
+
+from dashboard import client_map, topo
+from dashboard.figcache import CachedFigure, FigureCache, figure_key
+from dashboard.figures import (
+    CONTINENT_RANGES,
+    TREND_LEVELS,
+    extremes_figure,
+    map_figure,
+    subregion_figure,
+    trend_figure,
+)
+from dashboard.indicators import OBESITY, IndicatorStore
+from dashboard.ingest import LiveData
+from dashboard.panels import panel_key
+from dashboard.spatial import SpatialIndex, selected_keys
+from dashboard.instrument import Recorder, configure_logging, debug_enabled, figure_rows
+from dashboard.trends import TRANSFORMS
 
+logger = logging.getLogger(__name__)
 
 # ----------------------------------------------------------------------
 # 1. Application Configuration
@@ -14,6 +29,12 @@ st.set_page_config(
     page_title="Global and Regional Obesity Interactive Visualization",
     layout="wide")
 
+# Per-stage timings, opt-in with ?debug=1 or HDVC_DEBUG=1
+debug = debug_enabled(st.query_params)
+if debug:
+    configure_logging()
+recorder = Recorder(debug)
+
 # ----------------------------------------------------------------------
 # Abstract Section
 # ----------------------------------------------------------------------
@@ -41,78 +62,155 @@ st.sidebar.header("Interactive Data Filters")
 # 2. Data Loading
 # ----------------------------------------------------------------------
 
-@st.cache_data
+@st.cache_resource
+def load_figure_cache():
+    """
+    Figure JSON shared by all sessions, bounded by HDVC_FIGURE_CACHE_MB.
+    """
+    return FigureCache()
+
+
+figure_cache = load_figure_cache()
+
+
+def stale_figures(snapshot):
+    """
+    Predicate matching the cached figures of the bundled indicator not
+    drawn from ``snapshot``.
+    """
+    def stale(key):
+        filters = dict(key[1:])
+        if filters.get("indicator") != OBESITY.code:
+            return False
+        return filters.get("version") != snapshot.version_of(filters.get("year"))
+
+    return stale
+
+
+@st.cache_resource
 def load_data():
     """
-    Load the necessary data for the application:
-      - Obesity data (CSV)
-      - Shapefile (world map) using an integrated geopandas dataset.
+    Load the obesity data (CSV), joined to the world map on the M49 area
+    code, once per process and shared read-only by every session.
+
+    The table is memory-mapped from the Parquet cache in `.hdvc_cache`.
+    The aggregate cube behind the statistics panel and the subregion and
+    extremes charts, and the trend matrices, are built alongside it. A
+    background thread applies new WHO exports incrementally and swaps in
+    a new snapshot (see `dashboard.ingest`); figures of the years that
+    changed are dropped from the figure cache. The shapefile (world map,
+    one polygon per country) is only read on the first map view. Areas
+    without a polygon are logged.
     """
-    # Load obesity dataset
-    obesity_data = pd.read_csv("BEFA58B_ALL_LATEST.csv")  # Adjust the filename to your actual CSV file
-    # Load shapefile for the world map
-    file_path = "ne_50m_admin_0_countries/ne_50m_admin_0_countries.shp"
-    world = gpd.read_file(file_path)
-    
-    return obesity_data, world
+    live = LiveData.load()
+    unmatched = live.current.dataset.unmatched
+    if not unmatched.empty:
+        logger.warning(
+            "No map polygon for %d WHO area(s): %s",
+            len(unmatched), ", ".join(unmatched["GEO_NAME_SHORT"]),
+        )
+    live.subscribe(lambda old, new, report: figure_cache.discard(stale_figures(new)))
+    live.start()
+    return live
 
-data, world = load_data()
 
-# ----------------------------------------------------------------------
-# 3. Column Adjustments for Merging
-# ----------------------------------------------------------------------
-if "GEO_NAME_SHORT" in data.columns:
-    data.rename(columns={"GEO_NAME_SHORT": "NAME"}, inplace=True)
-
-# Name corrections for merging datasets
-name_corrections = {
-    'Antigua and Barbuda': 'Antigua and Barb.',
-    'Bolivia (Plurinational State of)': 'Bolivia',
-    'Bosnia and Herzegovina': 'Bosnia and Herz.',
-    'Brunei Darussalam': 'Brunei',
-    'Central African Republic': 'Central African Rep.',
-    "Democratic People's Republic of Korea": 'North Korea',
-    'Democratic Republic of the Congo': 'Dem. Rep. Congo',
-    'Dominican Republic': 'Dominican Rep.',
-    'Eswatini': 'eSwatini',
-    'Iran (Islamic Republic of)': 'Iran',
-    "Lao People's Democratic Republic": 'Laos',
-    'Marshall Islands': 'Marshall Is.',
-    'Micronesia (Federated States of)': 'Micronesia',
-    'Netherlands (Kingdom of the)': 'Netherlands',
-    'Republic of Korea': 'South Korea',
-    'Republic of Moldova': 'Moldova',
-    'Russian Federation': 'Russia',
-    'Saint Kitts and Nevis': 'St. Kitts and Nevis',
-    'Saint Vincent and the Grenadines': 'St. Vin. and Gren.',
-    'Sao Tome and Principe': 'SÒo TomÚ and Principe',
-    'Solomon Islands': 'Solomon Is.',
-    'South Sudan': 'S. Sudan',
-    'Syrian Arab Republic': 'Syria',
-    'Tokelau': 'Tokelau',  # No change needed
-    'T³rkiye': 'Turkey',
-    'United Kingdom of Great Britain and Northern Ireland': 'United Kingdom',
-    'United Republic of Tanzania': 'Tanzania',
-    'Venezuela (Bolivarian Republic of)': 'Venezuela',
-    'Viet Nam': 'Vietnam',
-    'occupied Palestinian territory, including east Jerusalem': 'Palestine'
-}
-
-data["NAME"] = data["NAME"].replace(name_corrections)
+@st.cache_resource
+def load_indicators(_live):
+    """
+    Catalog of the indicators, with the WHO exports found in `indicators/`
+    (or HDVC_INDICATOR_DIR) partitioned by indicator. Indicators other than
+    obesity are loaded on first selection and kept in a cache bounded by
+    HDVC_INDICATOR_CACHE_MB.
+    """
+    return IndicatorStore(_live)
 
 # ----------------------------------------------------------------------
-# 4. Merge World Map Data with Obesity Data
+# 3. Merge World Map Data with Obesity Data
 # ----------------------------------------------------------------------
-world = world.merge(data, on="NAME", how="inner", suffixes=(None, "_drop"))
-world = GeoDataFrame(world, geometry="geometry", crs=world.crs)
+# One polygon per country in `dataset.geometry`; the rows of every indicator
+# in `dataset.facts` refer to it by GEO_KEY and geometry is only joined in
+# when the map is drawn. Sessions never copy or modify the shared tables, and
+# a rerun reads one consistent snapshot even if new data arrives meanwhile.
+live = load_data()
+indicator_store = load_indicators(live)
+catalog = indicator_store.catalog
+
+# The indicator selector only appears once other exports are available
+indicator = OBESITY
+if len(catalog) > 1:
+    indicator = catalog[
+        st.sidebar.selectbox(
+            "Select an indicator:", list(catalog), format_func=lambda code: catalog[code].title, key="indicator"
+        )
+    ]
+recorder.context["indicator"] = indicator.code
+
+with recorder.stage("load_data") as record:
+    snapshot = indicator_store.snapshot(indicator.code)
+    dataset, cube = snapshot.dataset, snapshot.cube
+    facts = dataset.facts
+    record["rows"] = len(facts)
+    record["version"] = snapshot.version
+
+
+def cached_figure(stage, key, build):
+    """
+    Figure from the shared cache, built on a miss; recorded as ``stage``.
+    """
+    with recorder.stage(stage) as record:
+        record["cache"] = "hit"
+
+        def build_on_miss():
+            record["cache"] = "miss"
+            return build()
+
+        spec = figure_cache.get_or_build(key, build_on_miss)
+        if spec is None:
+            return None
+        fig = CachedFigure(spec)
+        if recorder.enabled:
+            record["rows"] = figure_rows(fig.to_dict())
+            record["bytes"] = len(spec)
+    return fig
+
+
+def plotly_chart(stage, fig, **kwargs):
+    """
+    ``st.plotly_chart`` at full width, recorded as ``stage``.
+    """
+    with recorder.stage(stage):
+        return st.plotly_chart(fig, use_container_width=True, **kwargs)
+
+
+def stage_timings(rerun):
+    """
+    Totals and stage records of the current rerun, for the debug panels.
+    """
+    st.markdown(
+        f"**{rerun['ms']:.1f} ms** over {rerun['stages']} stages, "
+        f"{rerun['cache_hits']} cache hit(s), {rerun['cache_misses']} miss(es)"
+    )
+    st.dataframe(recorder.records, hide_index=True)
+
+
+def panel_timings(panel, alone):
+    """
+    Stage timings of a panel rerun on its own, shown inside the panel since
+    a fragment cannot update the sidebar debug panel.
+    """
+    if alone and recorder.enabled:
+        with st.expander(f"Debug: {panel} panel rerun"):
+            stage_timings(recorder.summary())
 
 # ----------------------------------------------------------------------
-# 5. Sidebar Graph Selection
+# 4. Sidebar Graph Selection
 # ----------------------------------------------------------------------
 option = st.sidebar.radio(
     "Select the graph you want to visualize:",
-    ("Global Obesity Visualization", "Obesity Trends Over Time")
+    ("Global Obesity Visualization", "Obesity Trends Over Time"),
+    key="view",
 )
+recorder.context["view"] = option
 # Default values
 selected_year = 2022
 selected_continent = "World"
@@ -120,124 +218,86 @@ selected_continent = "World"
 # Show filters only when "World Map" is selected
 if option == "Global Obesity Visualization":
     # Year selection (DIM_TIME)
-    available_years = sorted(world["DIM_TIME"].dropna().unique().astype(int))
-    selected_year = st.sidebar.selectbox("Select a year:", available_years, index=available_years.index(2022))
+    available_years = list(dataset.years)
+    # 2022 when the indicator has it, otherwise its latest year
+    default_year = selected_year if selected_year in available_years else available_years[-1]
+    selected_year = st.sidebar.selectbox(
+        "Select a year:", available_years, index=available_years.index(default_year), key="year"
+    )
     
     # Filter available continents
-    available_continents = ['World'] + sorted(world["CONTINENT"].dropna().unique())
-    selected_continent = st.sidebar.selectbox("Select a geographical area:", available_continents)
-
-# Filter data by continent if "World" is not selected
-filtered_data = world.copy()
-if selected_continent != 'World' and option == "Global Obesity Visualization":
-    filtered_data = filtered_data[filtered_data["CONTINENT"] == selected_continent]
-
-# Filter data by selected year
-if option == "Global Obesity Visualization":
-    filtered_data = filtered_data[filtered_data["DIM_TIME"] == selected_year]
+    available_continents = ['World'] + list(dataset.continents)
+    selected_continent = st.sidebar.selectbox("Select a geographical area:", available_continents, key="continent")
 
 # ----------------------------------------------------------------------
-# 6. World Map with Year Filter
+# 5. World Map with Year Filter
 # ----------------------------------------------------------------------
 
-continent_ranges = {
-    "World": {"lon": [-180, 180], "lat": [-90, 90]},  # Entire world
-    "Europe": {"lon": [-30, 50], "lat": [30, 75]},
-    "Asia": {"lon": [30, 150], "lat": [10, 70]},
-    "Africa": {"lon": [-20, 55], "lat": [-35, 37]},
-    "North America": {"lon": [-170, -50], "lat": [5, 80]},
-    "South America": {"lon": [-85, -30], "lat": [-60, 15]},
-    "Oceania": {"lon": [110, 180], "lat": [-50, 0]},
-    "Seven seas (open ocean)": {"lon": [-180, 180], "lat": [-90, 90]}
-}
-
-# Get longitude and latitude ranges for the selected continent
-lon_range = continent_ranges[selected_continent]["lon"]
-lat_range = continent_ranges[selected_continent]["lat"]
-
-if option == "Global Obesity Visualization":
-    st.header(f"Global Obesity Visualization ({selected_year})")
-
-    # Calcular promedios y estadísticas
-    avg_obesity_rate = filtered_data["RATE_PER_100_N"].mean()
-    avg_obesity_by_gender = filtered_data.groupby("DIM_SEX")["RATE_PER_100_N"].mean()
-    male_avg = avg_obesity_by_gender.get("MALE", float("nan"))
-    female_avg = avg_obesity_by_gender.get("FEMALE", float("nan"))
+@st.cache_resource
+def load_spatial_index(geometry_version):
+    """
+    STRtree over the country polygons, for viewport queries and map clicks.
+    """
+    return SpatialIndex(dataset.geometry)
 
-    # Identify countries with high and low rates
-    max_obesity = filtered_data.loc[filtered_data["RATE_PER_100_N"].idxmax()]
-    min_obesity = filtered_data.loc[filtered_data["RATE_PER_100_N"].idxmin()]
-    
-    # Add a slider for selecting the range of obesity rates
-    min_rate, max_rate = filtered_data["RATE_PER_100_N"].min(), filtered_data["RATE_PER_100_N"].max()
-    selected_range = st.sidebar.slider(
-        "Select Obesity Rate Range displayed on the map:",
-        0,
-        100,
-        (0,100)
-    )
 
-    # Filter the data based on the selected range
-    filtered_data_range = filtered_data[
-        (filtered_data["RATE_PER_100_N"] >= selected_range[0]) &
-        (filtered_data["RATE_PER_100_N"] <= selected_range[1])
-    ]
+@st.cache_resource
+def load_map_geometry(lon_range, lat_range, geometry_version):
+    """
+    GeoJSON for a map view: simplified to the detail visible at that zoom
+    level, clipped to the view and quantized. Only the countries the spatial
+    index finds in the view are clipped and shipped. The underlying topology
+    is built once on disk and shared by every session.
+    """
+    index = load_spatial_index(geometry_version)
+    return topo.to_geojson(topo.load_view_topology(dataset.geometry, lon_range, lat_range, index=index))
 
-    col1, col2 = st.columns([3, 1])
 
-    with col1:
-        fig = px.choropleth(
-            filtered_data_range,
-            geojson=filtered_data_range.geometry,
-            locations=filtered_data_range.index,
-            color="RATE_PER_100_N",
-            hover_name="NAME",
-            hover_data={"RATE_PER_100_N": True, "DIM_TIME": False},
-            title=f"{selected_continent}",
-            color_continuous_scale=px.colors.sequential.Sunset,  
-            labels={"RATE_PER_100_N": "Obesity Rate (%)"},
-        )
+@st.cache_resource
+def load_client_map(continent, indicator_code, version):
+    """
+    Topology and the rates of every year of a continent, serialized once
+    per indicator and data version for the in-browser map.
+    """
+    view = CONTINENT_RANGES[continent]
+    index = load_spatial_index(live.current.geometry_version)
+    topology = topo.load_view_topology(dataset.geometry, tuple(view["lon"]), tuple(view["lat"]), index=index)
+    return client_map.map_payload(cube, topology, continent)
 
-        # Map
-        fig.update_geos(
-            projection_type="natural earth",
-            showcountries=True,
-            countrycolor="#D6D6D6",  # Country boundaries
-            showocean=True,
-            oceancolor="#EAF6FF", 
-            visible=True,
-            lonaxis_range=lon_range,
-            lataxis_range=lat_range,
-            resolution=50,
-        )
 
-        # Design and legend
-        fig.update_layout(
-            autosize=True,
-            title={
-                "text": f"{selected_continent}",
-                "x": 0.5,
-                "xanchor": "center",
-                "font": {"size": 20, "color": "#333"},  
-            },
-            coloraxis_colorbar={
-                "title": "<b>Obesity Rate (%)</b>",
-                "len": 0.75,  
-                "yanchor": "middle",
-                "y": 0.5,
-                "thickness": 15,
-                "x": 1.02,  
-                "tickfont": {"size": 12, "color": "#333"},  
-                "titlefont": {"size": 14, "color": "#333"},
-            },
-            margin={"r": 10, "t": 30, "l": 10, "b": 10},
-        )
+@st.cache_resource
+def load_plotly_js():
+    """
+    URL of the plotly.js bundle loaded by the in-browser map, served by this
+    app rather than a CDN.
+
+    The app's static file route sends scripts as text/plain, which browsers
+    refuse to run, so the bundle's directory is declared as a component
+    instead: Streamlit serves component files with their real content type.
+    The URL is relative, so it resolves against the page the map is
+    embedded in.
+    """
+    name = client_map.write_plotly_js()
+    component = components.declare_component("plotly_js", path=client_map.ASSET_DIR)
+    return f"component/{component.name}/{name}"
 
-        # Show in Streamlit
-        st.plotly_chart(fig, use_container_width=True)
+# Each panel reads only the inputs declared for it in `dashboard.panels`, and
+# its figures are cached under exactly those inputs. Panels with their own
+# widgets are fragments: moving the rate range only reruns the map, changing
+# the number of countries only reruns the extremes chart.
 
+def stats_panel(year, continent):
+    """
+    Headline statistics of a year and continent, from the aggregate cube.
+    """
+    with recorder.scope(panel="stats"):
+        # Calcular promedios y estadísticas (precomputed in the aggregate cube)
+        with recorder.stage("stats"):
+            summary = cube.summary(year, continent)
+        avg_obesity_rate = summary["mean"]
+        male_avg = summary["by_sex"].get("MALE", float("nan"))
+        female_avg = summary["by_sex"].get("FEMALE", float("nan"))
 
-    with col2:
         st.markdown(
             f"""
             <style>
@@ -272,7 +332,7 @@ if option == "Global Obesity Visualization":
             </style>
             <div class="stats-container">
                 <h2>{avg_obesity_rate:.2f}%</h2>
-                <p class="highlight">Average Obesity Rate</p>
+                <p class="highlight">Average {indicator.name} Rate</p>
                 <p>Male: <span class="highlight">{male_avg:.2f}%</span></p>
                 <p>Female: <span class="highlight">{female_avg:.2f}%</span></p>
             </div>
@@ -281,159 +341,164 @@ if option == "Global Obesity Visualization":
         )
 
 
-    # Chart 1: Stacked Bars by Subregion
-    st.subheader("Exploring Obesity Trends in Subregions")
-    if "SUBREGION" in filtered_data.columns:
-        subregion_data = (
-            filtered_data.groupby(["SUBREGION", "DIM_SEX"])["RATE_PER_100_N"]
-            .mean()
-            .reset_index()
-        )
-
-        # Sort subregions by average obesity rate (average of both genders)
-        subregion_order = (
-            subregion_data.groupby("SUBREGION")["RATE_PER_100_N"].mean()
-            .sort_values(ascending=False)
-            .index
-        )
-        subregion_data["SUBREGION"] = pd.Categorical(
-            subregion_data["SUBREGION"], categories=subregion_order, ordered=True
-        )
-        subregion_data_gender = subregion_data[subregion_data["DIM_SEX"].isin(["MALE", "FEMALE"])]
-
-        # Ensure Plotly respects the categorical order
-        fig1 = px.bar(
-            subregion_data_gender,
-            x="SUBREGION",
-            y="RATE_PER_100_N",
-            color="DIM_SEX",
-            barmode="stack",
-            labels={"RATE_PER_100_N": "Obesity Rate (%)", "SUBREGION": "Subregion"},
-            color_discrete_sequence=["#FF9999", "#9999FF"],  # Different colors for genders
-            title=f"Subregion-Level Gender Analysis of Obesity in {selected_continent}",
-            category_orders={"SUBREGION": list(subregion_order)},  # Respect categorical order
-        )
-
-        fig1.update_layout(
-            xaxis_title="Subregion",
-            yaxis_title="Obesity Rate (%)",
-            legend_title="Gender",
-            margin={"t": 50, "l": 50, "r": 50, "b": 50},
-            width=800,
-            height=500,
-        )
-
-        st.plotly_chart(fig1, use_container_width=True)
-    else:
-        st.warning("No subregion data found for this continent.")
-
+@st.fragment
+def map_panel(year, continent):
+    """
+    The map with its mode and rate range, plus the trends of the countries
+    selected on it. Its widgets and map selections rerun this panel only.
+    """
+    with recorder.fragment(panel="map") as alone:
+        # "All years" ships every year to the browser once; year, sex and rate
+        # range are then changed on the map itself without a rerun
+        map_mode = st.radio("Map mode:", ("Selected year", "All years (in browser)"), horizontal=True, key="map_mode")
+
+        if map_mode == "Selected year":
+            # Add a slider for selecting the range of obesity rates
+            selected_range = st.slider(
+                f"Select {indicator.name} Rate Range displayed on the map:",
+                0,
+                100,
+                (0,100),
+                key="rate_range",
+            )
+            view = CONTINENT_RANGES[continent]
+
+            # Filtered rows, geometry and figure are rebuilt only on a cache miss
+            fig = cached_figure(
+                "map_figure",
+                panel_key(
+                    "map",
+                    snapshot.version_of(year),
+                    indicator=indicator.code,
+                    year=year,
+                    continent=continent,
+                    rate_range=selected_range,
+                ),
+                lambda: map_figure(
+                    dataset,
+                    load_map_geometry(tuple(view["lon"]), tuple(view["lat"]), live.current.geometry_version),
+                    year,
+                    continent,
+                    selected_range,
+                    indicator,
+                ),
+            )
 
-    # Chart 2: Extreme Countries
-    st.subheader("Countries with Highest and Lowest Obesity Rates")
+            # Show in Streamlit; clicking (or box/lasso selecting) countries
+            # shows their trends below the map and in the trends view
+            event = plotly_chart(
+                "map_chart", fig, on_select="rerun", selection_mode=("points", "box", "lasso"), key="map_chart"
+            )
+            with recorder.stage("map_selection") as record:
+                keys = []
+                if event and event.selection.points:
+                    keys = selected_keys(event.selection, load_spatial_index(live.current.geometry_version))
+                st.session_state["selected_countries"] = cube.names_of(keys)
+                record["rows"] = len(keys)
+        else:
+            with recorder.stage("client_map") as record:
+                payload = load_client_map(continent, indicator.code, snapshot.version)
+                html = client_map.map_html(payload, continent, year, load_plotly_js(), indicator=indicator)
+                components.html(html, height=client_map.HEIGHT)
+                record["bytes"] = len(html)
+
+        # Trends of the countries selected on the map, served from the same
+        # precomputed matrices as the trends view
+        map_selection = st.session_state.get("selected_countries", [])
+        if map_selection:
+            st.subheader("Trends of the Countries Selected on the Map")
+            fig = cached_figure(
+                "selection_trend_figure",
+                panel_key(
+                    "selection_trends",
+                    snapshot.version,
+                    indicator=indicator.code,
+                    selection=frozenset(map_selection),
+                ),
+                lambda: trend_figure(
+                    snapshot.engine, "Countries", map_selection, False, "mean", indicator, snapshot.uncertainty
+                ),
+            )
+            plotly_chart("selection_trend_chart", fig)
 
-    # Explanation for the chart
-    st.markdown(f"""
-        This bar chart highlights the five countries with the highest and lowest obesity rates in {selected_continent}.
-        Data is categorized by gender to emphasize disparities.
-    """)
+        panel_timings("map", alone)
 
-    # Group by country and calculate the average rate for males and females
-    country_avg_data = (
-        filtered_data.groupby("NAME")["RATE_PER_100_N"]
-        .mean()
-        .reset_index()
-        .sort_values("RATE_PER_100_N", ascending=False)
-    )
-    # Select the 5 countries with the highest and lowest rates
-    top_countries = country_avg_data.nlargest(5, "RATE_PER_100_N")
-    bottom_countries = country_avg_data.nsmallest(5, "RATE_PER_100_N")
-    extreme_countries = pd.concat([top_countries, bottom_countries])
 
-    # Filter the original data to include only these countries
-    extreme_gender_data = filtered_data[filtered_data["NAME"].isin(extreme_countries["NAME"])]
+def subregions_panel(year, continent):
+    """
+    Stacked male/female bars of the subregions of a continent.
+    """
+    with recorder.scope(panel="subregions"):
+        # Chart 1: Stacked Bars by Subregion
+        st.subheader(f"Exploring {indicator.name} Trends in Subregions")
+        fig1 = cached_figure(
+            "subregion_figure",
+            panel_key("subregions", snapshot.version_of(year), indicator=indicator.code, year=year, continent=continent),
+            lambda: subregion_figure(cube, year, continent, indicator),
+        )
+        if fig1 is not None:
+            plotly_chart("subregion_chart", fig1)
+        else:
+            st.warning("No subregion data found for this continent.")
 
-    # Filter only males and females
-    extreme_gender_data = extreme_gender_data[extreme_gender_data["DIM_SEX"].isin(["MALE", "FEMALE"])]
-    extreme_gender_data = extreme_gender_data[["NAME", "DIM_SEX", "RATE_PER_100_N"]]
 
-    # Create a new column to differentiate between "Top 5" and "Bottom 5"
-    extreme_gender_data["Category"] = extreme_gender_data["NAME"].apply(
-        lambda x: "Top 5" if x in top_countries["NAME"].values else "Bottom 5"
-    )
+@st.fragment
+def extremes_panel(year, continent):
+    """
+    Countries with the highest and lowest rates; the number of countries
+    reruns this panel only.
+    """
+    with recorder.fragment(panel="extremes") as alone:
+        # Chart 2: Extreme Countries
+        st.subheader(f"Countries with Highest and Lowest {indicator.name} Rates")
+
+        # Number of countries shown at each end of the ranking
+        top_k = st.slider("Number of countries with the highest and lowest rates:", 1, 15, 5, key="k")
+
+        # Explanation for the chart
+        st.markdown(f"""
+            This bar chart highlights the {top_k} countries with the highest and lowest {indicator.name.lower()} rates in {continent}.
+            Data is categorized by gender to emphasize disparities. Error bars show the 95% credible interval of each rate.
+        """)
+
+        fig2 = cached_figure(
+            "extremes_figure",
+            panel_key(
+                "extremes", snapshot.version_of(year), indicator=indicator.code, year=year, continent=continent, k=top_k
+            ),
+            lambda: extremes_figure(cube, year, continent, top_k, indicator, snapshot.uncertainty),
+        )
 
-    # Sort data to ensure "Top 5" appear first and within each group sort by obesity rate
-    extreme_gender_data = extreme_gender_data.sort_values("RATE_PER_100_N", ascending=False).reset_index(drop=True)
+        # Display the chart in Streamlit
+        plotly_chart("extremes_chart", fig2)
 
+        panel_timings("extremes", alone)
 
-    # Calculate the average obesity rate (Male and Female) for each country
-    extreme_gender_data["Average Rate"] = (
-        extreme_gender_data.groupby("NAME")["RATE_PER_100_N"].transform("mean")
-    )
 
-    # Create the chart with improved aesthetics and additional hover data
-    fig2 = px.bar(
-        extreme_gender_data,
-        x="RATE_PER_100_N",
-        y="NAME",
-        color="DIM_SEX",  # Color by gender
-        pattern_shape="Category",  # Differentiate by Top 5/Bottom 5
-        orientation="h",
-        labels={
-            "RATE_PER_100_N": "Obesity Rate (%)",
-            "NAME": "Country",
-            "DIM_SEX": "Gender",
-            "Category": "Group",
-            "Average Rate": "Average Obesity Rate",
-        },
-        hover_data={
-            "Average Rate": ":.2f",  # Show the average obesity rate with two decimal places
-            "RATE_PER_100_N": ":.2f",  # Show the individual rate for each gender
-            "DIM_SEX": True,  # Show gender
-            "Category": True,  # Show whether it is Top 5 or Bottom 5
-        },
-        title=f"Top 5 and Bottom 5 Countries by Obesity Prevalence from {selected_continent}",
-        color_discrete_map={
-            "MALE": "#FF9999",  # Pink for Male
-            "FEMALE": "#9999FF",  # Blue for Female
-        },
-        pattern_shape_map={
-            "Highest Obesity Rates": "/",  # Slashes for Top 5
-            "Bottom 5": "",  # No pattern for Bottom 5
-        },
-    )
+if option == "Global Obesity Visualization":
+    st.header(f"Global {indicator.name} Visualization ({selected_year})")
 
-    # Layout for fig2
-    fig2.update_layout(
-        xaxis_title="Obesity Rate (%)",
-        yaxis_title="Country",
-        legend_title="Gender",
-        margin={"t": 50, "l": 50, "r": 50, "b": 50},  # Same margins
-        width=800,  # Same width
-        height=500,  # Same height
-        legend=dict(
-            orientation="v",
-            yanchor="middle",
-            y=0.5,
-            xanchor="left",
-            x=1.02,  # Align legend to the right
-        ),
-    )
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        map_panel(selected_year, selected_continent)
+    with col2:
+        stats_panel(selected_year, selected_continent)
 
-    # Display the chart in Streamlit
-    st.plotly_chart(fig2, use_container_width=True)
+    subregions_panel(selected_year, selected_continent)
+    extremes_panel(selected_year, selected_continent)
 
 
 
 # ----------------------------------------------------------------------
-# 7. Trends Graphs
+# 6. Trends Graphs
 # ----------------------------------------------------------------------
 elif option == "Obesity Trends Over Time":
-    st.header("Obesity Prevalence Trends")
+    st.header(f"{indicator.name} Prevalence Trends")
 
     # Add an introductory description
     st.markdown(
-        """
-        This section visualizes the obesity prevalence trends over time, categorized by regions, countries, or continents.
+        f"""
+        This section visualizes the {indicator.name.lower()} prevalence trends over time, categorized by regions, countries, or continents.
         Data source: World Health Organization (WHO), Open Data Repository.
         """
     )
@@ -441,107 +506,99 @@ elif option == "Obesity Trends Over Time":
     # Selector for grouping level
     view_option = st.sidebar.radio(
         "Show trends by:",
-        ("Regions", "Countries", "Continents")
+        ("Regions", "Countries", "Continents"),
+        key="level",
     )
 
     # Dynamic selection of grouping level based on the chosen option
-    if view_option == "Regions":
-        group_by_column = "SUBREGION"
-        group_title = "Region/Subregion"
-    elif view_option == "Continents":
-        group_by_column = "CONTINENT"
-        group_title = "Continent"
-    else:
-        group_by_column = "NAME"
-        group_title = "Country"
+    group_by_column, group_title = TREND_LEVELS[view_option]
 
     # Selection of available categories for the grouping level
-    available_groups = sorted(world[group_by_column].dropna().unique())
-    selected_groups = st.multiselect(f"Select {group_title.lower()}:", available_groups)
+    available_groups = list(dataset.groups(group_by_column))
+    # Countries selected on the map are preselected
+    map_selection = []
+    if group_by_column == "NAME":
+        map_selection = [name for name in st.session_state.get("selected_countries", []) if name in available_groups]
+    selected_groups = st.multiselect(
+        f"Select {group_title.lower()}:", available_groups, default=map_selection, key="groups"
+    )
 
     # Button to include/exclude the global trend
-    include_global_trend = st.sidebar.checkbox("Include global trend", value=False)
+    include_global_trend = st.sidebar.checkbox("Include global trend", value=False, key="include_global")
+
+    # Plain yearly means, smoothed series or year-over-year changes
+    transform = st.sidebar.selectbox(
+        "Show the trend as:", list(TRANSFORMS), format_func=lambda name: TRANSFORMS[name][0], key="transform"
+    )
 
     if not selected_groups:
         st.warning(f"Select at least one {group_title.lower()} to display trends.")
     else:
-        # Filter data by the selected grouping level (region, country, or continent)
-        filtered_data = world[world[group_by_column].isin(selected_groups)]
-
-        # Calculate global obesity trend (optional)
-        global_trend = (
-            world.groupby("DIM_TIME")["RATE_PER_100_N"]
-            .mean()
-            .reset_index()
-            .rename(columns={"RATE_PER_100_N": "Global Average"})
-        )
-
         # Check for required columns
-        if "DIM_TIME" in filtered_data.columns and "RATE_PER_100_N" in filtered_data.columns:
-            # Group data by the selected level and year
-            trend_data = (
-                filtered_data.groupby([group_by_column, "DIM_TIME"])["RATE_PER_100_N"]
-                .mean()
-                .reset_index()
-            )
-            # Determine if only one category is selected
-            if len(selected_groups) == 1:
-                line_color = ["#FF5733"]  # Streamlit's orange for a single line
-                markers = False  # Disable markers for single-line aesthetics
-            else:
-                line_color = px.colors.qualitative.Set2
-                markers = False
-
-            # Create the plot using Plotly
-            fig = px.line(
-                trend_data,
-                x="DIM_TIME",
-                y="RATE_PER_100_N",
-                color=group_by_column,
-                labels={
-                    "DIM_TIME": "Year",
-                    "RATE_PER_100_N": "Obesity Rate (%)",
-                    group_by_column: group_title,
-                },
-                title=f"Obesity Prevalence Trends by {group_title}",
-                markers=markers,
-                color_discrete_sequence=line_color,
+        if "DIM_TIME" in facts.columns and "RATE_PER_100_N" in facts.columns:
+            fig = cached_figure(
+                "trend_figure",
+                figure_key(
+                    "trends",
+                    level=view_option,
+                    groups=frozenset(selected_groups),
+                    include_global_trend=include_global_trend,
+                    transform=transform,
+                    indicator=indicator.code,
+                    version=snapshot.version,
+                ),
+                lambda: trend_figure(
+                    snapshot.engine, view_option, selected_groups, include_global_trend, transform, indicator,
+                    snapshot.uncertainty,
+                ),
             )
 
-            # Add the global trend if selected
-            if include_global_trend:
-                # Smoothing the global trend for better interpretation
-                fig.add_scatter(
-                    x=global_trend["DIM_TIME"],
-                    y=global_trend['Global Average'],
-                    mode="lines",
-                    name="Global Trend Average",
-                    line=dict(color="black"),
+            # Display the graph in Streamlit
+            plotly_chart("trend_chart", fig)
+            if transform == "mean":
+                st.caption(
+                    "Shaded bands are 95% intervals of each line: a country's average credible interval, "
+                    "or for a region or continent the interval of its mean, taking countries as independent. "
+                    "\u25b2/\u25bc mark a significant rise/fall between the first and last year: "
+                    "their intervals do not overlap."
                 )
 
-            # Customize the layout
-            fig.update_layout(
-                xaxis_title="Year",
-                yaxis_title="Obesity Rate (%)",
-                legend_title=group_title,
-                margin={"t": 50, "l": 50, "r": 50, "b": 50},
-                width=900,
-                height=600,
-                legend=dict(
-                    orientation="v",  # Vertical alignment
-                    yanchor="top",
-                    y=1.0,
-                    xanchor="left",
-                    x=1.02,
-                ),
+            # Countries of the selected groups ranked by the rise of their rate,
+            # sliced from arrays computed at load time
+            st.subheader("Fastest-Rising Countries")
+            sexes = list(cube.sexes)
+            sex = st.radio(
+                "Sex:", sexes, index=sexes.index("TOTAL") if "TOTAL" in sexes else 0,
+                format_func=str.title, horizontal=True, key="rising_sex",
             )
-
-            # Display the graph in Streamlit
-            st.plotly_chart(fig, use_container_width=True)
+            with recorder.stage("rising_table") as record:
+                uncertainty = snapshot.uncertainty
+                table = uncertainty.rising_table(uncertainty.countries_of(group_by_column, selected_groups), sex)
+                record["rows"] = len(table)
+                st.dataframe(
+                    table,
+                    hide_index=True,
+                    use_container_width=True,
+                    column_config={
+                        column: st.column_config.NumberColumn(format="%.2f")
+                        for column in table.columns if column not in ("Country", "Continent", "Significant")
+                    },
+                )
         else:
             st.warning("The required columns for creating the graph were not found.")
 
 
+# ----------------------------------------------------------------------
+# Debug Panel
+# ----------------------------------------------------------------------
+if recorder.enabled:
+    with st.sidebar.expander("Debug: stage timings"):
+        stage_timings(recorder.summary())
+        st.caption("Figure cache")
+        st.json(figure_cache.stats())
+        st.caption("Indicator cache")
+        st.json(indicator_store.stats())
+
 # ----------------------------------------------------------------------
 # Footer with Data Source
 # ----------------------------------------------------------------------
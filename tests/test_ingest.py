@@ -0,0 +1,113 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dashboard import store
+from dashboard.dataset import Dataset
+from dashboard.ingest import LiveData, Snapshot, diff_rows, refresh
+from dashboard.uncertainty import LOWER
+
+
+def facts(rows):
+    """
+    Fact table of ``(GEO_KEY, year, sex, rate, lower, upper)`` rows.
+    """
+    frame = pd.DataFrame(
+        rows, columns=["GEO_KEY", "DIM_TIME", "DIM_SEX", "RATE_PER_100_N", "RATE_PER_100_NL", "RATE_PER_100_NU"]
+    )
+    frame["DIM_SEX"] = frame["DIM_SEX"].astype("category")
+    return frame
+
+
+CODES = np.array([4, 8])
+
+
+def test_diff_rows_added_removed_changed():
+    old = facts([
+        (0, 2020, "MALE", 10.0, 9.0, 11.0),
+        (0, 2021, "MALE", 12.0, 11.0, 13.0),
+        (1, 2020, "FEMALE", 20.0, 19.0, 21.0),
+    ])
+    new = facts([
+        (0, 2020, "MALE", 10.0, 9.0, 11.0),
+        (0, 2021, "MALE", 12.5, 11.0, 13.0),
+        (1, 2022, "FEMALE", 22.0, 21.0, 23.0),
+    ])
+    diff = diff_rows(old, new, CODES)
+
+    assert diff.added.values.tolist() == [[8, 2022, "FEMALE"]]
+    assert diff.removed.values.tolist() == [[8, 2020, "FEMALE"]]
+    assert diff.changed.values.tolist() == [[4, 2021, "MALE"]]
+    assert diff.years() == [2020, 2021, 2022]
+    assert len(diff) == 3
+
+
+def test_diff_rows_nan_equals_nan():
+    old = facts([(0, 2020, "MALE", 10.0, np.nan, np.nan)])
+    new = facts([(0, 2020, "MALE", 10.0, np.nan, np.nan)])
+    assert len(diff_rows(old, new, CODES)) == 0
+
+    changed = facts([(0, 2020, "MALE", 10.0, 9.0, np.nan)])
+    assert diff_rows(old, changed, CODES).changed.values.tolist() == [[4, 2020, "MALE"]]
+
+
+@pytest.fixture
+def sources(tmp_path):
+    """
+    ``(csv, shapefile, cache)`` paths: a copy of the WHO export with its
+    table cache under ``tmp_path``.
+    """
+    if not os.path.exists(store.CSV_PATH):
+        pytest.skip("WHO export not available")
+    csv_path = str(tmp_path / "obesity.csv")
+    shutil.copyfile(store.CSV_PATH, csv_path)
+    cache_dir = str(tmp_path / "cache")
+    store.rebuild_cache(csv_path, store.SHAPEFILE_PATH, cache_dir)
+    return csv_path, store.SHAPEFILE_PATH, cache_dir
+
+
+def set_rate(csv_path, year, rate):
+    """
+    Set the estimate of the first row of ``year`` in the CSV.
+    """
+    data = pd.read_csv(csv_path)
+    data.loc[(data["DIM_TIME"] == year).idxmax(), "RATE_PER_100_N"] = rate
+    data.to_csv(csv_path, index=False)
+
+
+def test_refresh_unchanged_sources(sources):
+    table, unmatched = store.read_fact_table(store.read_manifest(sources[2]), sources[2])
+    snapshot = Snapshot.build(Dataset(table, unmatched))
+
+    new, report = refresh(snapshot, *sources)
+
+    assert new is snapshot
+    assert report is None
+
+
+def test_edit_reaches_live_snapshot_after_geometry_load(sources):
+    live = LiveData.load(*sources)
+    snapshot = live.current
+    set_rate(sources[0], 2022, 99.0)
+
+    # Drawing the map before the watcher runs must not consume the change
+    assert len(snapshot.dataset.geometry)
+    report = live.refresh()
+
+    assert report is not None
+    assert report["mode"] == "incremental"
+    assert report["changed"] == 1
+    assert report["years"] == [2022]
+    facts = live.current.dataset.facts
+    assert (facts["RATE_PER_100_N"] == np.float32(99.0)).any()
+    assert live.current.version_of(2022) == 1
+    assert live.current.version_of(2021) == 0
+
+    # Only 2022 was aggregated again, with the same result as a full build
+    full = Snapshot.build(live.current.dataset)
+    assert np.allclose(live.current.engine.world.mean, full.engine.world.mean, equal_nan=True)
+    assert np.allclose(live.current.uncertainty.world[LOWER], full.uncertainty.world[LOWER], equal_nan=True)
+    assert live.refresh() is None